@@ -27,42 +27,92 @@
 
 import __builtin__
 import StringIO
+import threading
+import hashlib
+import os
+import posixpath
+import ntpath
+import errno
+import binascii
+import tempfile
+import json
+import tarfile
+import zipfile
+import subprocess
+import Queue
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 
-_replaced_stack = []
+# Each thread keeps its own stack of active interceptors. __builtin__.open
+# is replaced once by intercept_open (the dispatch shim) and never restored:
+# threads without active interceptors fall back to the original open().
+_thread_state = threading.local()
 _original_open = __builtin__.open
+_shim_lock = threading.Lock()
+
+def _replaced_stack():
+    try:
+        return _thread_state.stack
+    except AttributeError:
+        _thread_state.stack = []
+        return _thread_state.stack
+        
+def _install_shim():
+    with _shim_lock:
+        if __builtin__.open is not intercept_open:
+            __builtin__.open = intercept_open
 
 class StringIO_noclose(StringIO.StringIO):
+    def __init__(self, buf="", on_close=None):
+        StringIO.StringIO.__init__(self, buf)
+        # called with this object each time the file is "closed"
+        self.on_close = on_close
+        
     def close(self):
-        pass
+        if self.on_close is not None:
+            self.on_close(self)
         
     def true_close(self):
-        return StringIO.close(self)
+        return StringIO.StringIO.close(self)
         
     def __enter__(self):
         return self
         
     def __exit__(self, exc_type, exc_value, traceback):
-        pass
+        if exc_type is None:
+            self.close()
         
 class open_interceptor():
     """
     open_interceptor: simple interceptor based on file extensions
+    
+    Interception is scoped to the thread that enters the interceptor, so 
+    conversions running on different threads can capture their own files.
+    
+    With virtual=True the interceptor works as a virtual filesystem: 
+    captured files can also be read and appended, and appending to a new 
+    file with a filtered extension creates it in memory.
+    
+    sink is an optional callable sink(name, content), called each time an 
+    intercepted file is closed (see analysis_sink).
     """
-    def __init__(self, file_extensions, enabled=True):
+    def __init__(self, file_extensions, enabled=True, virtual=False, sink=None):
         self.file_extensions = file_extensions
         self.enable_replace = enabled
+        self.virtual = virtual
+        self.sink = sink
         self.replaced_files = {}
+        self._files_lock = threading.Lock()
         
     def get_interceptor(self):
         return interceptor(self)
         
     def intercept_enter(self):
-        global _replaced_stack
-        _replaced_stack.append(self)
+        _replaced_stack().append(self)
         
     def intercept_exit(self):
-        global _replaced_stack
-        if _replaced_stack.pop() != self:
+        stack = _replaced_stack()
+        if len(stack) == 0 or stack.pop() is not self:
             raise ValueError("Stack inconsistent.")
             
     def filter(self, name, mode, buffering):
@@ -72,35 +122,378 @@ class open_interceptor():
                 return True
         return False
         
+    def new_file(self, name):
+        # the same object may be entered from several threads
+        if self.sink is not None:
+            f = StringIO_noclose(on_close=lambda f: self.sink(name, f.getvalue()))
+        else:
+            f = StringIO_noclose()
+        with self._files_lock:
+            self.replaced_files[name] = f
+        return f
+        
+    def exists(self, name):
+        return name in self.replaced_files
+        
+    def open_file(self, name, mode, buffering):
+        """
+        Return an in-memory file for an open() call, or None to use the 
+        original open()
+        """
+        if not self.enable_replace:
+            return None
+        if not self.virtual:
+            # only replace new files
+            if mode == 'w' and self.filter(name, mode, buffering):
+                return self.new_file(name)
+            return None
+        base_mode = mode.lstrip("U")[:1]
+        if base_mode == 'w':
+            if self.filter(name, mode, buffering):
+                return self.new_file(name)
+        elif base_mode == 'a':
+            f = self.replaced_files.get(name)
+            if f is not None:
+                f.seek(0, os.SEEK_END)
+                return f
+            if self.filter(name, mode, buffering):
+                return self.new_file(name)
+        elif base_mode in ('r', ''):
+            f = self.replaced_files.get(name)
+            if f is not None:
+                if "+" in mode:
+                    f.seek(0)
+                    return f
+                # independent reader: don't move the writer position
+                return StringIO_noclose(f.getvalue())
+        return None
+        
+    def flush(self, dest_dir=".", only_changed=True, atomic=True, jobs=1):
+        """
+        Write all intercepted files to disk.
+        
+        Arguments:
+        * dest_dir: destination directory. File names are relative to it
+        * only_changed: skip files whose content hash is the same as the 
+          existing file on disk (keeps its mtime untouched)
+        * atomic: write to a temporary file and rename it to its final name
+        * jobs: number of parallel writer threads
+        
+        Returns: list of written file paths.
+        """
+        with self._files_lock:
+            items = self.replaced_files.items()
+        args = [(os.path.join(dest_dir, name), f.getvalue(), only_changed, atomic) 
+                for name, f in items]
+        if jobs > 1 and len(args) > 1:
+            pool = ThreadPool(jobs)
+            try:
+                results = pool.map(_flush_file, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_flush_file, args)
+        return [path for path in results if path is not None]
+        
+    def export_archive(self, path, archive_format=None):
+        """
+        Save all intercepted files in a single compressed archive.
+        
+        The archive is content-addressed: each distinct content is stored 
+        once as "objects/<sha1>", and "MANIFEST.json" maps file names to 
+        content hashes.
+        
+        Arguments:
+        * path: archive file name
+        * archive_format: one of _archive_formats keys. Default: guess from 
+          path extension
+        """
+        archive_format = _archive_format(path, archive_format)
+        manifest = {"version": _archive_version, "files": {}}
+        objects = {}
+        with self._files_lock:
+            items = self.replaced_files.items()
+        for name, f in items:
+            content = f.getvalue()
+            digest = hashlib.sha1(content).hexdigest()
+            manifest["files"][name] = digest
+            objects[digest] = content
+        members = [("MANIFEST.json", json.dumps(manifest, indent=1, sort_keys=True))]
+        for digest in sorted(objects.iterkeys()):
+            members.append(("objects/%s" % digest, objects[digest]))
+        with _original_open(path, "wb") as af:
+            if archive_format == "zip":
+                zf = zipfile.ZipFile(af, "w", zipfile.ZIP_DEFLATED)
+                for name, content in members:
+                    zf.writestr(name, content)
+                zf.close()
+            else:
+                tf = tarfile.open(fileobj=af, mode="w:%s" % _archive_formats[archive_format])
+                for name, content in members:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(content)
+                    tf.addfile(info, StringIO.StringIO(content))
+                tf.close()
+        
+    def import_archive(self, path, archive_format=None):
+        """
+        Load files from an archive created with export_archive(). Loaded 
+        files are added to replaced_files. File names are normalized; names 
+        outside the archive root (absolute or with "..") raise ValueError.
+        
+        Returns: list of loaded file names.
+        """
+        archive_format = _archive_format(path, archive_format)
+        with _original_open(path, "rb") as af:
+            if archive_format == "zip":
+                zf = zipfile.ZipFile(af, "r")
+                read_member = zf.read
+            else:
+                tf = tarfile.open(fileobj=af, mode="r:%s" % _archive_formats[archive_format])
+                read_member = lambda name: tf.extractfile(name).read()
+            try:
+                manifest = json.loads(read_member("MANIFEST.json"))
+            except KeyError:
+                raise ValueError("Archive '%s' doesn't have a manifest." % path)
+            if manifest.get("version") != _archive_version:
+                raise ValueError("Unsupported archive version %s." % repr(manifest.get("version")))
+            objects = {}
+            for digest in set(manifest["files"].itervalues()):
+                content = read_member("objects/%s" % digest)
+                if hashlib.sha1(content).hexdigest() != digest:
+                    raise ValueError("Corrupted object '%s' in archive '%s'." % (digest, path))
+                objects[digest] = content
+        # check all names before loading any file
+        files = [(_archive_member_name(name, path), digest) 
+                 for name, digest in manifest["files"].iteritems()]
+        names = []
+        for name, digest in files:
+            f = self.new_file(name)
+            f.write(objects[digest])
+            names.append(name)
+        return names
+        
+# archive formats supported by export_archive() and import_archive()
+# format: tarfile compression ("zip" is handled by zipfile)
+_archive_formats = OrderedDict([("tar.bz2", "bz2"), ("tar.gz", "gz"), ("tgz", "gz"), ("tar", ""), ("zip", None)])
+_archive_version = 1
+
+def _archive_format(path, archive_format):
+    if archive_format is None:
+        for fmt in _archive_formats.iterkeys():
+            if path.endswith("." + fmt):
+                return fmt
+        raise ValueError("Unable to guess archive format for '%s'." % path)
+    if archive_format not in _archive_formats:
+        raise ValueError("Unknown archive format '%s'." % archive_format)
+    return archive_format
+        
+def _archive_member_name(name, path):
+    # normalized file name from an archive manifest, relative to the archive
+    # root (a later flush() must not write outside dest_dir)
+    # json returns unicode strings
+    norm = posixpath.normpath(str(name).replace("\\", "/"))
+    if posixpath.isabs(norm) or ntpath.splitdrive(norm)[0] != "" or \
+            norm in (".", "..") or norm.startswith("../"):
+        raise ValueError("Unsafe file name '%s' in archive '%s'." % (name, path))
+    return norm
+        
+def _file_digest(path):
+    h = hashlib.sha1()
+    with _original_open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), ""):
+            h.update(chunk)
+    return h.digest()
+        
+def _create_tmpfile(dirname):
+    # like tempfile.mkstemp(), but the file gets regular permissions: 
+    # os.open() applies the current umask to 0666, without reading or 
+    # changing the process umask. Returns (fd, path)
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    for i in xrange(tempfile.TMP_MAX):
+        path = os.path.join(dirname, ".tmp_%s" % binascii.hexlify(os.urandom(6)))
+        try:
+            return os.open(path, flags, 0666), path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    raise IOError(errno.EEXIST, "No usable temporary file name found in '%s'." % dirname)
+        
+def _flush_file(args):
+    path, content, only_changed, atomic = args
+    if only_changed and os.path.isfile(path):
+        if _file_digest(path) == hashlib.sha1(content).digest():
+            return None
+    dirname = os.path.dirname(path)
+    if dirname != "" and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # created by another writer thread
+            if not os.path.isdir(dirname):
+                raise
+    if atomic:
+        fd, tmppath = _create_tmpfile(dirname or ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            # replaced files keep their permissions
+            if os.path.exists(path):
+                os.chmod(tmppath, os.stat(path).st_mode & 07777)
+            if os.name == "nt" and os.path.exists(path):
+                # no atomic replace on Windows
+                os.remove(path)
+            os.rename(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+    else:
+        with _original_open(path, "wb") as f:
+            f.write(content)
+    return path
+        
+class analysis_sink(object):
+    """
+    analysis_sink: open_interceptor sink that analyzes each completed file
+    
+    Each file passed to the sink is written to dest_dir (only if changed) 
+    and analyzed by a pool of long-lived worker threads, so analysis runs
+    while the conversion goes on with other components. 
+    
+    Arguments:
+    * command: analysis command, "%(filename)s" is replaced with the file path
+    * dest_dir: directory where files are written
+    * jobs: number of worker threads. With jobs > 1 files can be analyzed out
+      of order: files whose analysis fails are analyzed again by close(), in 
+      the order they were completed
+    * shared_workdir: analysis commands use the same library (e.g. GHDL 
+      rewrites work-obj93.cf on each analysis), so only one runs at a time; 
+      workers still write files in parallel. Set it to False only if each 
+      analysis uses its own library
+    
+    Usage:
+    
+    sink = analysis_sink("ghdl -a --workdir=work %(filename)s")
+    i_files = open_interceptor(("vhd",), sink=sink)
+    with i_files.get_interceptor():
+        toVHDL_kh(topmodule, signals)
+    failed = sink.close()
+    """
+    def __init__(self, command="ghdl -a --workdir=work %(filename)s", dest_dir=".", jobs=1, 
+                 shared_workdir=True):
+        self.command = command
+        self.dest_dir = dest_dir
+        self.completed = []
+        self.failed = OrderedDict()
+        self._lock = threading.Lock()
+        self._analyze_lock = threading.Lock() if shared_workdir else None
+        # last content of each file, to write it again on retry
+        self._contents = {}
+        self._closed = False
+        self._queue = Queue.Queue()
+        self._workers = []
+        for i in range(jobs):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+            
+    def __call__(self, name, content):
+        if self._closed:
+            raise ValueError("Sink already closed.")
+        path = os.path.join(self.dest_dir, name)
+        with self._lock:
+            # keep completion order. A file closed again is analyzed again
+            if path in self.completed:
+                self.completed.remove(path)
+            self.completed.append(path)
+            self._contents[path] = content
+        self._queue.put((path, content))
+        
+    def close(self):
+        """
+        Wait for pending analysis and stop the workers. Calling it again 
+        only returns the same result.
+        
+        Returns: dict with failed file paths as keys and command return 
+        value (or the exception raised writing the file or running the 
+        command) as values.
+        """
+        if self._closed:
+            return dict(self.failed)
+        self._closed = True
+        for t in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
+        # retry failed files until no progress is made
+        while len(self.failed) > 0:
+            retry = [path for path in self.completed if path in self.failed]
+            progress = False
+            for path in retry:
+                retval = self._process(path, self._contents[path])
+                if retval == 0:
+                    del self.failed[path]
+                    progress = True
+                else:
+                    self.failed[path] = retval
+            if not progress:
+                break
+        return dict(self.failed)
+        
+    def _analyze(self, path):
+        if self._analyze_lock is None:
+            return subprocess.call(self.command % {"filename": path}, shell=True)
+        with self._analyze_lock:
+            return subprocess.call(self.command % {"filename": path}, shell=True)
+            
+    def _process(self, path, content):
+        # write and analyze a file. Returns the command return value, or 
+        # the exception raised
+        try:
+            _flush_file((path, content, True, True))
+            return self._analyze(path)
+        except Exception as e:
+            return e
+        
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            path, content = item
+            retval = self._process(path, content)
+            with self._lock:
+                if retval != 0:
+                    self.failed[path] = retval
+                elif path in self.failed:
+                    del self.failed[path]
+        
 class interceptor():
     def __init__(self, ic_ref):
         self.ic_ref = ic_ref
-        self.built_module = __import__("__builtin__")
-        self.prev_open = getattr(self.built_module, "open")
     
     def __enter__(self):
+        _install_shim()
         self.ic_ref.intercept_enter()
-        setattr(self.built_module, "open", intercept_open)
         return self
         
     def __exit__(self, exc_type, exc_value, traceback):
         self.ic_ref.intercept_exit()
-        setattr(self.built_module, "open", self.prev_open)
-        
-def intercept_open(name, mode='r', buffering=0):
-    global _replaced_stack
-    ic_ref = _replaced_stack[-1]
-    if ic_ref.enable_replace:
-        # only replace new files
-        if mode == 'w':
-            if ic_ref.filter(name, mode, buffering):
-                f = StringIO_noclose()
-                ic_ref.replaced_files[name] = f
-                return f
+        
+def intercept_open(name, mode='r', buffering=-1):
+    stack = _replaced_stack()
+    if len(stack) > 0:
+        f = stack[-1].open_file(name, mode, buffering)
+        if f is not None:
+            return f
     # otherwise, use original open
     return _original_open(name, mode, buffering)
     
 def current_interceptor():
-    global _replaced_stack
-    if len(_replaced_stack) > 0:
-        return _replaced_stack[-1]
+    stack = _replaced_stack()
+    if len(stack) > 0:
+        return stack[-1]
@@ -4,9 +4,10 @@
 from myhdl.conversion import verify, analyze, registerSimulator
 import sys
 import os
-import glob
 import subprocess
 
+from vhdl_lib import vhdl_project
+
 registerSimulator(
     name="GHDL_kh",
     hdl="VHDL",
@@ -19,37 +20,31 @@ verify.simulator = analyze.simulator = "GHDL_kh"
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
-        # TODO: change to mimic make-like operation
-        #print "DEBUG: Extra analyze for %s" % sys.argv[1]
-        files = glob.glob("*.vhd")
-        files.sort(cmp=lambda x, y : cmp(os.stat(x).st_mtime, os.stat(y).st_mtime))
-        pck = []
-        # Analyze packages first
-        for f in files:
-            if f.startswith("pck_"):
-                pck.append(f)
-                #print "Pck Analyze %s" % f
-                retval = subprocess.call("ghdl -a --workdir=work %s" % f, shell=True)
-                if retval != 0:
-                    print "GHDL Analyze error (%s)." % f
-                    sys.exit(retval)
-        for f in pck:
-            files.remove(f)
-        for f in files:
-            if f == "%s.vhd" % sys.argv[1]:
-                continue
-            if os.stat(f).st_size == 0:
-                continue
-            if os.path.isfile("work/" + f.replace(".vhd", ".o")):
-                if os.stat(f).st_mtime < os.stat("work/" + f.replace(".vhd", ".o")).st_mtime:
-                    #print "File up to date %s" % f
+        # analyze the top file after the files it depends on (packages and 
+        # instantiated entities). Make-like: a file is analyzed again if it 
+        # changed or one of its dependencies was analyzed again
+        top = "%s.vhd" % sys.argv[1]
+        project = vhdl_project("*.vhd")
+        project.parse(processes=1, ignore_errors=True)
+        order = project.compile_order(top)
+        # files the parser can't read have unknown dependencies: analyze 
+        # them before the top file
+        for f, error in project.errors.iteritems():
+            print "Parse error in %s, analyzed before top file: %s" % (f, error)
+            if f not in order:
+                order.insert(len(order) - 1, f)
+        analyzed = set()
+        for f in order:
+            if f != top:
+                if os.stat(f).st_size == 0:
                     continue
-            #print "Sub Analyze %s" % f
+                obj = "work/" + f.replace(".vhd", ".o")
+                if os.path.isfile(obj) and os.stat(f).st_mtime < os.stat(obj).st_mtime:
+                    if len(analyzed.intersection(project.dependencies(f))) == 0:
+                        #print "File up to date %s" % f
+                        continue
             retval = subprocess.call("ghdl -a --workdir=work %s" % f, shell=True)
-            #if retval != 0:
-            #    print "GHDL Analyze error (ignore)."
-        #print "Analyze %s.vhd" % sys.argv[1]
-        retval = subprocess.call("ghdl -a --workdir=work %s.vhd" % sys.argv[1], shell=True)
-        if retval != 0:
-            print "GHDL Analyze error (%s)." % f
-            sys.exit(retval)
+            if retval != 0:
+                print "GHDL Analyze error (%s)." % f
+                sys.exit(retval)
+            analyzed.add(f)
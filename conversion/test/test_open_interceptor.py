@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Tests for open_interceptor
+
+import sys
+sys.path.append("..")
+
+import unittest
+from unittest import TestCase
+import os
+import json
+import hashlib
+import shutil
+import tarfile
+import tempfile
+import threading
+import StringIO
+
+from open_interceptor import open_interceptor, analysis_sink
+
+class TempDirCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+class TestThreadScope(TempDirCase):
+
+    def testOtherThread(self):
+        """ files opened by other threads are not intercepted """
+        i_files = open_interceptor(("vhd",))
+        entered = threading.Event()
+        written = threading.Event()
+        def other():
+            entered.wait()
+            with open(self.path("other.vhd"), "w") as f:
+                f.write("other")
+            written.set()
+        t = threading.Thread(target=other)
+        t.start()
+        with i_files.get_interceptor():
+            entered.set()
+            written.wait()
+            with open(self.path("mine.vhd"), "w") as f:
+                f.write("mine")
+        t.join()
+        self.assertEqual(i_files.replaced_files.keys(), [self.path("mine.vhd")])
+        self.assertEqual(os.listdir(self.tmpdir), ["other.vhd"])
+
+    def testExtensions(self):
+        """ only new files with filtered extensions """
+        i_files = open_interceptor(("vhd",))
+        with i_files.get_interceptor():
+            with open(self.path("a.vhd"), "w") as f:
+                f.write("a")
+            with open(self.path("b.txt"), "w") as f:
+                f.write("b")
+        self.assertEqual(i_files.replaced_files[self.path("a.vhd")].getvalue(), "a")
+        self.assertEqual(os.listdir(self.tmpdir), ["b.txt"])
+
+class TestFlush(TempDirCase):
+
+    def capture(self, files):
+        i_files = open_interceptor(("vhd",))
+        with i_files.get_interceptor():
+            for name, content in files.iteritems():
+                with open(name, "w") as f:
+                    f.write(content)
+        return i_files
+
+    def testChangedOnly(self):
+        """ unchanged files are not written again """
+        files = {"a.vhd": "a", os.path.join("sub", "b.vhd"): "b"}
+        written = self.capture(files).flush(self.tmpdir)
+        self.assertEqual(sorted(written), [self.path("a.vhd"), self.path(os.path.join("sub", "b.vhd"))])
+        self.assertEqual(open(self.path("a.vhd")).read(), "a")
+        os.utime(self.path("a.vhd"), (1000, 1000))
+        files[os.path.join("sub", "b.vhd")] = "changed"
+        written = self.capture(files).flush(self.tmpdir, jobs=2)
+        self.assertEqual(written, [self.path(os.path.join("sub", "b.vhd"))])
+        self.assertEqual(os.stat(self.path("a.vhd")).st_mtime, 1000)
+        self.assertEqual(open(self.path(os.path.join("sub", "b.vhd"))).read(), "changed")
+        # no temporary files left
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["a.vhd", "sub"])
+
+    def testPermissions(self):
+        """ new files follow the umask, replaced files keep their mode """
+        umask = os.umask(027)
+        try:
+            self.capture({"a.vhd": "a"}).flush(self.tmpdir)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.path("a.vhd")).st_mode & 0777, 0640)
+        os.chmod(self.path("a.vhd"), 0600)
+        self.capture({"a.vhd": "changed"}).flush(self.tmpdir)
+        self.assertEqual(os.stat(self.path("a.vhd")).st_mode & 0777, 0600)
+
+class TestVirtual(TempDirCase):
+
+    def testReadAppend(self):
+        """ captured files can be read and appended """
+        i_files = open_interceptor(("vhd",), virtual=True)
+        name = self.path("a.vhd")
+        with i_files.get_interceptor():
+            with open(name, "w") as f:
+                f.write("line1\n")
+            with open(name, "a") as f:
+                f.write("line2\n")
+            with open(name) as f:
+                self.assertEqual(f.readlines(), ["line1\n", "line2\n"])
+            # new file in append mode
+            with open(self.path("b.vhd"), "a") as f:
+                f.write("b")
+            self.assertTrue(i_files.exists(self.path("b.vhd")))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+class TestArchive(TempDirCase):
+
+    def testRoundTrip(self):
+        """ export and import in every format, same contents stored once """
+        i_files = open_interceptor(("vhd",))
+        for name, content in (("a.vhd", "same"), ("b.vhd", "same"), ("w/c.vhd", "other")):
+            i_files.new_file(name).write(content)
+        for fmt in ("tar.bz2", "tar.gz", "tgz", "tar", "zip"):
+            path = self.path("files." + fmt)
+            i_files.export_archive(path)
+            loaded = open_interceptor(("vhd",))
+            self.assertEqual(sorted(loaded.import_archive(path)), ["a.vhd", "b.vhd", "w/c.vhd"])
+            self.assertEqual(loaded.replaced_files["w/c.vhd"].getvalue(), "other")
+            self.assertEqual(loaded.replaced_files["b.vhd"].getvalue(), "same")
+        members = tarfile.open(self.path("files.tar")).getnames()
+        self.assertEqual(len(members), 3)
+
+    def testUnsafeNames(self):
+        """ names outside the archive root are rejected """
+        for name in ("../x.vhd", "/tmp/x.vhd", "a/../../x.vhd"):
+            path = self.path("bad.tar")
+            tf = tarfile.open(path, "w")
+            manifest = json.dumps({"version": 1, "files": {name: hashlib.sha1("x").hexdigest()}})
+            for member, content in (("MANIFEST.json", manifest), 
+                                    ("objects/" + hashlib.sha1("x").hexdigest(), "x")):
+                info = tarfile.TarInfo(member)
+                info.size = len(content)
+                tf.addfile(info, StringIO.StringIO(content))
+            tf.close()
+            i_files = open_interceptor(("vhd",))
+            self.assertRaises(ValueError, i_files.import_archive, path)
+            self.assertEqual(i_files.replaced_files, {})
+
+class TestAnalysisSink(TempDirCase):
+
+    def write(self, i_files, name, content):
+        with i_files.get_interceptor():
+            with open(name, "w") as f:
+                f.write(content)
+
+    def testRetry(self):
+        """ files analyzed before their dependencies are analyzed again """
+        # each file holds the name of a file that must be analyzed first
+        command = 'd=$(cat %(filename)s); test -z "$d" -o -e "$d.done" && touch %(filename)s.done'
+        sink = analysis_sink(command, dest_dir=self.tmpdir)
+        i_files = open_interceptor(("vhd",), sink=sink)
+        self.write(i_files, "b.vhd", self.path("a.vhd"))
+        self.write(i_files, "a.vhd", "")
+        self.assertEqual(sink.close(), {})
+        self.assertTrue(os.path.exists(self.path("b.vhd.done")))
+        self.assertRaises(ValueError, sink, "c.vhd", "")
+
+    def testFailures(self):
+        """ command errors and exceptions are reported, close() only once """
+        sink = analysis_sink("exit 3; %(filename)s", dest_dir=self.tmpdir, jobs=2)
+        sink("a.vhd", "a")
+        self.assertEqual(sink.close(), {self.path("a.vhd"): 3})
+        # dest_dir is a file: writing fails
+        open(self.path("file"), "w").close()
+        sink = analysis_sink("touch %(filename)s.done", dest_dir=self.path("file"), jobs=2)
+        sink("a.vhd", "a")
+        failed = sink.close()
+        self.assertEqual(failed.keys(), [os.path.join(self.path("file"), "a.vhd")])
+        self.assertTrue(isinstance(failed.values()[0], EnvironmentError))
+        self.assertEqual(sink.close(), failed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -24,8 +24,6 @@
 # <http://www.gnu.org/licenses/>.
 #
 
-import os
-import StringIO
 from datetime import datetime
 import vhdl_lib
 
@@ -38,39 +36,24 @@ import vhdl_lib
 #        yield delay(1)
 #    return empty
   
-def gen_cosim_testbench(source, generics_values={}):
+def gen_cosim_testbench(source, generics_values={}, cache=None):
     """
     Generate a VHDL testbench for use in GHDL co-simulation
     * source: base design (str, file, path or StringIO)
     * generics_values: dict with optional generic values
+    * cache: vhdl_lib.vhdl_cache object or directory, to skip parsing the 
+      same design again
     """
-    if type(source) == str:
-        if os.path.exists(source):
-            filename = source
-            with open(source) as f:
-                filecontent = StringIO.StringIO(f.read())
-        else:
-            # assume string content
-            filecontent = StringIO.StringIO(source)
-    elif type(source) == file:
-        filename = source.name
-        t = source.tell()
-        source.seek(0)
-        filecontent = StringIO.StringIO(source.read())
-        source.seek(t)
-    elif isinstance(source, StringIO.StringIO):
-        filecontent = source
-    else:
-        raise ValueError("Unable to get any VHDL source with %s" % repr(source))
+    filename, filecontent = vhdl_lib.read_source(source)
     
-    vp = vhdl_parser.vhdl_parser(filecontent)
-    vp.parse()
+    vp = vhdl_lib.vhdl_parser(filecontent)
+    vp.parse(cache)
     dut_name = vp.model.get_entity_name()
     tb_name = "%s_tb" % dut_name
     for g, v in generics_values.items():
         vp.model.set_generic_value(g, v)
         
-    vcg = vhdl_parser.vhdl_codegen(vp.model)
+    vcg = vhdl_lib.vhdl_codegen(vp.model)
     
     ghdl_constdata = {"to_width": 0, "from_width": 0, "to_info": "", "from_info": ""}
     signal_decl = []
@@ -159,13 +142,13 @@ def gen_cosim_testbench(source, generics_values={}):
     #return i_files.replaced_files[".vhd" % tb_name].getvalue()
     
     # test with parser generator
-    tb_model = vhdl_parser.vhdl_model(entity_name = tb_name)
+    tb_model = vhdl_lib.vhdl_model(entity_name = tb_name)
     tb_model.add_std_library()
     tb_model.add_library("work.myhdl_ghdl_core")
     tb_model.set_architecture_name("tb")
     tb_model.add_architecture_body("%s\nbegin\n%s" % (cosim_decl, cosim_code))
     tb_model.add_header(_cosim_header % {"filename": "%s.vhdl" % tb_name, "date": datetime.today().ctime()})
-    return vhdl_parser.vhdl_codegen(tb_model).generate_content()
+    return vhdl_lib.vhdl_codegen(tb_model).generate_content()
         
 _cosim_header = """-- File: %(filename)s
 -- Generated by "cosim_helper"
@@ -25,10 +25,30 @@
 #
 
 import myhdl
+from myhdl._extractHierarchy import _HierExtr
 import os.path
 import time
+import atexit
+import sys
+import threading
+import Queue
+import weakref
+import json
+import struct
+import re
+import fnmatch
+import zlib
+from array import array
+from collections import deque
+from copy import copy
 from collections import OrderedDict
-from math import log
+from itertools import product, islice
+
+# optional: trace_store query API
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 """
 signal_monitor: custom class for signal tracing in MyHDL
@@ -47,6 +67,9 @@ tracer.add_trace_signal(clock, "Master_clock")
 
 trace_generator = tracer.traceConfig(sim_max_time, "vcd_filename")
 
+# or, to write value changes while the simulation runs:
+# trace_generator = tracer.traceConfig(sim_max_time, "vcd_filename", streaming=True)
+
 ...
 
 # assuming "my_generators" is a list with myhdl generators
@@ -54,8 +77,1430 @@ trace_generator = tracer.traceConfig(sim_max_time, "vcd_filename")
 my_generators.extend(trace_generator)
 sim = myhdl.Simulation(my_generators)
 sim.run(sim_max_time)
+
+# record only around an event, like a logic analyzer: start when 
+# "Master_reset" goes low, keep 100 changes before it and 500 time units after
+# trace_generator = tracer.traceConfig(sim_max_time, "vcd_filename", 
+#     trigger=("Master_reset", "negedge"), pretrigger=100, posttrigger=500)
+
+# with a co-simulation link (e.g. GHDL), trace both sides in one file:
+# cosim = myhdl.Cosimulation(cmd, **signals)
+# tracer.add_trace_cosimulation(cosim, "ghdl")
+# trace_generator = tracer.traceConfig(sim_max_time, "vcd_filename", timescale="1ns")
+
+# for long simulations, a compressed binary trace (converted to VCD later):
+# trace_generator = tracer.traceConfig(sim_max_time, "trace_filename", trace_format="smt")
+# smt_to_vcd("trace_filename.smt", "trace_filename.vcd")
+
+# for multi-hour simulations, rotate the VCD output into chunk files of about
+# 100 MB ("trace_filename.0000.vcd", ...). Each chunk has its own header and 
+# $dumpvars, "trace_filename.index.json" maps time ranges to chunks:
+# trace_generator = tracer.traceConfig(None, "trace_filename", rotate_size=100 << 20)
+# vcd_chunks("trace_filename.index.json", 5000, 6000)
+
+# only switching activity (toggle counts, per bit coverage, active cycles),
+# much cheaper than a waveform:
+# trace_generator = tracer.traceConfig(sim_max_time, "stats_filename", 
+#     trace_format="stats", stats_clock="Master_clock")
+# tracer.stats.report()
+
+# without streaming, value changes are kept in a trace_store object that can
+# be queried after simulation:
+tracer.traceinfo.value_at("Master_reset", 100)
+# with numpy: (times, values) arrays, edges, toggle counts and duty cycle
+times, values = tracer.traceinfo.arrays("Master_clock", 1000, 2000)
+tracer.traceinfo.edges("Master_clock", 1000, 2000, "posedge")
+tracer.traceinfo.duty_cycle("Master_reset")
+# SMT traces can be loaded for the same queries:
+# smt_to_store("trace_filename.smt").toggle_count("Master_reset")
+
+# in streaming mode, if the simulation ends before sim_max_time (e.g. 
+# StopSimulation) or sim_max_time is None (open-ended), close the trace:
+tracer.close()
+
+# several Simulation runs with the same traced signals (e.g. one per test 
+# case): register once, one capture session for each run. Each session 
+# writes its own file ("case_1.vcd", ...) and releases its data when stopped
+for testcase in testcases:
+    sim = myhdl.Simulation(testcase.generators + 
+        tracer.start_session(None, "case_%d"))
+    sim.run(testcase.duration)
+    tracer.stop_session()
 """
 
+# open streaming traces, closed at exit if the user didn't
+_open_streams = weakref.WeakSet()
+
+@atexit.register
+def _close_open_streams():
+    for stream in list(_open_streams):
+        stream.close()
+
+class _vcd_stream(object):
+    """
+    Streaming VCD output: value changes are written while simulation runs.
+    
+    Changes are kept in memory only for the current timestep. When time 
+    advances, the finished timestep is written to the (buffered) file, 
+    so the file always holds complete timesteps.
+    """
+    def __init__(self, path, header, bufsize=1<<16):
+        self.path = path
+        self.bufsize = bufsize
+        self.file = open(path, "w", bufsize)
+        self.file.write(header)
+        self.curtime = None
+        self.pending = []
+        _open_streams.add(self)
+        
+    def change(self, curtime, value, ref):
+        if curtime != self.curtime:
+            self.write_pending()
+            self.curtime = curtime
+        self.pending.append(value + ref)
+        
+    def write_pending(self):
+        if len(self.pending) > 0:
+            self.file.write("#%d\n%s\n" % (self.curtime, "\n".join(self.pending)))
+            self.pending = []
+            
+    def close(self, endtime=None):
+        if self.file is None:
+            return
+        self.write_pending()
+        if endtime is None:
+            endtime = self.curtime
+        if endtime is not None:
+            self.file.write("$vcdclose #%d $end\n" % endtime)
+        self.file.close()
+        self.file = None
+        _open_streams.discard(self)
+
+class _vcd_chunked_stream(_vcd_stream):
+    """
+    Streaming VCD output rotated into chunk files.
+    
+    A new chunk starts at a timestep boundary when the current one reaches
+    rotate_size bytes or spans rotate_time. Each chunk starts with the full
+    header and a $dumpvars snapshot of all values, so it can be loaded on 
+    its own. Chunks are named "<root>.NNNN<ext>" and listed with their time
+    ranges in "<root>.index.json" (see vcd_chunks)
+    """
+    def __init__(self, path, header, dumpvars, initial, rotate_size=None, 
+                 rotate_time=None, bufsize=1<<16):
+        root, ext = os.path.splitext(path)
+        self.chunk_format = root + ".%04d" + ext
+        self.indexpath = root + ".index.json"
+        self.header = header
+        self.dumpvars = dumpvars
+        # current values: ref -> formatted value
+        self.values = OrderedDict(initial)
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        self.chunk_start = 0
+        self.stamped = None
+        self.chunks = []
+        _vcd_stream.__init__(self, self.chunk_format % 0, header + dumpvars(self.values), bufsize)
+        self.chunks.append([os.path.basename(self.path), 0, None])
+        self.write_index()
+        
+    def change(self, curtime, value, ref):
+        if curtime != self.curtime:
+            self.write_pending()
+            if self.curtime is not None and self.rotate_due(curtime):
+                self.rotate(curtime)
+            self.curtime = curtime
+        self.pending.append(value + ref)
+        self.values[ref] = value
+        
+    def write_pending(self):
+        if len(self.pending) > 0:
+            if self.curtime == self.stamped:
+                # timestamp already written with the chunk snapshot
+                self.file.write("%s\n" % "\n".join(self.pending))
+            else:
+                self.file.write("#%d\n%s\n" % (self.curtime, "\n".join(self.pending)))
+            self.pending = []
+            
+    def rotate_due(self, curtime):
+        if self.rotate_time is not None and curtime - self.chunk_start >= self.rotate_time:
+            return True
+        if self.rotate_size is not None and self.file.tell() >= self.rotate_size:
+            return True
+        return False
+        
+    def rotate(self, curtime):
+        # close current chunk, next one starts at curtime with a snapshot 
+        # of the values before curtime
+        self.file.write("$vcdclose #%d $end\n" % curtime)
+        self.file.close()
+        self.chunks[-1][2] = curtime
+        self.path = self.chunk_format % len(self.chunks)
+        self.file = open(self.path, "w", self.bufsize)
+        self.file.write(self.header)
+        self.file.write("#%d\n" % curtime)
+        self.file.write(self.dumpvars(self.values))
+        self.chunk_start = self.stamped = curtime
+        self.chunks.append([os.path.basename(self.path), curtime, None])
+        self.write_index()
+        
+    def write_index(self):
+        index = {"version": 1, 
+                 "chunks": [{"file": f, "start": start, "end": end} for f, start, end in self.chunks]}
+        tmppath = self.indexpath + ".tmp"
+        with open(tmppath, "w") as indexfile:
+            json.dump(index, indexfile, indent=1)
+        os.rename(tmppath, self.indexpath)
+        
+    def close(self, endtime=None):
+        if self.file is None:
+            return
+        _vcd_stream.close(self, endtime)
+        self.chunks[-1][2] = endtime if endtime is not None else self.curtime
+        self.write_index()
+        
+def vcd_chunks(indexpath, start=None, stop=None):
+    """
+    Chunk files of a rotated VCD trace (see traceConfig rotate_size and 
+    rotate_time)
+    
+    Arguments:
+    * indexpath: index file "<root>.index.json"
+    * start, stop: time range [start, stop) of interest. None for no limit
+    
+    Returns: list of (chunk path, chunk start time, chunk end time) for the 
+    chunks that overlap the time range. End time is None for a chunk still 
+    being written.
+    """
+    with open(indexpath) as indexfile:
+        index = json.load(indexfile)
+    basedir = os.path.dirname(indexpath)
+    retval = []
+    for chunk in index["chunks"]:
+        if stop is not None and chunk["start"] >= stop:
+            continue
+        if start is not None and chunk["end"] is not None and chunk["end"] <= start:
+            continue
+        retval.append((os.path.join(basedir, chunk["file"]), chunk["start"], chunk["end"]))
+    return retval
+
+class _background_writer(object):
+    """
+    Runs trace encoding and output of a stream in a background thread.
+    
+    Value changes are collected as raw (time, sink id, value) records in 
+    batches; full batches go through a bounded queue to the writer thread, 
+    which calls the stream recording functions (sinks). When the queue is 
+    full the simulation waits for the writer (backpressure).
+    """
+    def __init__(self, stream, batchsize=4096, maxbatches=16):
+        self.stream = stream
+        self.batchsize = batchsize
+        self.sinks = []
+        self.batch = []
+        self.queue = Queue.Queue(maxbatches)
+        self.error = None
+        # closed through this writer, after pending records
+        _open_streams.discard(stream)
+        _open_streams.add(self)
+        self.thread = threading.Thread(target=self._run, name="signal_monitor writer")
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def recorder(self, sink, sigref):
+        """
+        Returns a function record(time, value) that queues value changes 
+        for sink(time, value)
+        
+        Arguments:
+        * sink: stream recording function, called in the writer thread
+        * sigref: signal, to choose how values are copied (intbv values 
+          are changed in place)
+        """
+        sinkid = len(self.sinks)
+        self.sinks.append(sink)
+        batch = self.batch
+        batchsize = self.batchsize
+        flush = self.flush
+        value = sigref._val
+        if isinstance(value, myhdl.intbv) and sigref._nrbits > 0:
+            def record(curtime, value):
+                batch.append((curtime, sinkid, int(value)))
+                if len(batch) >= batchsize:
+                    flush()
+        elif isinstance(value, myhdl.intbv):
+            def record(curtime, value):
+                batch.append((curtime, sinkid, copy(value)))
+                if len(batch) >= batchsize:
+                    flush()
+        else:
+            def record(curtime, value):
+                batch.append((curtime, sinkid, value))
+                if len(batch) >= batchsize:
+                    flush()
+        return record
+        
+    def flush(self):
+        self.check()
+        if len(self.batch) > 0:
+            self.queue.put(list(self.batch))
+            del self.batch[:]
+            
+    def check(self):
+        # re-raise an error from the writer thread
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+            
+    def _run(self):
+        sinks = self.sinks
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                if self.error is None:
+                    for curtime, sinkid, value in batch:
+                        sinks[sinkid](curtime, value)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+                
+    def sync(self):
+        # wait until the writer has processed all queued records
+        self.flush()
+        self.queue.join()
+        self.check()
+        
+    @property
+    def file(self):
+        self.sync()
+        return self.stream.file
+        
+    @property
+    def curtime(self):
+        self.sync()
+        return self.stream.curtime
+        
+    def close(self, endtime=None):
+        if not self.thread.is_alive():
+            return
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            _open_streams.discard(self)
+        self.check()
+        self.stream.close(endtime)
+
+# widest value stored directly in trace_store value array
+_store_int_bits = array("L").itemsize * 8
+
+# VCD identifier codes: printable ASCII '!' to '~'
+_vcd_id_chars = "".join(chr(c) for c in range(33, 127))
+
+def iter_vcd_identifiers():
+    """
+    Generate VCD identifier codes: the 94 one character codes, then the 
+    two character codes, and so on. Codes never repeat.
+    """
+    nchars = 1
+    while True:
+        for code in product(_vcd_id_chars, repeat=nchars):
+            yield "".join(code)
+        nchars += 1
+
+def vcd_identifiers(count):
+    """
+    Returns: list of the first count VCD identifier codes
+    """
+    return list(islice(iter_vcd_identifiers(), count))
+
+# ******
+# VCD value formatting. The formatting function is chosen once for each 
+# signal from its value type; vector values are formatted with a cache, 
+# recurring values (counters, state registers, data patterns) are only 
+# converted once.
+
+def _vcd_format_bit(value):
+    return "1" if value else "0"
+    
+def _vcd_format_real(value):
+    return "r%.16g " % value
+    
+def _vcd_vector_formatter(cachesize=4096):
+    """
+    Returns: formatting function for integer values, with a value cache
+    """
+    cache = {}
+    def format_vector(value):
+        value = int(value)
+        retval = cache.get(value)
+        if retval is None:
+            if value >= 0:
+                retval = "b%s " % format(value, "b")
+            else:
+                retval = "b%s " % myhdl.bin(value)
+            if len(cache) >= cachesize:
+                cache.clear()
+            cache[value] = retval
+        return retval
+    return format_vector
+    
+def _vcd_enum_formatter():
+    cache = {}
+    def format_enum(value):
+        retval = cache.get(value)
+        if retval is None:
+            retval = cache[value] = "s%s " % repr(value)
+        return retval
+    return format_enum
+    
+def _vcd_formatter(value, nbits, fallback):
+    """
+    VCD formatting function for the values of a signal
+    
+    Arguments:
+    * value: sample value (e.g. initial value)
+    * nbits: signal width
+    * fallback: formatting function for other types
+    """
+    if isinstance(value, bool) or (isinstance(value, myhdl.intbv) and nbits == 1):
+        return _vcd_format_bit
+    elif isinstance(value, (myhdl.intbv, int, long)):
+        return _vcd_vector_formatter()
+    elif isinstance(value, float):
+        return _vcd_format_real
+    elif isinstance(value, myhdl.EnumItemType):
+        return _vcd_enum_formatter()
+    else:
+        return fallback
+
+def _signal_kind(sigref):
+    """
+    Storage kind of a signal: returns (kind, nbits, signed)
+    """
+    value = sigref.val
+    nbits = sigref._nrbits
+    signed = False
+    if isinstance(value, (bool, myhdl.intbv)) and nbits > 0:
+        if isinstance(value, myhdl.intbv):
+            signed = value.min is not None and value.min < 0
+        kind = "int" if nbits <= _store_int_bits else "wide"
+    else:
+        kind = "obj"
+    return kind, nbits, signed
+
+# ******
+# SMT: binary, block-compressed trace format
+#
+# File layout:
+# * magic "SMTRACE\x01"
+# * header: uint32 length (little endian) + JSON object with keys
+#   "version", "date", "timescale", "basename", "signals" (list of 
+#   {"name", "kind", "nbits", "signed", "ref"}; signal id is the list 
+#   index; "ref" is the VCD identifier code) and "scopes" (list of 
+#   [scope path, [[var name, signal id], ...]]; scope path is a list of 
+#   scope names, [] is the top scope. A signal id can appear in several 
+#   scopes)
+# * blocks: uint32 compressed length + uint32 raw length + zlib data. Each
+#   block decodes independently to a sequence of records:
+#   varint time delta (the first record in a block holds absolute time), 
+#   varint signal id, value. Values are encoded by signal kind:
+#   - "int", "wide": varint of the value (two's complement for signed)
+#   - "obj": one tag byte and its data: 0 int (zigzag varint), 1 float 
+#     (little endian double), 2 text (varint length + bytes)
+#   The first records (one per signal, in id order) are the initial values.
+# * trailer: uint32 0 + uint64 end time
+_smt_magic = "SMTRACE\x01"
+_smt_version = 1
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+    
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+    
+class _smt_stream(object):
+    """
+    SMT output: records are encoded in a block buffer, compressed and 
+    written when the block is full.
+    """
+    def __init__(self, path, meta, blocksize=1<<16, level=6):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(_smt_magic)
+        header = json.dumps(meta)
+        self.file.write(struct.pack("<I", len(header)) + header)
+        self.blocksize = blocksize
+        self.level = level
+        self.block = bytearray()
+        self.curtime = None
+        self.lasttime = 0
+        self.signals = meta["signals"]
+        _open_streams.add(self)
+        
+    def recorder(self, sigid):
+        """
+        Returns a function record(time, value) for a signal.
+        """
+        sigmeta = self.signals[sigid]
+        kind = sigmeta["kind"]
+        mask = (1 << sigmeta["nbits"]) - 1
+        idcode = _varint(sigid)
+        def record(curtime, value):
+            block = self.block
+            block += _varint(curtime - self.lasttime)
+            block += idcode
+            if kind == "obj":
+                block += _smt_encode_obj(value)
+            else:
+                block += _varint(int(value) & mask)
+            self.lasttime = self.curtime = curtime
+            if len(block) >= self.blocksize:
+                self.write_block()
+        return record
+        
+    def write_block(self):
+        if len(self.block) > 0:
+            data = zlib.compress(str(self.block), self.level)
+            self.file.write(struct.pack("<II", len(data), len(self.block)))
+            self.file.write(data)
+            self.block = bytearray()
+            # next block starts with absolute time
+            self.lasttime = 0
+            
+    def close(self, endtime=None):
+        if self.file is None:
+            return
+        self.write_block()
+        if endtime is None:
+            endtime = self.curtime or 0
+        self.file.write(struct.pack("<IQ", 0, endtime))
+        self.file.close()
+        self.file = None
+        _open_streams.discard(self)
+        
+def _smt_encode_obj(value):
+    if isinstance(value, (int, long, myhdl.intbv)) and not isinstance(value, bool):
+        # zigzag encoding for signed values (also unbounded intbv)
+        value = int(value)
+        return "\x00" + _varint((value << 1) if value >= 0 else ((-value << 1) - 1))
+    elif isinstance(value, float):
+        return "\x01" + struct.pack("<d", value)
+    else:
+        text = value if isinstance(value, str) else repr(value)
+        return "\x02" + _varint(len(text)) + text
+        
+class smt_reader(object):
+    """
+    Reader for SMT trace files
+    
+    Attributes:
+    * meta: header dict (see format description)
+    * endtime: simulation time at trace close
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(_smt_magic)) != _smt_magic:
+                raise ValueError("'%s' is not a SMT trace file." % path)
+            hlen, = struct.unpack("<I", f.read(4))
+            self.meta = json.loads(f.read(hlen))
+            self._data_pos = f.tell()
+        if self.meta["version"] != _smt_version:
+            raise ValueError("Unsupported SMT version %s." % repr(self.meta["version"]))
+        self.endtime = None
+            
+    def iter_blocks(self):
+        """
+        Iterate over decompressed blocks
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self._data_pos)
+            while True:
+                clen, = struct.unpack("<I", f.read(4))
+                if clen == 0:
+                    self.endtime, = struct.unpack("<Q", f.read(8))
+                    return
+                rlen, = struct.unpack("<I", f.read(4))
+                data = zlib.decompress(f.read(clen))
+                if len(data) != rlen:
+                    raise ValueError("Corrupted block in '%s'." % self.path)
+                yield bytearray(data)
+                
+    def iter_changes(self):
+        """
+        Iterate over all records as (time, signal id, value). Values of 
+        "int" and "wide" signals are returned as unsigned integers.
+        """
+        signals = self.meta["signals"]
+        kinds = [sigmeta["kind"] for sigmeta in signals]
+        for data in self.iter_blocks():
+            pos = 0
+            curtime = 0
+            end = len(data)
+            while pos < end:
+                delta, pos = _read_varint(data, pos)
+                curtime += delta
+                sigid, pos = _read_varint(data, pos)
+                if kinds[sigid] != "obj":
+                    value, pos = _read_varint(data, pos)
+                else:
+                    tag = data[pos]
+                    pos += 1
+                    if tag == 0:
+                        z, pos = _read_varint(data, pos)
+                        value = (z >> 1) if not (z & 1) else -((z + 1) >> 1)
+                    elif tag == 1:
+                        value, = struct.unpack("<d", str(data[pos:pos + 8]))
+                        pos += 8
+                    else:
+                        tlen, pos = _read_varint(data, pos)
+                        value = str(data[pos:pos + tlen])
+                        pos += tlen
+                yield curtime, sigid, value
+                
+def smt_to_vcd(path, vcdpath):
+    """
+    Convert a SMT trace file to VCD
+    """
+    reader = smt_reader(path)
+    meta = reader.meta
+    signals = meta["signals"]
+    vcdgen = signal_monitor()
+    
+    def format_obj(value):
+        if isinstance(value, str):
+            return "s%s " % value
+        return vcdgen._vcd_printval(value)
+    def format_signed(nbits, format_vector):
+        def format_value(value):
+            if value >> (nbits - 1):
+                value -= 1 << nbits
+            return format_vector(value)
+        return format_value
+    formats = []
+    for sigmeta in signals:
+        nbits = sigmeta["nbits"]
+        if sigmeta["kind"] == "obj":
+            formats.append(format_obj)
+        elif nbits == 1:
+            formats.append(_vcd_format_bit)
+        elif sigmeta["signed"]:
+            formats.append(format_signed(nbits, _vcd_vector_formatter()))
+        else:
+            formats.append(_vcd_vector_formatter())
+    def printval(sigid, value):
+        return formats[sigid](value)
+        
+    with open(vcdpath, "w") as vcdfile:
+        vcdfile.write(vcdgen._vcd_section("date", meta["date"], True, True))
+        vcdfile.write(vcdgen._vcd_section("version", "NoCmodel 0.1 (TEMP)", True, True))
+        vcdfile.write(vcdgen._vcd_section("timescale", meta["timescale"], True, True))
+        vcdfile.write("\n")
+        vcdfile.write(vcdgen._vcd_section("scope", "module %s" % meta["basename"]))
+        def var_decl(varname, sigid):
+            sigmeta = signals[sigid]
+            return vcdgen._vcd_var_decl(varname, sigmeta["nbits"], sigmeta["ref"])
+        vcdfile.write(vcdgen._vcd_scope_decls(meta["scopes"], var_decl))
+        vcdfile.write(vcdgen._vcd_section("upscope", ""))
+        vcdfile.write(vcdgen._vcd_section("enddefinitions", ""))
+        
+        changes = reader.iter_changes()
+        ival = {}
+        for i in range(len(signals)):
+            curtime, sigid, value = changes.next()
+            ival[sigid] = "%s%s" % (printval(sigid, value), signals[sigid]["ref"])
+        # same order as declarations
+        ival = [ival[sigid] for sigid in OrderedDict.fromkeys(
+            sigid for path, scopevars in meta["scopes"] for varname, sigid in scopevars)]
+        vcdfile.write(vcdgen._vcd_section("dumpvars", "\n".join(ival), True))
+        lasttime = None
+        for curtime, sigid, value in changes:
+            if curtime != lasttime:
+                vcdfile.write("#%d\n" % curtime)
+                lasttime = curtime
+            vcdfile.write("%s%s\n" % (printval(sigid, value), signals[sigid]["ref"]))
+        vcdfile.write(vcdgen._vcd_section("vcdclose", "#%d" % reader.endtime))
+        
+class trace_store(object):
+    """
+    Compact in-memory trace: value changes stored in typed arrays.
+    
+    Each change takes one entry in three parallel arrays: time, signal id 
+    and value (about 20 bytes per change). Values are packed according to 
+    the signal kind, resolved once when the signal is added:
+    * "int": bool and intbv that fit in an unsigned long (64 bits on most 
+      platforms), stored in the value array (signed values in two's 
+      complement)
+    * "wide": wider intbv, packed in a bytearray. The value
+      array holds its offset
+    * "obj": any other value (int, float, enum, ...), kept in a list. The 
+      value array holds its index
+      
+    Queries returning NumPy arrays (arrays, values_at, edges, toggle_count,
+    duty_cycle) require numpy. Time ranges are [start, stop).
+    """
+    def __init__(self):
+        self.times = array("L")
+        self.ids = array("I")
+        self.values = array("L")
+        self.wide = bytearray()
+        self.objects = []
+        # per signal: (name, kind, nbits, signed)
+        self.signals = []
+        self.ids_by_name = {}
+        # first entry after initial values
+        self.start_pos = 0
+        self._index = []
+        self._indexed_len = 0
+        # trace end time, if known
+        self.endtime = None
+        # numpy copies of times and values columns
+        self._columns = None
+        
+    def __len__(self):
+        return len(self.times)
+        
+    def add_signal(self, name, sigref):
+        """
+        Register a signal. Returns its id.
+        """
+        return self.add_signal_kind(name, *_signal_kind(sigref))
+        
+    def add_signal_kind(self, name, kind, nbits, signed):
+        """
+        Register a signal with explicit storage kind. Returns its id.
+        """
+        sigid = len(self.signals)
+        self.signals.append((name, kind, nbits, signed))
+        self.ids_by_name[name] = sigid
+        self._index.append(array("L"))
+        return sigid
+        
+    def start(self, curtime, signal_objects):
+        """
+        Record initial values of all signals
+        """
+        for name, sigref in signal_objects.iteritems():
+            self.recorder(self.ids_by_name[name])(curtime, sigref.val)
+        self.start_pos = len(self.times)
+        
+    def recorder(self, sigid):
+        """
+        Returns a function record(time, value) for a signal.
+        """
+        name, kind, nbits, signed = self.signals[sigid]
+        times, ids, values = self.times, self.ids, self.values
+        if kind == "int":
+            mask = (1 << nbits) - 1
+            def record(curtime, value):
+                times.append(curtime)
+                ids.append(sigid)
+                values.append(int(value) & mask)
+        elif kind == "wide":
+            nbytes = (nbits + 7) // 8
+            mask = (1 << nbits) - 1
+            wide = self.wide
+            def record(curtime, value):
+                times.append(curtime)
+                ids.append(sigid)
+                values.append(len(wide))
+                wide.extend(("%0*x" % (nbytes * 2, int(value) & mask)).decode("hex"))
+        else:
+            objects = self.objects
+            intbv = myhdl.intbv
+            def record(curtime, value):
+                times.append(curtime)
+                ids.append(sigid)
+                values.append(len(objects))
+                # unbounded intbv values are changed in place
+                if isinstance(value, intbv):
+                    value = copy(value)
+                objects.append(value)
+        return record
+        
+    def value(self, pos):
+        """
+        Value of entry at position pos
+        """
+        name, kind, nbits, signed = self.signals[self.ids[pos]]
+        raw = self.values[pos]
+        if kind == "int":
+            if nbits == 1 and not signed:
+                return bool(raw)
+            if signed and raw >> (nbits - 1):
+                return raw - (1 << nbits)
+            return int(raw)
+        elif kind == "wide":
+            nbytes = (nbits + 7) // 8
+            v = int(str(self.wide[raw:raw + nbytes]).encode("hex"), 16)
+            if signed and v >> (nbits - 1):
+                return v - (1 << nbits)
+            return v
+        else:
+            return self.objects[raw]
+            
+    def iter_changes(self, start=None):
+        """
+        Iterate over recorded changes as (time, signal id, value)
+        """
+        if start is None:
+            start = self.start_pos
+        times, ids = self.times, self.ids
+        for pos in xrange(start, len(times)):
+            yield times[pos], ids[pos], self.value(pos)
+            
+    def positions(self, name):
+        """
+        Array with entry positions for a signal
+        """
+        self._update_index()
+        return self._index[self.ids_by_name[name]]
+        
+    def value_at(self, name, curtime):
+        """
+        Value of a signal at time curtime (last change at or before 
+        curtime). Returns None before the first record.
+        """
+        pos = self.positions(name)
+        times = self.times
+        # binary search on the signal's entries
+        lo, hi = 0, len(pos)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[pos[mid]] <= curtime:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        return self.value(pos[lo - 1])
+        
+    def changes(self, name):
+        """
+        List of (time, value) for a signal
+        """
+        return [(self.times[p], self.value(p)) for p in self.positions(name)]
+        
+    def arrays(self, name, start=None, stop=None, initial=True):
+        """
+        Changes of a signal as NumPy arrays (times, values)
+        
+        Arguments:
+        * name: signal name
+        * start, stop: time range [start, stop). None for no limit
+        * initial: if start is given, begin with the value the signal has at
+          start (time start), so the arrays describe the whole range
+          
+        Values are integers (bool for 1 bit signals) for "int" signals, 
+        object arrays for other kinds.
+        """
+        times_col, values_col = self._numpy_columns()
+        pos = _numpy_from_array(self.positions(name)).astype(numpy.intp)
+        times = times_col[pos]
+        lo, hi = 0, len(pos)
+        if stop is not None:
+            hi = int(numpy.searchsorted(times, stop, "left"))
+        if start is not None:
+            lo = int(numpy.searchsorted(times, start, "left"))
+            if initial and lo > 0 and (lo == len(times) or times[lo] != start):
+                # value before start
+                lo -= 1
+                times = times.copy()
+                times[lo] = start
+        if lo >= hi:
+            lo = hi
+        times = times[lo:hi]
+        pos = pos[lo:hi]
+        name, kind, nbits, signed = self.signals[self.ids_by_name[name]]
+        if kind == "int":
+            raw = values_col[pos]
+            if nbits == 1 and not signed:
+                values = raw.astype(bool)
+            elif signed and nbits < 64:
+                values = raw.astype(numpy.int64)
+                values[values >= (1 << (nbits - 1))] -= (1 << nbits)
+            elif signed:
+                values = raw.view(numpy.int64)
+            else:
+                values = raw.astype(numpy.uint64)
+        else:
+            values = numpy.empty(len(pos), dtype=object)
+            values[:] = [self.value(p) for p in pos]
+        return times, values
+        
+    def values_at(self, name, times):
+        """
+        Values of a signal at each time in times (NumPy array). Times before 
+        the first record get the first recorded value.
+        """
+        sigtimes, values = self.arrays(name)
+        if len(sigtimes) == 0:
+            raise ValueError("No records for signal '%s'." % name)
+        idx = numpy.searchsorted(sigtimes, numpy.asarray(times), "right") - 1
+        return values[numpy.maximum(idx, 0)]
+        
+    def edges(self, name, start=None, stop=None, edge="both"):
+        """
+        Times of edges of a signal in range [start, stop) as a NumPy array. 
+        An edge is a change between zero and non-zero values.
+        
+        Arguments:
+        * edge: "posedge", "negedge" or "both"
+        """
+        if edge not in ("posedge", "negedge", "both"):
+            raise ValueError("Unknown edge '%s'." % edge)
+        if self.signals[self.ids_by_name[name]][1] != "int":
+            raise ValueError("Signal '%s' is not an integer signal." % name)
+        times, values = self.arrays(name, start, stop)
+        level = values != 0
+        rising = ~level[:-1] & level[1:]
+        falling = level[:-1] & ~level[1:]
+        if edge == "posedge":
+            mask = rising
+        elif edge == "negedge":
+            mask = falling
+        else:
+            mask = rising | falling
+        return times[1:][mask]
+        
+    def toggle_count(self, name, start=None, stop=None):
+        """
+        Number of value changes of a signal in range [start, stop)
+        """
+        times, values = self.arrays(name, start, stop)
+        return int(numpy.count_nonzero(values[1:] != values[:-1]))
+        
+    def duty_cycle(self, name, start=None, stop=None):
+        """
+        Fraction of time range [start, stop) the signal has a non-zero value.
+        Default range is from the first record to the trace end time.
+        """
+        times, values = self.arrays(name, start, stop)
+        if len(times) == 0:
+            raise ValueError("No records for signal '%s' in range." % name)
+        if start is None:
+            start = int(times[0])
+        if stop is None:
+            stop = self.endtime if self.endtime is not None else int(self.times[-1])
+        if stop <= start:
+            raise ValueError("Empty time range [%s, %s)." % (start, stop))
+        durations = numpy.diff(numpy.append(times.astype(numpy.int64), stop))
+        return float(durations[values != 0].sum()) / (stop - start)
+        
+    def _numpy_columns(self):
+        # numpy copies of times and values, updated when the trace grows
+        if numpy is None:
+            raise ImportError("numpy is required for trace_store queries.")
+        if self._columns is None or self._columns[0] != len(self.times):
+            self._columns = (len(self.times), _numpy_from_array(self.times), 
+                             _numpy_from_array(self.values))
+        return self._columns[1:]
+        
+    def _update_index(self):
+        ids = self.ids
+        index = self._index
+        for pos in xrange(self._indexed_len, len(ids)):
+            index[ids[pos]].append(pos)
+        self._indexed_len = len(ids)
+        
+class activity_stats(object):
+    """
+    Switching activity statistics, without waveform.
+    
+    Kept in compact arrays indexed by signal id, updated on each value 
+    change:
+    * toggles: number of value changes
+    * first, last: time of first and last change (-1: no change)
+    * active: number of cycles with at least one change
+    
+    For bool and intbv signals, per bit toggle counts are kept as bit-sliced
+    counters: plane k holds bit k of the toggle count of every signal bit, 
+    so a change updates all bits at once with a few integer operations. 
+    Rise (0->1) and fall (1->0) counts follow from the toggle count and the 
+    initial bit value, as transitions of a bit alternate.
+      
+    A cycle is a rising edge of the clock signal, or a simulation timestep
+    with any change if there is no clock.
+    """
+    def __init__(self, clock=None):
+        self.clock = clock
+        # per signal: (name, kind, nbits, signed)
+        self.signals = []
+        self.ids_by_name = {}
+        self.toggles = array("L")
+        self.first = array("l")
+        self.last = array("l")
+        self.active = array("L")
+        self.endtime = None
+        # [cycle count, current cycle time (no clock)]
+        self._cycle = [0, None]
+        # initial and last value, bit toggle counter planes, last active cycle
+        self._initial = []
+        self._values = []
+        self._planes = []
+        self._lastcycle = array("l")
+        
+    @property
+    def cycles(self):
+        return self._cycle[0]
+        
+    def add_signal(self, name, sigref):
+        """
+        Register a signal. Returns its id.
+        """
+        kind, nbits, signed = _signal_kind(sigref)
+        sigid = len(self.signals)
+        self.signals.append((name, kind, nbits, signed))
+        self.ids_by_name[name] = sigid
+        for column in (self.toggles, self.active):
+            column.append(0)
+        for column in (self.first, self.last, self._lastcycle):
+            column.append(-1)
+        if kind != "obj":
+            value = int(sigref.val) & ((1 << nbits) - 1)
+        else:
+            value = copy(sigref.val)
+        self._initial.append(value)
+        self._values.append(value)
+        self._planes.append([])
+        return sigid
+        
+    def recorder(self, sigid):
+        """
+        Returns a function record(time, value) for a signal.
+        """
+        name, kind, nbits, signed = self.signals[sigid]
+        toggles, first, last, active = self.toggles, self.first, self.last, self.active
+        lastcycle = self._lastcycle
+        values = self._values
+        planes = self._planes[sigid]
+        cycle = self._cycle
+        clocked = self.clock is not None
+        is_clock = name == self.clock
+        if kind != "obj":
+            mask = (1 << nbits) - 1
+            def record(curtime, value):
+                value = int(value) & mask
+                carry = values[sigid] ^ value
+                if carry == 0:
+                    return
+                values[sigid] = value
+                if is_clock:
+                    if value:
+                        cycle[0] += 1
+                elif not clocked and curtime != cycle[1]:
+                    cycle[1] = curtime
+                    cycle[0] += 1
+                toggles[sigid] += 1
+                if first[sigid] < 0:
+                    first[sigid] = curtime
+                last[sigid] = curtime
+                if lastcycle[sigid] != cycle[0]:
+                    lastcycle[sigid] = cycle[0]
+                    active[sigid] += 1
+                # add 1 to the toggle counter of each changed bit
+                k = 0
+                while carry:
+                    if k == len(planes):
+                        planes.append(carry)
+                        break
+                    plane = planes[k]
+                    planes[k] = plane ^ carry
+                    carry &= plane
+                    k += 1
+        else:
+            def record(curtime, value):
+                if value == values[sigid]:
+                    return
+                values[sigid] = copy(value)
+                if not clocked and curtime != cycle[1]:
+                    cycle[1] = curtime
+                    cycle[0] += 1
+                toggles[sigid] += 1
+                if first[sigid] < 0:
+                    first[sigid] = curtime
+                last[sigid] = curtime
+                if lastcycle[sigid] != cycle[0]:
+                    lastcycle[sigid] = cycle[0]
+                    active[sigid] += 1
+        return record
+        
+    def bit_toggles(self, name):
+        """
+        Returns: (rises, falls) lists of per bit transition counts, bit 0 
+        first
+        """
+        sigid = self.ids_by_name[name]
+        nbits = self.signals[sigid][2]
+        if self.signals[sigid][1] == "obj":
+            raise ValueError("Signal '%s' has no bits." % name)
+        initial = self._initial[sigid]
+        planes = self._planes[sigid]
+        rises = []
+        falls = []
+        for bit in xrange(nbits):
+            count = 0
+            for k, plane in enumerate(planes):
+                count |= ((plane >> bit) & 1) << k
+            if (initial >> bit) & 1:
+                rises.append(count // 2)
+                falls.append(count - count // 2)
+            else:
+                rises.append(count - count // 2)
+                falls.append(count // 2)
+        return rises, falls
+        
+    def report(self):
+        """
+        Returns: dict signal name -> statistics dict, with keys "toggles", 
+        "first_change", "last_change", "active_cycles", "active_ratio" and,
+        for bool and intbv signals, "rises", "falls" (per bit lists, bit 0 
+        first) and "bit_coverage" (fraction of bits with both transitions)
+        """
+        cycles = self.cycles
+        retval = OrderedDict()
+        for sigid, (name, kind, nbits, signed) in enumerate(self.signals):
+            sigstats = OrderedDict()
+            sigstats["toggles"] = self.toggles[sigid]
+            sigstats["first_change"] = self.first[sigid] if self.first[sigid] >= 0 else None
+            sigstats["last_change"] = self.last[sigid] if self.last[sigid] >= 0 else None
+            sigstats["active_cycles"] = self.active[sigid]
+            sigstats["active_ratio"] = float(self.active[sigid]) / cycles if cycles > 0 else 0.0
+            if kind != "obj":
+                rises, falls = self.bit_toggles(name)
+                covered = sum(1 for r, f in zip(rises, falls) if r > 0 and f > 0)
+                sigstats["rises"] = rises
+                sigstats["falls"] = falls
+                sigstats["bit_coverage"] = float(covered) / nbits
+            retval[name] = sigstats
+        return retval
+        
+    def write(self, path):
+        """
+        Write statistics report to a JSON file
+        """
+        with open(path, "w") as statsfile:
+            json.dump({"cycles": self.cycles, "endtime": self.endtime, "clock": self.clock,
+                "signals": self.report()}, statsfile, indent=1)
+        
+def _numpy_from_array(arr):
+    # copy of an array.array as a NumPy array
+    if len(arr) == 0:
+        return numpy.zeros(0, dtype=arr.typecode)
+    return numpy.frombuffer(buffer(arr), dtype=arr.typecode).copy()
+    
+def smt_to_store(path):
+    """
+    Load a SMT trace file in a trace_store, for queries
+    """
+    reader = smt_reader(path)
+    store = trace_store()
+    for sigmeta in reader.meta["signals"]:
+        store.add_signal_kind(sigmeta["name"], sigmeta["kind"], sigmeta["nbits"], sigmeta["signed"])
+    recorders = [store.recorder(sigid) for sigid in xrange(len(store.signals))]
+    for curtime, sigid, value in reader.iter_changes():
+        recorders[sigid](curtime, value)
+    # first records are initial values
+    store.start_pos = min(len(store.signals), len(store))
+    store.endtime = reader.endtime
+    return store
+
+def extract_hierarchy(dut, *args, **kwargs):
+    """
+    Elaborate a design and extract its hierarchy, the same way 
+    myhdl.traceSignals() does.
+    
+    Returns: (top instance, hierarchy), for use in
+    signal_monitor.add_trace_hierarchy()
+    """
+    name = kwargs.pop("name", None)
+    if name is None:
+        name = dut.func_name
+    h = _HierExtr(name, dut, *args, **kwargs)
+    return h.top, h.hierarchy
+
+def _value_snapshot(sigref):
+    """
+    Returns a function to keep a value of a signal: intbv values are 
+    changed in place by MyHDL
+    """
+    if isinstance(sigref._val, myhdl.intbv):
+        if sigref._nrbits > 0:
+            return int
+        return copy
+    return lambda value: value
+
+class _capture_dispatch(object):
+    """
+    Signal._printVcd hook shared by all the monitors that capture a 
+    signal. Calls the hook it replaced if the signal was already traced 
+    (e.g. by traceSignals), then each attached capture. The replaced hook
+    is restored when the last capture is detached, in any order.
+    """
+    def __init__(self, sigref):
+        self.sigref = sigref
+        self.prev_tracing = sigref._tracing
+        self.prev_hook = sigref._printVcd
+        self.captures = []
+        
+    def __call__(self):
+        if self.prev_tracing:
+            self.prev_hook()
+        for capture in self.captures:
+            capture()
+            
+    @classmethod
+    def attach(cls, sigref, capture):
+        """
+        Call capture() on each value change of sigref. Returns the 
+        dispatcher of the signal
+        """
+        dispatch = sigref._printVcd
+        if not isinstance(dispatch, cls):
+            dispatch = cls(sigref)
+            sigref._printVcd = dispatch
+            sigref._tracing = 1
+        dispatch.captures.append(capture)
+        return dispatch
+        
+    def detach(self, capture):
+        """
+        Remove a capture function added with attach
+        """
+        # new list: a running __call__ keeps its own
+        self.captures = [c for c in self.captures if c is not capture]
+        if len(self.captures) == 0 and self.sigref._printVcd is self:
+            self.sigref._printVcd = self.prev_hook
+            self.sigref._tracing = self.prev_tracing
+
+class _delta_filter(object):
+    """
+    Collapses the value changes of a signal within a timestep (delta 
+    cycles) to its final value, and drops it if it is the last recorded 
+    value (e.g. a glitch that returns to the previous value).
+    
+    Changes of the current timestep are pending until time advances or 
+    flush() is called.
+    """
+    def __init__(self):
+        self.curtime = None
+        self.records = []
+        self.last = []
+        # signal index -> final value, in order of first change
+        self.pending = {}
+        self.order = []
+        
+    def wrap(self, record, sigref):
+        """
+        Returns a record(time, value) function that filters changes for 
+        record
+        """
+        index = len(self.records)
+        self.records.append(record)
+        snapshot = _value_snapshot(sigref)
+        self.last.append(snapshot(sigref._val))
+        pending = self.pending
+        order = self.order
+        def filtered(curtime, value):
+            if curtime != self.curtime:
+                self.flush()
+                self.curtime = curtime
+            if index not in pending:
+                order.append(index)
+            pending[index] = snapshot(value)
+        return filtered
+        
+    def flush(self):
+        """
+        Record pending changes
+        """
+        pending = self.pending
+        last = self.last
+        records = self.records
+        for index in self.order:
+            value = pending[index]
+            if value != last[index]:
+                last[index] = value
+                records[index](self.curtime, value)
+        pending.clear()
+        del self.order[:]
+
+class _capture_filter(object):
+    """
+    Capture windows and trigger for traced value changes.
+    
+    Record functions of all signals are wrapped. Changes outside capture
+    windows, or before the trigger, are not recorded; the last pretrigger
+    changes before the trigger (in the same window) are kept in a ring 
+    buffer and recorded when it fires, after a snapshot of all values at 
+    the oldest buffered time. Each time recording starts (window start or 
+    trigger), the current values of all signals are recorded to give a 
+    complete snapshot.
+    
+    Current values are the ones passed to the wrapped functions, not the 
+    live signal values: behind a _delta_filter, changes of a timestep arrive
+    when time has already advanced. A snapshot is stamped at the window 
+    start or trigger time. If changes happen at that time, it is recorded at
+    the end of the timestep (next change at a later time, or flush()). 
+    Snapshots only record signals with a value different from the last one
+    recorded.
+    """
+    def __init__(self, windows=None, trigger=None, pretrigger=0, posttrigger=None):
+        if windows is not None:
+            windows = sorted(windows)
+            for start, stop in windows:
+                if stop <= start:
+                    raise ValueError("Invalid capture window (%s, %s)." % (start, stop))
+        self.windows = windows
+        if trigger is not None:
+            if not isinstance(trigger, (list, tuple)) or len(trigger) != 2:
+                raise ValueError("Trigger must be a (signal name, condition) tuple.")
+        self.trigger = trigger
+        self.pretrigger = pretrigger
+        self.posttrigger = posttrigger
+        self.reset()
+        
+    def reset(self):
+        self.records = []
+        # per signal: value copy function, last value seen and last value
+        # recorded
+        self.snapshots = []
+        self.values = []
+        self.written = []
+        # time of a pending snapshot
+        self.pending = None
+        self.window_idx = 0
+        self.triggered = self.trigger is None
+        self.trigger_time = None
+        self.buffer = deque(maxlen=self.pretrigger) if self.pretrigger > 0 else None
+        self.recording = False
+        
+    def wrap(self, record, sigref, signame):
+        index = len(self.records)
+        snapshot = _value_snapshot(sigref)
+        self.records.append(record)
+        self.snapshots.append(snapshot)
+        # initial values are already in the trace
+        self.values.append(snapshot(sigref._val))
+        self.written.append(self.values[-1])
+        if self.trigger is not None and signame == self.trigger[0]:
+            condition = self.trigger[1]
+            last = [copy(sigref._val)]
+            def trigger_record(curtime, value):
+                if not self.triggered and self.in_window(curtime):
+                    prev = last[0]
+                    if condition == "posedge":
+                        fire = not prev and value
+                    elif condition == "negedge":
+                        fire = prev and not value
+                    elif condition == "change":
+                        fire = True
+                    else:
+                        fire = (value == condition)
+                    if fire:
+                        self.fire(curtime)
+                last[0] = copy(value)
+                self.filter(index, curtime, value)
+            return trigger_record
+        def filtered_record(curtime, value):
+            self.filter(index, curtime, value)
+        return filtered_record
+        
+    def in_window(self, curtime):
+        if self.windows is None:
+            return True
+        windows = self.windows
+        while self.window_idx < len(windows) and curtime >= windows[self.window_idx][1]:
+            self.window_idx += 1
+        return self.window_idx < len(windows) and curtime >= windows[self.window_idx][0]
+        
+    def filter(self, index, curtime, value):
+        if self.pending is not None and curtime != self.pending:
+            self.flush()
+        # value objects like intbv change in place
+        value = self.snapshots[index](value)
+        prev = self.values[index]
+        self.values[index] = value
+        if not self.in_window(curtime):
+            self.recording = False
+            if self.buffer is not None:
+                self.buffer.clear()
+            return
+        if not self.triggered:
+            if self.buffer is not None:
+                self.buffer.append((index, curtime, value, prev))
+            return
+        if self.posttrigger is not None and curtime >= self.trigger_time + self.posttrigger:
+            self.recording = False
+            return
+        if not self.recording:
+            self.recording = True
+            start = curtime
+            if self.windows is not None and curtime != self.trigger_time:
+                start = self.windows[self.window_idx][0]
+            if start < curtime:
+                # no change since the window start: values before this one
+                values = list(self.values)
+                values[index] = prev
+                self.snapshot(start, values)
+            else:
+                self.pending = curtime
+        self.record(index, curtime, value)
+        
+    def record(self, index, curtime, value):
+        # record a change, unless the trace already has that value
+        if value != self.written[index]:
+            self.written[index] = value
+            self.records[index](curtime, value)
+        
+    def fire(self, curtime):
+        self.triggered = True
+        self.trigger_time = curtime
+        if self.buffer:
+            # values at the end of the oldest buffered timestep: undo the 
+            # later changes
+            oldest = self.buffer[0][1]
+            values = list(self.values)
+            for index, buftime, value, prev in reversed(self.buffer):
+                if buftime > oldest:
+                    values[index] = prev
+            self.snapshot(oldest, values)
+            for index, buftime, value, prev in self.buffer:
+                if buftime > oldest:
+                    self.record(index, buftime, value)
+            self.buffer.clear()
+        
+    def snapshot(self, curtime, values):
+        for index, value in enumerate(values):
+            self.record(index, curtime, value)
+        
+    def flush(self):
+        """
+        Record a pending snapshot
+        """
+        if self.pending is None:
+            return
+        curtime, self.pending = self.pending, None
+        self.snapshot(curtime, self.values)
+        
 class signal_monitor():
     def __init__(self):
         self.signal_objects = OrderedDict()
@@ -65,8 +1510,27 @@ class signal_monitor():
         self.vcdpath = ""
         self.scope_top = []
         self.scope_tree = {}
+        # hierarchical scopes: list of (scope path, [(var name, signal name), ...])
+        self.scope_hier = []
         self.traceinfo = {}
         self.sim_max_time = 0
+        self.streaming = False
+        self.rotate_size = None
+        self.rotate_time = None
+        self.background = False
+        self.queue_size = 16
+        self.stats = None
+        self.stats_clock = None
+        self.timescale = "1ns"
+        self._stream = None
+        self._capture_hooks = []
+        self.capture_filter = None
+        self._delta_filter = None
+        self.keep_deltas = False
+        # capture sessions (see start_session)
+        self.session_count = 0
+        self._session_output = None
+        self._header_key = None
         
     def add_trace_signal(self, signal, name="", scopename=""):
         if isinstance(signal, myhdl.SignalType):
@@ -143,75 +1607,458 @@ class signal_monitor():
                     self.scope_tree[scopename] = listnames
         self.trace_objects.append(signal)
         
-    def build_trace_generator(self):
-        # need to build a mirror signal list, in order to trace the signals correctly
-        # TODO: is really necessary a mirror signal? assert this.
+    def add_trace_hierarchy(self, hierarchy, patterns=None, maxdepth=None, memories=False):
+        """
+        Add signals from an extracted MyHDL design hierarchy.
         
-        mirror_signals = {}
-        for key, signalref in self.signal_objects.iteritems():
-            mirror_signals[key] = myhdl.Signal(signalref.val)
-            
-        def mirror_proc_gen(base, mirror):
-            @myhdl.always_comb
-            def mirror_proc():
-                mirror.next = base
-                
-            return mirror_proc
-            
-        procs = []
-        for key, sig in mirror_signals.iteritems():
-            procs.append(mirror_proc_gen(self.signal_objects[key], sig))
-                
-        return procs
+        Arguments:
+        * hierarchy: list of instances from _HierExtr (see extract_hierarchy)
+        * patterns: glob patterns (strings) or compiled regular expressions
+          matched against the hierarchical signal path ("top.inst.signal").
+          None to add all signals
+        * maxdepth: deepest instance level to trace (1: only top level). 
+          None for unlimited depth
+        * memories: also add signals from lists of signals, named 
+          "<name>(<index>)"
+          
+        VCD scopes follow the instance tree. A signal seen in several 
+        instances (e.g. a port) is traced once, and declared in each scope
+        with the same VCD reference. Its trace name is the path where it was
+        found first.
+        
+        Returns: number of traced signals added.
+        """
+        globs = []
+        regexes = []
+        if patterns is not None:
+            for pat in patterns:
+                if isinstance(pat, basestring):
+                    globs.append(fnmatch.translate(pat))
+                else:
+                    regexes.append(pat)
+            if len(globs) > 0:
+                # all globs in a single regular expression
+                regexes.append(re.compile("|".join("(?:%s)" % g for g in globs)))
+        
+        traced = self._traced_ids()
+        added = 0
+        pathstack = []
+        for inst in hierarchy:
+            level = inst.level
+            del pathstack[level - 1:]
+            pathstack.append(inst.name)
+            if maxdepth is not None and level > maxdepth:
+                continue
+            prefix = ".".join(pathstack) + "."
+            items = sorted(inst.sigdict.iteritems())
+            if memories:
+                for n, mi in inst.memdict.iteritems():
+                    items.extend(("%s(%d)" % (n, i), sig) for i, sig in enumerate(mi.mem))
+            if regexes:
+                items = [(n, sig) for n, sig in items 
+                         if any(rx.match(prefix + n) for rx in regexes)]
+            added += self._add_scope_vars(tuple(pathstack), prefix, items, traced)
+        self.trace_objects.append(hierarchy)
+        return added
+        
+    def add_trace_cosimulation(self, cosim, scopename="cosimulation"):
+        """
+        Add the signals of a co-simulation link (myhdl.Cosimulation, e.g. 
+        GHDL through the VHPI interface in cosimulation/ghdl).
+        
+        Arguments:
+        * cosim: Cosimulation object, after its creation (signal 
+          descriptions already received)
+        * scopename: VCD scope for the link signals
+        
+        TO signals (driven by the co-simulator) and FROM signals (driven by 
+        MyHDL) are declared with the names of the signal descriptions 
+        (C_TO_SIGINFO and C_FROM_SIGINFO generics). Their value changes are
+        the updates exchanged on the link, so both sides are in the same 
+        trace at MyHDL time resolution (use traceConfig timescale to match 
+        C_TIMERES), without a GHDL --vcd dump. A signal already traced is 
+        declared with the same reference.
+        
+        Returns: number of traced signals added.
+        """
+        items = zip(cosim._toSignames, cosim._toSigs) + zip(cosim._fromSignames, cosim._fromSigs)
+        added = self._add_scope_vars((scopename,), scopename + ".", items, self._traced_ids())
+        self.trace_objects.append(cosim)
+        return added
+        
+    def _traced_ids(self):
+        # id(signal) -> trace name, for signals already traced
+        return dict((id(sig), name) for name, sig in self.signal_objects.iteritems())
+        
+    def _add_scope_vars(self, path, prefix, items, traced):
+        # add a hierarchical scope with (var name, signal) items. New signals
+        # are traced with name prefix + var name, signals in traced (see 
+        # _traced_ids, updated here) keep their trace name. 
+        # Returns number of signals added
+        signal_objects = self.signal_objects
+        added = 0
+        scopevars = []
+        for n, sig in items:
+            key = traced.get(id(sig))
+            if key is None:
+                key = prefix + n
+                if key in signal_objects:
+                    raise ValueError("Signal '%s' (%s) already traced." % (key, repr(sig)))
+                signal_objects[key] = sig
+                traced[id(sig)] = key
+                added += 1
+            scopevars.append((n, key))
+        if len(scopevars) > 0:
+            self.scope_hier.append((path, scopevars))
+        return added
         
     def vcd_generator(self):
         header = self._vcd_header()
         signals = self._vcd_signal_header()
-        vcdclose = self._vcd_section("vcdclose", "#%d" % self.sim_max_time)
         if self.vcdpath == os.path.splitext(self.vcdpath)[0]:
             self.vcdpath += ".vcd"
+        if self.streaming:
+            return self._vcd_stream_generator(header, signals)
         
-        def sig_proc_gen(sigref, signame):
-            @myhdl.always(sigref)
-            def sig_proc():
-                curtime = myhdl.now()
-                traceval = "%s%s" % (self._vcd_printval(sigref), self._vcd_references[signame])
-                if curtime not in self.traceinfo:
-                    self.traceinfo[curtime] = []
-                self.traceinfo[curtime].append(traceval)
-                
-            return sig_proc
-            
-        @myhdl.instance
-        def file_driver():
-            yield myhdl.delay(self.sim_max_time - 1)
+        self.traceinfo = trace_store()
+        for signame, sigref in self.signal_objects.iteritems():
+            self.traceinfo.add_signal(signame, sigref)
+        # trace generators run in a new Simulation: initial values at time 0
+        self.traceinfo.start(0, self.signal_objects)
+        
+        def record_gen(sigref, signame):
+            return self.traceinfo.recorder(self.traceinfo.ids_by_name[signame])
+        self._attach_capture(record_gen, self.keep_deltas)
+        
+        def write_output(endtime):
+            self.traceinfo.endtime = endtime
             vcdfile = open(self.vcdpath, 'w')
             vcdfile.write(header)
             vcdfile.write(signals)
-            timevals = self.traceinfo.keys()
-            timevals.sort()
-            for t in timevals:
-                vcdfile.write("#%d\n" % t)
-                for v in self.traceinfo[t]:
-                    vcdfile.write(v+"\n")
-            vcdfile.write(vcdclose)
+            self._vcd_write_changes(vcdfile, self.traceinfo)
+            vcdfile.write(self._vcd_section("vcdclose", "#%d" % endtime))
             vcdfile.close()
-            return
+        self._session_output = write_output
+        
+        generator_list = []
+        if self.sim_max_time is not None:
+            @myhdl.instance
+            def file_driver():
+                yield myhdl.delay(self.sim_max_time - 1)
+                self._write_session_output(self.sim_max_time)
+                return
+            generator_list.append(file_driver)
                     
-        generator_list = [file_driver]
+        return generator_list
+        
+    def _vcd_stream_generator(self, header, signals):
+        self.close()
+        if self.rotate_size is not None or self.rotate_time is not None:
+            self._stream = _vcd_chunked_stream(self.vcdpath, header + self._vcd_declarations, 
+                self._vcd_dumpvars, self._vcd_initial, self.rotate_size, self.rotate_time)
+        else:
+            self._stream = _vcd_stream(self.vcdpath, header + signals)
+        stream = self._stream
+        if self.background:
+            self._stream = _background_writer(stream, maxbatches=self.queue_size)
+        
+        def record_gen(sigref, signame):
+            ref = self._vcd_references[signame]
+            format_value = self._vcd_formats[signame]
+            def record(curtime, value):
+                stream.change(curtime, format_value(value), ref)
+            if self.background:
+                return self._stream.recorder(record, sigref)
+            return record
+        self._attach_capture(record_gen, self.keep_deltas)
+            
+        generator_list = []
+        if self.sim_max_time is not None:
+            @myhdl.instance
+            def file_driver():
+                yield myhdl.delay(self.sim_max_time - 1)
+                self.close(self.sim_max_time)
+                return
+            generator_list.append(file_driver)
+            
+        return generator_list
+        
+    def _attach_capture(self, record_gen, keep_deltas=False):
+        # Value changes are captured with the hook MyHDL uses for its own 
+        # VCD tracing: Signal._update() calls Signal._printVcd() on every 
+        # value change when Signal._tracing is set. No generator is added 
+        # to the scheduler for each traced signal. Hooks are shared with 
+        # other monitors and chained to existing ones (see _capture_dispatch)
+        # record_gen(sigref, signame) returns a function record(time, value)
+        # Unless keep_deltas is set, changes go through a _delta_filter
+        self._detach_capture()
+        if self.capture_filter is not None:
+            self.capture_filter.reset()
+        if not keep_deltas:
+            self._delta_filter = _delta_filter()
         for signame, sigref in self.signal_objects.iteritems():
-            generator_list.append(sig_proc_gen(sigref, signame))
+            record = record_gen(sigref, signame)
+            if self.capture_filter is not None:
+                record = self.capture_filter.wrap(record, sigref, signame)
+            if self._delta_filter is not None:
+                record = self._delta_filter.wrap(record, sigref)
+            def capture(record=record, sigref=sigref):
+                record(myhdl.now(), sigref._val)
+            self._capture_hooks.append((_capture_dispatch.attach(sigref, capture), capture))
+            
+    def _detach_capture(self):
+        if self._delta_filter is not None:
+            self._delta_filter.flush()
+            self._delta_filter = None
+        if self.capture_filter is not None:
+            self.capture_filter.flush()
+        for dispatch, capture in self._capture_hooks:
+            dispatch.detach(capture)
+        self._capture_hooks = []
+        
+    def smt_generator(self):
+        """
+        Trace generators for SMT binary output (see smt_reader and 
+        smt_to_vcd). Records are written in compressed blocks while 
+        simulation runs.
+        """
+        # assign VCD identifier codes, stored in the SMT header
+        self._vcd_signal_header()
+        if self.vcdpath == os.path.splitext(self.vcdpath)[0]:
+            self.vcdpath += ".smt"
+        sigids = {}
+        signals = []
+        for signame, sigref in self.signal_objects.iteritems():
+            kind, nbits, signed = _signal_kind(sigref)
+            sigids[signame] = len(signals)
+            signals.append({"name": signame, "kind": kind, "nbits": nbits, 
+                "signed": signed, "ref": self._vcd_references[signame]})
+        scopes = [[list(path), [[varname, sigids[n]] for varname, n in scopevars]] 
+                  for path, scopevars in self._scope_list()]
+        meta = {"version": _smt_version, "date": time.asctime(), "timescale": self.timescale,
+            "basename": "signal_monitor", "signals": signals, "scopes": scopes}
+            
+        self.close()
+        self._stream = _smt_stream(self.vcdpath, meta)
+        stream = self._stream
+        for signame, sigref in self.signal_objects.iteritems():
+            stream.recorder(sigids[signame])(0, sigref._val)
+        if self.background:
+            self._stream = _background_writer(stream, maxbatches=self.queue_size)
+        
+        def record_gen(sigref, signame):
+            if self.background:
+                return self._stream.recorder(stream.recorder(sigids[signame]), sigref)
+            return stream.recorder(sigids[signame])
+        self._attach_capture(record_gen, self.keep_deltas)
+        
+        generator_list = []
+        if self.sim_max_time is not None:
+            @myhdl.instance
+            def file_driver():
+                yield myhdl.delay(self.sim_max_time - 1)
+                self.close(self.sim_max_time)
+                return
+            generator_list.append(file_driver)
             
         return generator_list
         
-    def traceConfig(self, sim_max_time, basename=""):
+    def stats_generator(self):
+        """
+        Trace generators for activity statistics (see activity_stats). 
+        Statistics are written to a JSON file at sim_max_time.
+        """
+        if self.vcdpath == os.path.splitext(self.vcdpath)[0]:
+            self.vcdpath += ".json"
+        self.close()
+        self.stats = activity_stats(self.stats_clock)
+        for signame, sigref in self.signal_objects.iteritems():
+            self.stats.add_signal(signame, sigref)
+            
+        def record_gen(sigref, signame):
+            return self.stats.recorder(self.stats.ids_by_name[signame])
+        # every change counts for switching activity
+        self._attach_capture(record_gen, True)
+        
+        def write_output(endtime):
+            self.stats.endtime = endtime
+            self.stats.write(self.vcdpath)
+        self._session_output = write_output
+        
+        generator_list = []
+        if self.sim_max_time is not None:
+            @myhdl.instance
+            def file_driver():
+                yield myhdl.delay(self.sim_max_time - 1)
+                self._write_session_output(self.sim_max_time)
+                return
+            generator_list.append(file_driver)
+            
+        return generator_list
+        
+    def traceConfig(self, sim_max_time, basename="", streaming=False, trace_format="vcd", 
+                    windows=None, trigger=None, pretrigger=0, posttrigger=None,
+                    rotate_size=None, rotate_time=None, background=False, queue_size=16,
+                    stats_clock=None, timescale="1ns", keep_deltas=False):
+        """
+        Configure trace output and return the list of trace generators.
+        
+        Arguments:
+        * sim_max_time: simulation time when the trace is written. Use None 
+          for open-ended simulations (close the trace with close(), or 
+          stop_session() for in-memory output)
+        * basename: output file name
+        * timescale: duration of one MyHDL time step in the trace (e.g. 
+          C_TIMERES of a GHDL co-simulation)
+        * keep_deltas: record every value change. By default, changes of a 
+          signal in the same timestep (delta cycles) are collapsed to the 
+          final value, and dropped if it equals the last recorded value. 
+          "stats" format always counts every change
+        * streaming: write value changes to file while simulation runs, 
+          instead of keeping them in memory until sim_max_time. Use close()
+          if the simulation ends before sim_max_time.
+        * trace_format: "vcd", "smt" (compressed binary format, always 
+          streaming. Use smt_to_vcd() to convert it) or "stats" (no 
+          waveform, only switching activity statistics in self.stats, see 
+          activity_stats. Written as JSON at sim_max_time, or by close())
+        * stats_clock: clock signal name, to count active cycles in "stats"
+          format
+        
+        Capture control (like a logic analyzer, see _capture_filter):
+        * windows: list of (start, stop) times. Only value changes with 
+          start <= time < stop are recorded
+        * trigger: (signal name, condition) tuple. Recording starts when 
+          condition is met: "posedge", "negedge", "change" or a value to 
+          match
+        * pretrigger: number of value changes before the trigger to keep, 
+          recorded after a snapshot of all values at the oldest one
+        * posttrigger: recording time after the trigger (None: until end)
+        
+        Rotating output (VCD only, always streaming. See vcd_chunks):
+        * rotate_size: start a new chunk file when the current one reaches 
+          this size in bytes
+        * rotate_time: start a new chunk file after this simulation time span
+        
+        Background output (always streaming):
+        * background: encode and write the trace in a background thread. The
+          simulation only queues raw value changes
+        * queue_size: number of queued batches (4096 changes each) before 
+          simulation waits for the writer
+        """
+        # a previous configuration without output yet is discarded
+        self._session_output = None
+        self._detach_capture()
         if basename == "":
             self.vcdpath = "custom_tracer"
         else:
             self.vcdpath = basename
+        if trace_format not in ("vcd", "smt", "stats"):
+            raise ValueError("Unknown trace format '%s'." % trace_format)
+        if trace_format == "stats":
+            if rotate_size is not None or rotate_time is not None or background:
+                raise ValueError("Statistics mode has no trace output options.")
+            if stats_clock is not None and stats_clock not in self.signal_objects:
+                raise ValueError("Clock signal '%s' not traced." % stats_clock)
+            # nothing to stream, sim_max_time is optional
+            streaming = True
+        self.stats_clock = stats_clock
+        self.timescale = timescale
+        self.keep_deltas = keep_deltas
+        if trace_format == "smt":
+            streaming = True
+        if rotate_size is not None or rotate_time is not None:
+            if trace_format != "vcd":
+                raise ValueError("Trace rotation is only available for VCD output.")
+            streaming = True
+        self.rotate_size = rotate_size
+        self.rotate_time = rotate_time
+        if background:
+            streaming = True
+        self.background = background
+        self.queue_size = queue_size
         self.sim_max_time = sim_max_time
-        self.traceGenerator = self.vcd_generator()
+        self.streaming = streaming
+        if windows is not None or trigger is not None:
+            if trigger is not None and trigger[0] not in self.signal_objects:
+                raise ValueError("Trigger signal '%s' not traced." % trigger[0])
+            self.capture_filter = _capture_filter(windows, trigger, pretrigger, posttrigger)
+        else:
+            self.capture_filter = None
+        if trace_format == "smt":
+            self.traceGenerator = self.smt_generator()
+        elif trace_format == "stats":
+            self.traceGenerator = self.stats_generator()
+        else:
+            self.traceGenerator = self.vcd_generator()
         return self.traceGenerator
+        
+    def start_session(self, sim_max_time, basename="", **kwargs):
+        """
+        Start a new capture session and return its trace generators. Signals
+        are registered once: the same monitor can trace several Simulation 
+        runs (e.g. one per test case), each one with its own output file. 
+        An active session is stopped first (see stop_session).
+        
+        Arguments:
+        * sim_max_time: as in traceConfig. None: output is written by 
+          stop_session()
+        * basename: output file name. A "%d" in it is replaced with the 
+          session number
+        * kwargs: other traceConfig options
+        """
+        self.stop_session()
+        self.session_count += 1
+        basename = basename.replace("%d", str(self.session_count))
+        return self.traceConfig(sim_max_time, basename, **kwargs)
+        
+    def stop_session(self):
+        """
+        Stop the current capture session at current simulation time: write 
+        its output if not already written (also for streaming traces, see 
+        close) and release the captured data. Traced signals stay 
+        registered for the next session.
+        
+        Returns the session data: trace_store (in-memory VCD), 
+        activity_stats ("stats" format) or None (streaming traces)
+        """
+        if isinstance(self.traceinfo, trace_store):
+            retval = self.traceinfo
+        else:
+            retval = self.stats
+        self._write_session_output(None)
+        self.close()
+        # per-session data
+        self.traceinfo = {}
+        self.stats = None
+        self.capture_filter = None
+        self.traceGenerator = None
+        return retval
+        
+    def _write_session_output(self, endtime=None):
+        # stop capture and write in-memory output once (None: current time)
+        self._detach_capture()
+        write_output, self._session_output = self._session_output, None
+        if write_output is not None:
+            if endtime is None:
+                endtime = myhdl.now()
+            write_output(endtime)
+        
+    def close(self, endtime=None):
+        """
+        Close a streaming trace at current simulation time. Required when 
+        simulation ends before sim_max_time (StopSimulation) or with 
+        open-ended simulations. Open traces are also closed at exit. Output
+        not written yet ("stats" JSON, in-memory VCD) is written.
+        
+        Arguments:
+        * endtime: trace end time, instead of current simulation time
+        """
+        self._write_session_output(endtime)
+        if self._stream is not None:
+            stream, self._stream = self._stream, None
+            if endtime is None and stream.file is not None and stream.curtime is not None:
+                endtime = max(stream.curtime, myhdl.now())
+            stream.close(endtime)
 
     def _add_myhdl_trace_signal(self, signal, name, ignExcp=False):
         # direct reference, need a correct name
@@ -228,6 +2075,38 @@ class signal_monitor():
             self.signal_objects[name] = signal
         return name
             
+    def _vcd_write_changes(self, vcdfile, store, batchsize=8192):
+        # VCD formatting of a trace_store, written in batches of lines.
+        # Unsigned integer entries are formatted directly from the value 
+        # column, without decoding
+        refs = []
+        formats = []
+        direct = []
+        for name, kind, nbits, signed in store.signals:
+            refs.append(self._vcd_references[name] + "\n")
+            formats.append(self._vcd_formats[name])
+            direct.append(kind == "int" and not signed)
+        times, ids, values = store.times, store.ids, store.values
+        decode = store.value
+        lines = []
+        append = lines.append
+        lasttime = None
+        for pos in xrange(store.start_pos, len(times)):
+            curtime = times[pos]
+            if curtime != lasttime:
+                append("#%d\n" % curtime)
+                lasttime = curtime
+            sigid = ids[pos]
+            if direct[sigid]:
+                append(formats[sigid](values[pos]))
+            else:
+                append(formats[sigid](decode(pos)))
+            append(refs[sigid])
+            if len(lines) >= batchsize:
+                vcdfile.write("".join(lines))
+                del lines[:]
+        vcdfile.write("".join(lines))
+            
     def _vcd_section(self, name, content, cr=False, tab=False):
         if cr:
             if tab:
@@ -240,69 +2119,93 @@ class signal_monitor():
     def _vcd_header(self):
         retval = self._vcd_section("date", time.asctime(), True, True)
         retval += self._vcd_section("version", "NoCmodel 0.1 (TEMP)", True, True)
-        retval += self._vcd_section("timescale", "1ns", True, True)
+        retval += self._vcd_section("timescale", self.timescale, True, True)
         return retval+"\n"
         
+    def _scope_list(self):
+        # all scopes as (scope path, [(var name, signal name), ...])
+        scopes = [((), [(s, s) for s in self.scope_top])]
+        for k, v in self.scope_tree.iteritems():
+            scopes.append(((k,), [(s, s) for s in v]))
+        scopes.extend(self.scope_hier)
+        return scopes
+        
     def _vcd_signal_header(self, basename="signal_monitor"):
+        # traced signals only grow: the declarations are reused between 
+        # sessions until a signal or scope is added
+        key = (len(self.signal_objects), len(self.scope_hier), basename)
+        if key != self._header_key:
+            self._vcd_build_declarations(basename)
+            self._header_key = key
+        retval = self._vcd_declarations
+        # initial values: ref -> formatted value
+        self._vcd_initial = OrderedDict()
+        for sig, ref in self._vcd_references.iteritems():
+            self._vcd_initial[ref] = self._vcd_formats[sig](self.signal_objects[sig].val)
+        retval += self._vcd_dumpvars(self._vcd_initial)
+        return retval
+        
+    def _vcd_build_declarations(self, basename):
         self._vcd_references = OrderedDict()
-        #index_counter = 33 # ascii '!'
-        index_counter = 0
+        scopes = self._scope_list()
+        # one reference for each signal, in declaration order. A signal in 
+        # several scopes is declared with the same reference
+        for path, scopevars in scopes:
+            for varname, s in scopevars:
+                self._vcd_references.setdefault(s)
+        refs = vcd_identifiers(len(self._vcd_references))
+        for s, ref in zip(self._vcd_references, refs):
+            self._vcd_references[s] = ref
+        # value formatting resolved once for each signal
+        self._vcd_formats = {}
+        for s in self._vcd_references:
+            sigref = self.signal_objects[s]
+            self._vcd_formats[s] = _vcd_formatter(sigref.val, sigref._nrbits, self._vcd_printval)
+        def var_decl(varname, s):
+            return self._vcd_var_decl(varname, self.signal_objects[s]._nrbits, self._vcd_references[s])
         # main scope
         retval = self._vcd_section("scope", "module %s" % basename)
-        # top scope
-        for s in self.scope_top:
-            width = self.signal_objects[s]._nrbits
-            ref = self._vcd_genref(index_counter)
-            if width == 0:
-                # take as integer (def 64 bits)
-                retval += self._vcd_section("var", "integer 64 %s %s" % (ref, s))
-            else:
-                # reg
-                retval += self._vcd_section("var", "reg %d %s %s" % (width, ref, s))
-            self._vcd_references[s] = ref
-            index_counter += 1
-        # sub scopes
-        for k, v in self.scope_tree.iteritems():
-            retval += self._vcd_section("scope", "module %s" % k)
-            for s in v:
-                width = self.signal_objects[s]._nrbits
-                ref = self._vcd_genref(index_counter)
-                if width == 0:
-                    # take as integer (def 64 bits)
-                    retval += self._vcd_section("var", "integer 64 %s %s" % (ref, s))
-                else:
-                    # reg
-                    retval += self._vcd_section("var", "reg %d %s %s" % (width, ref, s))
-                self._vcd_references[s] = ref
-                index_counter += 1
-            retval += self._vcd_section("upscope", "")
-        
+        retval += self._vcd_scope_decls(scopes, var_decl)
         retval += self._vcd_section("upscope", "")
         # end signal header
         retval += self._vcd_section("enddefinitions", "")
-        #print "SIGNAL HEADER: index counter = %d (%d)" % (index_counter, index_counter - 33)
-        # initial values
-        ival = ""
-        for sig, ref in self._vcd_references.iteritems():
-            ival += "%s%s\n" % (self._vcd_printval(self.signal_objects[sig]), ref)
-        retval += self._vcd_section("dumpvars", ival[:-1], True)
-        return retval
+        self._vcd_declarations = retval
         
-    def _vcd_genref(self, countval):
-        if not hasattr(self, "_vcd_signal_count"):
-            setattr(self, "_vcd_signal_count", len(self.signal_objects))
-            setattr(self, "_vcd_ref_numchr", int(log(self._vcd_signal_count, 94)) + 1)
-            setattr(self, "_vcd_ref_range", range(self._vcd_ref_numchr))
-        retval = ""
-        tempval = countval
-        # TODO: check this algorithm!!!
-        for i in self._vcd_ref_range:
-            if i == len(self._vcd_ref_range) - 1:
-                retval += chr((countval % 94)+33) 
-            else:
-                retval += chr((tempval / 94)+33) 
-                tempval -= 94
-        return retval
+    def _vcd_dumpvars(self, values):
+        # values: ref -> formatted value
+        ival = "\n".join("%s%s" % (v, ref) for ref, v in values.iteritems())
+        return self._vcd_section("dumpvars", ival, True)
+        
+    def _vcd_scope_decls(self, scopes, var_decl):
+        # nested scope and var declarations. 
+        # scopes: list of (scope path, [(var name, signal key), ...])
+        # var_decl(var name, signal key) returns a var declaration
+        root = (OrderedDict(), [])
+        for path, scopevars in scopes:
+            node = root
+            for scopename in path:
+                if scopename not in node[0]:
+                    node[0][scopename] = (OrderedDict(), [])
+                node = node[0][scopename]
+            node[1].extend(scopevars)
+        retval = []
+        def emit(node):
+            for varname, key in node[1]:
+                retval.append(var_decl(varname, key))
+            for scopename, sub in node[0].iteritems():
+                retval.append(self._vcd_section("scope", "module %s" % scopename))
+                emit(sub)
+                retval.append(self._vcd_section("upscope", ""))
+        emit(root)
+        return "".join(retval)
+        
+    def _vcd_var_decl(self, name, width, ref):
+        if width == 0:
+            # take as integer (def 64 bits)
+            return self._vcd_section("var", "integer 64 %s %s" % (ref, name))
+        else:
+            # reg
+            return self._vcd_section("var", "reg %d %s %s" % (width, ref, name))
         
     def _vcd_printval(self, value):
         if isinstance(value, myhdl.SignalType):
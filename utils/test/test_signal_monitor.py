@@ -0,0 +1,639 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Tests for signal_monitor
+
+import sys
+sys.path.append("..")
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+import random
+random.seed(2)
+
+from myhdl import Signal, intbv, enum, always, always_comb, delay, Simulation, Cosimulation
+
+from signal_monitor import signal_monitor, iter_vcd_identifiers, vcd_identifiers, \
+                           _vcd_formatter, trace_store, numpy, activity_stats, _delta_filter, \
+                           smt_to_vcd, smt_to_store, extract_hierarchy, vcd_chunks, \
+                           _background_writer, _vcd_stream
+
+MAX_SIGNALS = 10 * 1000 * 1000
+
+state_t = enum("IDLE", "RUN", "DONE")
+
+def example_design():
+    """ 
+    Signals of every value kind, changing on clock falling edges. Returns 
+    (list of (name, signal), generator)
+    """
+    clk = Signal(bool(0))
+    data = Signal(intbv(0)[8:])
+    sdata = Signal(intbv(0, min=-100, max=100))
+    wide = Signal(intbv(0)[100:])
+    unbounded = Signal(intbv(0))
+    state = Signal(state_t.IDLE)
+    real = Signal(0.5)
+    count = Signal(0)
+    @always(delay(5))
+    def gen():
+        clk.next = not clk
+        if clk:
+            data.next = (data + 37) % 256
+            sdata.next = (sdata + 33) % 100 - 50
+            wide.next = (wide * 3 + 1) % 2**100
+            unbounded.next = unbounded + 1000
+            state.next = state_t.RUN if state == state_t.IDLE else state_t.IDLE
+            real.next = real * -1.5
+            count.next = count - 7
+    signals = [("clk", clk), ("data", data), ("sdata", sdata), ("wide", wide), 
+        ("unbounded", unbounded), ("state", state), ("real", real), ("count", count)]
+    return signals, gen
+
+def vcd_body(path):
+    """ VCD file content after the date section """
+    content = open(path).read()
+    return content[content.index("$version"):]
+
+def vcd_changes(path):
+    """ 
+    Value changes in a VCD file: returns (dumpvars dict ref -> value, list 
+    of (time, ref, value), end time)
+    """
+    lines = open(path).read().split("$enddefinitions  $end\n")[1].splitlines()
+    initial = {}
+    changes = []
+    curtime = None
+    endtime = None
+    in_dumpvars = False
+    for line in lines:
+        if line == "$dumpvars":
+            in_dumpvars = True
+        elif line == "$end":
+            in_dumpvars = False
+        elif line.startswith("#"):
+            curtime = int(line[1:])
+        elif line.startswith("$vcdclose"):
+            endtime = int(line.split()[1][1:])
+        else:
+            if line[0] in "brs":
+                value, ref = line.split(" ")
+            else:
+                value, ref = line[0], line[1:]
+            if in_dumpvars:
+                initial[ref] = value
+            else:
+                changes.append((curtime, ref, value))
+    return initial, changes, endtime
+
+class TempDirCase(TestCase):
+    """ output files in a temporary directory """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def trace(self, basename, duration=200, sim_max_time=200, **kwargs):
+        """ trace example_design to basename in tmpdir. Returns the monitor """
+        signals, gen = example_design()
+        tracer = signal_monitor()
+        for name, sig in signals:
+            tracer.add_trace_signal(sig, name)
+        gens = tracer.traceConfig(sim_max_time, self.path(basename), **kwargs)
+        Simulation([gen] + gens).run(duration, quiet=1)
+        return tracer
+
+class TestVcdIdentifiers(TestCase):
+
+    def testUniqueCodes(self):
+        """ identifier codes are unique and valid for up to 10M signals """
+        # codes are generated in strictly increasing (length, code) order, 
+        # so checking each code against the previous one is enough
+        prev = (0, "")
+        count = 0
+        for code in iter_vcd_identifiers():
+            if count == MAX_SIGNALS:
+                break
+            cur = (len(code), code)
+            self.assertTrue(prev < cur, "code %r after %r" % (code, prev[1]))
+            prev = cur
+            count += 1
+        self.assertEqual(count, MAX_SIGNALS)
+        # 94 + 94**2 + 94**3 < 10M <= 94 + 94**2 + 94**3 + 94**4
+        self.assertEqual(prev[0], 4)
+
+    def testCharacters(self):
+        """ identifier codes only use printable ASCII characters """
+        codes = vcd_identifiers(94 + 94**2 + 1)
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertEqual(codes[0], "!")
+        self.assertEqual(codes[93], "~")
+        self.assertEqual(codes[94], "!!")
+        self.assertEqual(codes[-1], "!!!")
+        for code in codes:
+            for c in code:
+                self.assertTrue(33 <= ord(c) <= 126)
+
+    def testSignalHeader(self):
+        """ each traced signal gets its own identifier code """
+        nsig = 1000
+        sigs = [Signal(intbv(0)[8:]) for i in range(nsig)]
+        mon = signal_monitor()
+        mon.add_trace_signal(sigs, "sigs", "scope")
+        mon._vcd_signal_header()
+        refs = mon._vcd_references.values()
+        self.assertEqual(len(refs), nsig)
+        self.assertEqual(len(set(refs)), nsig)
+
+
+class TestVcdFormat(TestCase):
+
+    def testFormatters(self):
+        """ per signal formatters match the generic value formatting """
+        mon = signal_monitor()
+        state = enum("IDLE", "RUN")
+        cases = ((Signal(bool(0)), (False, True)),
+                 (Signal(intbv(0)[1:]), (intbv(0)[1:], intbv(1)[1:])),
+                 (Signal(intbv(0)[8:]), (0, 5, 255, 5)),
+                 (Signal(intbv(0, min=-8, max=8)), (-8, -1, 0, 7, -1)),
+                 (Signal(intbv(0)[100:]), (0, 2**99 + 1, 2**99 + 1)),
+                 (Signal(0), (0, 3, -3)),
+                 (Signal(0.5), (0.5, 1e-20, -3.25)),
+                 (Signal(state.IDLE), (state.IDLE, state.RUN, state.IDLE)))
+        for sig, values in cases:
+            fmt = _vcd_formatter(sig.val, sig._nrbits, mon._vcd_printval)
+            for v in values:
+                if isinstance(sig.val, intbv) and not isinstance(v, intbv):
+                    v = intbv(v, min=sig.min, max=sig.max)
+                self.assertEqual(fmt(v), mon._vcd_printval(v))
+
+
+class TestSmt(TempDirCase):
+
+    def testRoundTrip(self):
+        """ SMT converted to VCD is the same as a direct VCD trace """
+        for trace_format in ("vcd", "smt"):
+            self.trace(trace_format, trace_format=trace_format)
+        smt_to_vcd(self.path("smt.smt"), self.path("smt.vcd"))
+        self.assertEqual(vcd_body(self.path("smt.vcd")), vcd_body(self.path("vcd.vcd")))
+        store = smt_to_store(self.path("smt.smt"))
+        self.assertEqual(store.endtime, 200)
+        self.assertEqual(store.changes("unbounded")[:3], [(0, 0), (10, 1000), (20, 2000)])
+        self.assertEqual(store.value_at("sdata", 20), -34)
+        self.assertEqual(store.value_at("wide", 200), 3**19 // 2)
+
+def inverter(a, y):
+    @always_comb
+    def logic():
+        y.next = not a
+    return logic
+
+def inverter_chain(a, y):
+    m = Signal(bool(0))
+    u0 = inverter(a, m)
+    u1 = inverter(m, y)
+    return u0, u1
+
+class TestHierarchy(TestCase):
+
+    def setUp(self):
+        self.a = Signal(bool(0))
+        self.y = Signal(bool(0))
+        self.top, self.hierarchy = extract_hierarchy(inverter_chain, self.a, self.y)
+
+    def testScopes(self):
+        """ nested scopes, a signal in several scopes has one reference """
+        tracer = signal_monitor()
+        self.assertEqual(tracer.add_trace_hierarchy(self.hierarchy), 3)
+        self.assertEqual(list(tracer.signal_objects), ["inverter_chain.a", 
+            "inverter_chain.m", "inverter_chain.y"])
+        tracer._vcd_signal_header()
+        decls = tracer._vcd_declarations
+        self.assertEqual(decls.count("$scope"), 4)
+        for scope, refs in (("u0", '! a $end\n$var reg 1 " y'), ("u1", '" a $end\n$var reg 1 # y')):
+            start = decls.index("$scope module %s $end" % scope)
+            self.assertTrue(refs in decls[start:decls.index("$upscope", start)], scope)
+
+    def testSelection(self):
+        """ patterns, depth limit and signals already traced """
+        tracer = signal_monitor()
+        self.assertEqual(tracer.add_trace_hierarchy(self.hierarchy, ["*.u0.*"]), 2)
+        self.assertEqual(list(tracer.signal_objects), ["inverter_chain.u0.a", "inverter_chain.u0.y"])
+        tracer = signal_monitor()
+        self.assertEqual(tracer.add_trace_hierarchy(self.hierarchy, maxdepth=1), 3)
+        self.assertEqual(tracer.scope_hier[0][0], ("inverter_chain",))
+        self.assertEqual(len(tracer.scope_hier), 1)
+        tracer = signal_monitor()
+        tracer.add_trace_signal(self.y, "out")
+        self.assertEqual(tracer.add_trace_hierarchy(self.hierarchy), 2)
+        self.assertEqual(tracer.scope_hier[0][1][2], ("y", "out"))
+
+    def testChanges(self):
+        """ changes of a shared signal recorded once """
+        tracer = signal_monitor()
+        tracer.add_trace_hierarchy(self.hierarchy)
+        a = self.a
+        @always(delay(10))
+        def stim():
+            a.next = not a
+        gens = tracer.traceConfig(None)
+        Simulation([self.top, stim] + gens).run(35, quiet=1)
+        store = tracer.traceinfo
+        tracer._detach_capture()
+        self.assertEqual(store.changes("inverter_chain.m"), [(0, False), (0, True), 
+            (10, False), (20, True), (30, False)])
+
+class TestSharedCapture(TempDirCase):
+
+    def testDetachOrder(self):
+        """ monitors of the same signal stopped in any order """
+        for streaming in (True, False):
+            clk = Signal(bool(0))
+            @always(delay(5))
+            def clkgen():
+                clk.next = not clk
+            monitors = []
+            gens = []
+            for name, sim_max_time in (("a", 50), ("b", 100)):
+                tracer = signal_monitor()
+                tracer.add_trace_signal(clk, "clk")
+                gens.extend(tracer.traceConfig(sim_max_time, self.path(name), streaming=streaming))
+                monitors.append(tracer)
+            Simulation([clkgen] + gens).run(100, quiet=1)
+            for name, endtime in (("a", 50), ("b", 100)):
+                initial, changes, vcd_end = vcd_changes(self.path(name + ".vcd"))
+                self.assertEqual(vcd_end, endtime)
+                self.assertEqual(changes[-1][0], endtime - 5)
+            # first monitor stopped at 50, second one at 100
+            self.assertEqual(clk._tracing, 0)
+            monitors[1].close()
+            monitors[0].close()
+            Simulation([clkgen]).run(20, quiet=1)
+            if not streaming:
+                self.assertEqual(monitors[0].traceinfo.changes("clk")[-1][0], 45)
+
+class TestRotation(TempDirCase):
+
+    def check_chunks(self, chunks):
+        # each chunk holds the full trace values at its start and the 
+        # changes of its time range
+        initial, changes, endtime = vcd_changes(self.path("full.vcd"))
+        prev_end = 0
+        for path, start, end in chunks:
+            self.assertEqual(start, prev_end)
+            prev_end = end
+            values = dict(initial)
+            values.update((ref, v) for t, ref, v in changes if t < start)
+            chunk_initial, chunk_changes, chunk_end = vcd_changes(path)
+            self.assertEqual(chunk_initial, values, path)
+            self.assertEqual(chunk_changes, [c for c in changes if start <= c[0] < end], path)
+            self.assertEqual(chunk_end, end)
+        self.assertEqual(prev_end, endtime)
+
+    def testRotateTime(self):
+        """ one chunk for each time span """
+        self.trace("full")
+        self.trace("rot", rotate_time=50)
+        index = self.path("rot.index.json")
+        chunks = vcd_chunks(index)
+        self.assertEqual([(os.path.basename(p), s, e) for p, s, e in chunks], 
+            [("rot.%04d.vcd" % n, n * 50, (n + 1) * 50) for n in range(4)])
+        self.check_chunks(chunks)
+        self.assertEqual([s for p, s, e in vcd_chunks(index, 60, 120)], [50, 100])
+
+    def testRotateSize(self):
+        """ new chunk at a timestep boundary after rotate_size bytes """
+        self.trace("full")
+        self.trace("rot", rotate_size=1200)
+        chunks = vcd_chunks(self.path("rot.index.json"))
+        self.assertTrue(2 < len(chunks) < 20)
+        self.check_chunks(chunks)
+
+class TestBackground(TempDirCase):
+
+    def testSameOutput(self):
+        """ same trace written in a background thread """
+        self.trace("direct", streaming=True)
+        self.trace("background", background=True)
+        self.trace("background_smt", trace_format="smt", background=True, queue_size=1)
+        smt_to_vcd(self.path("background_smt.smt"), self.path("background_smt.vcd"))
+        direct = vcd_body(self.path("direct.vcd"))
+        for name in ("background", "background_smt"):
+            self.assertEqual(vcd_body(self.path(name + ".vcd")), direct)
+
+    def testWriterError(self):
+        """ an error in the writer thread is raised in the simulation thread """
+        stream = _vcd_stream(self.path("error.vcd"), "")
+        writer = _background_writer(stream, batchsize=2)
+        def sink(curtime, value):
+            raise ValueError("bad value %d" % value)
+        record = writer.recorder(sink, Signal(intbv(0)[8:]))
+        record(0, 1)
+        record(1, 2)
+        self.assertRaises(ValueError, writer.sync)
+        self.assertTrue(writer.thread.is_alive())
+        writer.close()
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(stream.file, None)
+
+# co-simulator speaking the MyHDL pipe protocol: y = not a, in the same 
+# timestep
+_cosim_inverter = """
+import os, sys
+to_fd = int(os.environ["MYHDL_TO_PIPE"])
+from_fd = int(os.environ["MYHDL_FROM_PIPE"])
+def recv():
+    buf = os.read(from_fd, 4096)
+    if not buf:
+        sys.exit(0)
+    return buf.split()
+for msg in ("FROM 0 a 1", "TO 0 y 1", "START"):
+    os.write(to_fd, msg)
+    recv()
+a, y = 0, None
+while True:
+    if y != (not a):
+        y = not a
+        os.write(to_fd, "0 y %x" % y)
+    else:
+        os.write(to_fd, "0")
+    values = recv()
+    if len(values) > 1:
+        a = int(values[1], 16)
+"""
+
+class TestCosimulation(TempDirCase):
+
+    def testLinkSignals(self):
+        """ both sides of the link in one trace, already traced aliased """
+        script = self.path("inverter.py")
+        with open(script, "w") as f:
+            f.write(_cosim_inverter)
+        a = Signal(bool(0))
+        y = Signal(bool(0))
+        cosim = Cosimulation("%s %s" % (sys.executable, script), a=a, y=y)
+        tracer = signal_monitor()
+        tracer.add_trace_signal(a, "stimulus")
+        self.assertEqual(tracer.add_trace_cosimulation(cosim, "ghdl"), 1)
+        @always(delay(10))
+        def stim():
+            a.next = not a
+        path = self.path("cosim")
+        gens = tracer.traceConfig(40, path, timescale="1ps")
+        Simulation([cosim, stim] + gens).run(40, quiet=1)
+        vcd = vcd_body(path + ".vcd")
+        self.assertTrue("$timescale\n    1ps\n$end" in vcd)
+        self.assertTrue("$scope module ghdl $end\n$var reg 1 \" y $end\n"
+            "$var reg 1 ! a $end\n$upscope" in vcd)
+        initial, changes, endtime = vcd_changes(path + ".vcd")
+        self.assertEqual(initial, {"!": "0", '"': "0"})
+        self.assertEqual(changes, [(0, '"', "1"), (10, "!", "1"), (10, '"', "0"), 
+            (20, "!", "0"), (20, '"', "1"), (30, "!", "1"), (30, '"', "0")])
+
+class TestTraceQueries(TempDirCase):
+
+    def setUp(self):
+        TempDirCase.setUp(self)
+        self.clk = Signal(bool(0))
+        self.data = Signal(intbv(0, min=-8, max=8))
+        self.store = trace_store()
+        self.store.add_signal("clk", self.clk)
+        self.store.add_signal("data", self.data)
+        self.store.start(0, {"clk": self.clk, "data": self.data})
+        rec_clk = self.store.recorder(0)
+        rec_data = self.store.recorder(1)
+        # clock period 10, data changes on negedge
+        for t in range(5, 100, 5):
+            rec_clk(t, (t // 5) % 2)
+            if (t // 5) % 2 == 0:
+                rec_data(t, (t // 10) - 5)
+        self.store.endtime = 100
+
+    @unittest.skipIf(numpy is None, "numpy not available")
+    def testArrays(self):
+        times, values = self.store.arrays("data", 22, 45)
+        self.assertEqual(list(times), [22, 30, 40])
+        self.assertEqual(list(values), [-3, -2, -1])
+        times, values = self.store.arrays("data", 22, 45, initial=False)
+        self.assertEqual(list(times), [30, 40])
+        self.assertEqual(list(self.store.values_at("data", [0, 10, 15, 99])), [0, -4, -4, 4])
+
+    @unittest.skipIf(numpy is None, "numpy not available")
+    def testEdges(self):
+        self.assertEqual(list(self.store.edges("clk", 0, 30, "posedge")), [5, 15, 25])
+        self.assertEqual(list(self.store.edges("clk", 0, 30, "negedge")), [10, 20])
+        self.assertEqual(self.store.toggle_count("clk", 0, 30), 5)
+        self.assertAlmostEqual(self.store.duty_cycle("clk"), 0.5)
+        self.assertAlmostEqual(self.store.duty_cycle("clk", 5, 12), 5.0 / 7)
+
+    def testObjectValues(self):
+        """ unbounded intbv values are copied, not referenced """
+        count = Signal(intbv(0))
+        tracer = signal_monitor()
+        tracer.add_trace_signal(count, "count")
+        @always(delay(5))
+        def gen():
+            count.next = count + 1
+        gens = tracer.traceConfig(None, self.path("count"), keep_deltas=True)
+        Simulation([gen] + gens).run(20, quiet=1)
+        store = tracer.stop_session()
+        self.assertEqual(store.changes("count"), [(0, 0), (5, 1), (10, 2), (15, 3), (20, 4)])
+
+
+class TestActivityStats(TempDirCase):
+
+    def testBitToggles(self):
+        """ per bit rise and fall counts match a bit by bit count """
+        nbits = 12
+        sig = Signal(intbv(5)[nbits:])
+        stats = activity_stats()
+        stats.add_signal("data", sig)
+        record = stats.recorder(0)
+        rises = [0] * nbits
+        falls = [0] * nbits
+        prev = 5
+        values = [random.randrange(2**nbits) for i in range(500)]
+        for t, v in enumerate(values):
+            record(t, v)
+            for b in range(nbits):
+                if (prev >> b) & 1 != (v >> b) & 1:
+                    if (v >> b) & 1:
+                        rises[b] += 1
+                    else:
+                        falls[b] += 1
+            prev = v
+        self.assertEqual(stats.bit_toggles("data"), (rises, falls))
+        report = stats.report()["data"]
+        changes = [t for t, (a, b) in enumerate(zip([5] + values, values)) if a != b]
+        self.assertEqual(report["toggles"], len(changes))
+        self.assertEqual(report["first_change"], changes[0])
+        self.assertEqual(report["last_change"], changes[-1])
+
+    def testActiveCycles(self):
+        """ active cycles counted on clock rising edges """
+        clk = Signal(bool(0))
+        data = Signal(intbv(0)[4:])
+        stats = activity_stats(clock="clk")
+        stats.add_signal("clk", clk)
+        stats.add_signal("data", data)
+        rec_clk = stats.recorder(0)
+        rec_data = stats.recorder(1)
+        for cycle in range(10):
+            rec_clk(cycle * 10, 1)
+            if cycle % 2:
+                rec_data(cycle * 10 + 1, cycle)
+                rec_data(cycle * 10 + 2, 0)
+            rec_clk(cycle * 10 + 5, 0)
+        self.assertEqual(stats.cycles, 10)
+        report = stats.report()["data"]
+        self.assertEqual(report["active_cycles"], 5)
+        self.assertEqual(report["toggles"], 10)
+        self.assertAlmostEqual(report["active_ratio"], 0.5)
+
+
+    def testOpenEnded(self):
+        """ statistics written by close() without sim_max_time """
+        tracer = self.trace("stats", 100, None, trace_format="stats", stats_clock="clk")
+        tracer.close()
+        report = json.load(open(self.path("stats.json")))
+        self.assertEqual((report["endtime"], report["cycles"]), (100, 10))
+        self.assertEqual(report["signals"]["data"]["toggles"], 10)
+
+class TestDeltaFilter(TestCase):
+
+    def testCollapse(self):
+        """ changes in one timestep collapse to the final value """
+        sig = Signal(intbv(0)[8:])
+        records = []
+        filt = _delta_filter()
+        record = filt.wrap(lambda t, v: records.append((t, v)), sig)
+        # glitch back to the recorded value: dropped
+        record(5, 3)
+        record(5, 0)
+        # several deltas: final value only
+        record(10, 1)
+        record(10, 2)
+        record(10, 7)
+        # in place intbv changes are copied
+        value = intbv(9)[8:]
+        record(20, value)
+        value[:] = 0
+        filt.flush()
+        self.assertEqual(records, [(10, 7), (20, 9)])
+
+class TestCapture(TempDirCase):
+
+    def run_capture(self, **kwargs):
+        """ 
+        Counter a incremented on clk rising edges, b follows a one delta 
+        later. Returns (VCD value changes, trace_store)
+        """
+        clk = Signal(bool(0))
+        a = Signal(intbv(0)[4:])
+        b = Signal(intbv(0)[4:])
+        @always(delay(5))
+        def clkgen():
+            clk.next = not clk
+        @always(clk.posedge)
+        def counter():
+            a.next = (a + 1) % 16
+        @always(a)
+        def follow():
+            b.next = a
+        tracer = signal_monitor()
+        for sig, name in ((clk, "clk"), (a, "a"), (b, "b")):
+            tracer.add_trace_signal(sig, name)
+        basename = self.path("capture")
+        gens = tracer.traceConfig(100, basename, **kwargs)
+        Simulation([clkgen, counter, follow] + gens).run(100, quiet=1)
+        vcd = open(basename + ".vcd").read()
+        return vcd[vcd.index("$end\n#") + 5:], tracer.traceinfo
+
+    def testWindows(self):
+        """ changes in windows only, with a snapshot at each window start """
+        # same trace with or without delta cycles, in memory or streaming.
+        # Second window starts between changes
+        for keep_deltas, streaming in ((True, False), (False, False), (False, True)):
+            vcd, store = self.run_capture(windows=[(50, 70), (83, 90)], 
+                keep_deltas=keep_deltas, streaming=streaming)
+            self.assertEqual(vcd, "#50\nb101 \"\nb101 #\n"
+                "#55\n1!\nb110 \"\nb110 #\n#60\n0!\n#65\n1!\nb111 \"\nb111 #\n"
+                "#83\n0!\nb1000 \"\nb1000 #\n#85\n1!\nb1001 \"\nb1001 #\n"
+                "$vcdclose #100 $end\n")
+
+    def testTriggerConditions(self):
+        """ recording starts at the first change that meets the condition """
+        for trigger, start in ((("clk", "posedge"), 5), (("clk", "negedge"), 10), 
+                               (("b", "change"), 5), (("a", 3), 25)):
+            vcd, store = self.run_capture(trigger=trigger, keep_deltas=True)
+            changes = list(store.iter_changes())
+            self.assertEqual(changes[0][0], start, trigger)
+            self.assertEqual(changes[-1][0], 95, trigger)
+
+    def testPretrigger(self):
+        """ last changes before the trigger, recording time after it """
+        for keep_deltas, streaming in ((True, False), (False, False), (False, True)):
+            vcd, store = self.run_capture(trigger=("a", 3), pretrigger=3, posttrigger=30, 
+                keep_deltas=keep_deltas, streaming=streaming)
+            # buffer: b at 15, clk at 20, clk at 25. Snapshot at 15
+            self.assertEqual(vcd, "#15\n1!\nb10 \"\nb10 #\n#20\n0!\n#25\n1!\nb11 \"\nb11 #\n"
+                "#30\n0!\n#35\n1!\nb100 \"\nb100 #\n#40\n0!\n#45\n1!\nb101 \"\nb101 #\n"
+                "#50\n0!\n$vcdclose #100 $end\n")
+
+    def testTriggerSnapshot(self):
+        """ snapshot with the values at the end of the trigger timestep """
+        # b still has the previous value when a changes
+        for keep_deltas in (True, False):
+            vcd, store = self.run_capture(trigger=("a", 3), keep_deltas=keep_deltas)
+            self.assertTrue(vcd.startswith("#25\nb11 \"\nb11 #\n1!\n#30\n"), vcd)
+
+class TestSessions(TempDirCase):
+
+    def testSeveralRuns(self):
+        """ one registration, one output and data release for each run """
+        clk = Signal(bool(0))
+        count = Signal(intbv(0)[8:])
+        def clkgen():
+            @always(delay(5))
+            def gen():
+                clk.next = not clk
+                if not clk:
+                    count.next = (count + 1) % 256
+            return gen
+        tracer = signal_monitor()
+        tracer.add_trace_signal(clk, "clk")
+        tracer.add_trace_signal(count, "count")
+        basename = self.path("run_%d")
+        for duration in (50, 100):
+            gens = tracer.start_session(None, basename)
+            Simulation([clkgen()] + gens).run(duration, quiet=1)
+            store = tracer.stop_session()
+            self.assertEqual(store.endtime, duration)
+            # initial value and one change every 5 time units
+            self.assertEqual(len(store.changes("clk")), duration // 5 + 1)
+            self.assertEqual(tracer.traceinfo, {})
+        self.assertEqual(tracer.session_count, 2)
+        for n, duration in ((1, 50), (2, 100)):
+            vcd = open(basename % n + ".vcd").read()
+            self.assertTrue(vcd.endswith("$vcdclose #%d $end\n" % duration))
+
+    def testLiteralPercent(self):
+        """ only "%d" in the basename is replaced """
+        tracer = self.trace("run_50%", sim_max_time=None)
+        tracer.stop_session()
+        tracer.start_session(None, self.path("run_%d_50%"))
+        tracer.stop_session()
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["run_1_50%.vcd", "run_50%.vcd"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Tests for vcd_tools
+
+import sys
+sys.path.append("..")
+
+import unittest
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from myhdl import Signal, intbv, always, delay, Simulation
+
+from signal_monitor import signal_monitor, vcd_chunks
+from vcd_tools import vcd_reader, vcd_writer, extract_vcd, split_vcd_scopes, \
+                      split_vcd_time, merge_vcd, parse_timescale
+
+def make_trace(path, timescale="1ns", period=5, duration=200):
+    """ VCD trace with a top level clock and two scopes """
+    clk = Signal(bool(0))
+    pc = Signal(intbv(0)[8:])
+    addr = Signal(intbv(0)[8:])
+    data = Signal(intbv(0)[16:])
+    @always(delay(period))
+    def gen():
+        clk.next = not clk
+        if clk:
+            pc.next = (pc + 3) % 256
+            if pc % 2:
+                addr.next = (addr + 5) % 256
+                data.next = (data * 7 + 1) % 2**16
+    tracer = signal_monitor()
+    tracer.add_trace_signal(clk, "clk")
+    tracer.add_trace_signal(pc, "pc", "cpu")
+    tracer.add_trace_signal([addr, data], ["addr", "data"], "mem")
+    gens = tracer.traceConfig(duration, os.path.splitext(path)[0], timescale=timescale)
+    Simulation([gen] + gens).run(duration, quiet=1)
+
+def named_changes(path):
+    """
+    Changes in a VCD file by hierarchical name: returns (list of (time,
+    name, value), end time, reader)
+    """
+    reader = vcd_reader(path)
+    names = {}
+    for scopepath, scopevars in reader.scopes:
+        for varname, ref, width, vartype in scopevars:
+            names.setdefault(ref, []).append(".".join(scopepath + (varname,)))
+    changes = []
+    for curtime, ref, value in reader.iter_changes():
+        for name in names[ref]:
+            changes.append((curtime, name, value))
+    return changes, reader.endtime, reader
+
+class TempDirCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.trace = self.path("trace.vcd")
+        make_trace(self.trace)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+class TestReaderWriter(TempDirCase):
+
+    def testRoundTrip(self):
+        """ a trace written again has the same header and changes """
+        reader = vcd_reader(self.trace)
+        self.assertEqual(reader.timescale, "1ns")
+        self.assertEqual(sorted((p, [v[0] for v in vs]) for p, vs in reader.scopes),
+            [(("signal_monitor",), ["clk"]), (("signal_monitor", "cpu"), ["pc"]),
+             (("signal_monitor", "mem"), ["addr", "data"])])
+        writer = vcd_writer(self.path("copy.vcd"), reader.scopes, reader.timescale, reader.date)
+        for curtime, ref, value in reader.iter_changes():
+            writer.change(curtime, ref, value)
+        writer.close(reader.endtime)
+        self.assertEqual(reader.endtime, 200)
+        self.assertEqual(named_changes(self.path("copy.vcd"))[:2], named_changes(self.trace)[:2])
+        copy = vcd_reader(self.path("copy.vcd"))
+        self.assertEqual(copy.scopes, reader.scopes)
+        self.assertEqual(copy.date, reader.date)
+
+    def testTimescale(self):
+        self.assertEqual(parse_timescale("10 ns"), 10**7)
+        self.assertEqual(parse_timescale("1ps"), 1000)
+        self.assertRaises(ValueError, parse_timescale, "1 parsec")
+
+class TestExtractSplit(TempDirCase):
+
+    def testExtract(self):
+        """ only matching variables, with all their changes """
+        self.assertEqual(extract_vcd(self.trace, self.path("mem.vcd"), ["*.mem.*", "*.clk"]), 3)
+        changes, endtime, reader = named_changes(self.trace)
+        expected = [c for c in changes if c[1] != "signal_monitor.cpu.pc"]
+        self.assertEqual(named_changes(self.path("mem.vcd"))[:2], (expected, endtime))
+
+    def testSplitScopes(self):
+        """ one file for each scope at a depth """
+        outputs = split_vcd_scopes(self.trace, self.path("part_%s.vcd"), depth=2)
+        self.assertEqual(sorted(os.path.basename(p) for p in outputs),
+            ["part_signal_monitor.cpu.vcd", "part_signal_monitor.mem.vcd"])
+        changes, endtime, reader = named_changes(self.trace)
+        for path, scope in zip(sorted(outputs), ("cpu", "mem")):
+            prefix = "signal_monitor.%s." % scope
+            self.assertEqual(named_changes(path)[:2],
+                ([c for c in changes if c[1].startswith(prefix)], endtime))
+
+    def testSplitTime(self):
+        """ chunks with a snapshot of all values at their start """
+        outputs = split_vcd_time(self.trace, step=60)
+        chunks = vcd_chunks(self.path("trace.index.json"))
+        self.assertEqual([(os.path.basename(p), s, e) for p, s, e in chunks],
+            [("trace.%04d.vcd" % n, n * 60, min((n + 1) * 60, 200)) for n in range(4)])
+        self.assertEqual(outputs, [p for p, s, e in chunks])
+        changes, endtime, reader = named_changes(self.trace)
+        for path, start, end in chunks:
+            values = {}
+            for curtime, name, value in changes:
+                if curtime < start:
+                    values[name] = value
+            chunk_changes = named_changes(path)[0]
+            if start > 0:
+                # snapshot
+                snapshot = [c for c in chunk_changes if c[0] == start][:len(values)]
+                self.assertEqual(dict((n, v) for t, n, v in snapshot), values)
+                chunk_changes = chunk_changes[len(values):]
+            self.assertEqual(chunk_changes, [c for c in changes if start <= c[0] < end])
+
+class TestMerge(TempDirCase):
+
+    def testScales(self):
+        """ inputs in their own scopes, time in the finest timescale """
+        make_trace(self.path("fast.vcd"), "100ps", period=3, duration=500)
+        merge_vcd([self.trace, self.path("fast.vcd")], self.path("all.vcd"))
+        changes, endtime, reader = named_changes(self.path("all.vcd"))
+        self.assertEqual(reader.timescale, "100ps")
+        self.assertEqual(endtime, 2000)
+        self.assertEqual([t for t, n, v in changes], sorted(t for t, n, v in changes))
+        expected = [(t * 10, "trace." + n, v) for t, n, v in named_changes(self.trace)[0]]
+        self.assertEqual([c for c in changes if c[1].startswith("trace.")], expected)
+        expected = [("fast." + n, v) for t, n, v in named_changes(self.path("fast.vcd"))[0]]
+        self.assertEqual([(n, v) for t, n, v in changes if n.startswith("fast.")], expected)
+
+    def testFanin(self):
+        """ merge in several steps, same result """
+        inputs = [self.trace]
+        for n in range(4):
+            inputs.append(self.path("t%d.vcd" % n))
+            shutil.copy(self.trace, inputs[-1])
+        merge_vcd(inputs, self.path("direct.vcd"))
+        merge_vcd(inputs, self.path("steps.vcd"), fanin=2, processes=2)
+        self.assertEqual(named_changes(self.path("steps.vcd"))[:2],
+                         named_changes(self.path("direct.vcd"))[:2])
+
+    def testDuplicates(self):
+        """ a variable declared in several inputs can't be merged in one scope """
+        self.assertRaises(ValueError, merge_vcd, [self.trace, self.trace],
+            self.path("all.vcd"), scopes="merge")
+
+
+if __name__ == "__main__":
+    unittest.main()
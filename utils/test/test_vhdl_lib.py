@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Tests for vhdl_lib
+
+import sys
+sys.path.append("..")
+
+import unittest
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import json
+import zlib
+import cPickle
+
+from vhdl_lib import vhdl_parser, vhdl_project, vhdl_cache, ParseException
+
+def tokens(content):
+    # str_token objects, with line and column numbers
+    parser = vhdl_parser(content)
+    return parser._token_range(0, len(parser._tokenize()))
+
+class TestTokenizer(TestCase):
+
+    def testLineCol(self):
+        """ line and column numbers of each token """
+        toks = tokens("entity e is\n  port (a : in bit);\nend e;\n")
+        self.assertEqual(toks[4], "(")
+        self.assertEqual(toks[4]._getlinecol(), (2, 8))
+        # same text in a line: its own column
+        self.assertEqual(toks[10]._getlinecol(), (2, 20))
+        self.assertEqual(toks[11]._getlinecol(), (3, 1))
+
+    def testComments(self):
+        """ comments as one token with line end, inline ones flagged """
+        toks = tokens("-- header\n  a : in bit; -- port a\n")
+        self.assertEqual(toks[0], "-- header\n")
+        self.assertEqual(toks[0]._getmeta(), None)
+        self.assertEqual(toks[-1], "-- port a\n")
+        self.assertEqual(toks[-1]._getmeta(), "inline-comment")
+
+    def testLiterals(self):
+        """ string, character, bit string and abstract literals """
+        toks = tokens('x <= "a ""b""" & \'1\' & X"F0" & 16#FF# & 1.5e3;')
+        self.assertEqual(toks[2::2], ['"a ""b"""', "'1'", 'X"F0"', "16#FF#", "1.5e3"])
+
+    def testAttributes(self):
+        """ a quote after a name is an attribute tick """
+        toks = tokens("clk'event and std_logic'('1') /= a'length")
+        self.assertEqual(toks, ["clk", "'", "event", "and", "std_logic", "'",
+            "(", "'1'", ")", "/=", "a", "'", "length"])
+
+    def testOpenString(self):
+        """ unterminated string """
+        self.assertRaises(ParseException, tokens, 'x <= "abc;\n')
+
+_arch_source = """
+entity top is
+    port(clk : in bit; q : out bit_vector(3 downto 0));
+end entity top;
+
+architecture rtl of top is
+    signal a, b : bit := '0'; -- internal
+    function f(x : integer) return integer is
+    begin
+        if x > 0 then
+            return x;
+        end if;
+        return 0;
+    end function f;
+    component sub is
+        port (d : in bit; o : out bit);
+    end component;
+begin
+    u0 : sub port map (d => a, o => b);
+    gen : for i in 1 to 3 generate
+        ui : entity work.sub(beh) port map (q(i-1), q(i));
+        proc : process(clk, a)
+        begin
+            if clk'event and clk = '1' then
+                a <= not a;
+            end if;
+        end process proc;
+    end generate gen;
+end architecture rtl;
+"""
+
+class TestArchitecture(TestCase):
+
+    def setUp(self):
+        parser = vhdl_parser(_arch_source)
+        parser.parse()
+        self.model = parser.model
+
+    def testSignals(self):
+        """ signal declarations, with default value and description """
+        signals = list(self.model.get_signals_iter())
+        self.assertEqual([n for n, s in signals], ["a", "b"])
+        self.assertEqual(signals[1][1], {"typedef": "bit", "defvalue": "'0'", 
+            "desc": "-- internal\n"})
+
+    def testInstances(self):
+        """ component and entity instances, named and positional maps """
+        instances = dict(self.model.get_instances_iter())
+        self.assertEqual(sorted(instances), ["gen.ui", "u0"])
+        self.assertEqual(instances["u0"]["kind"], "component")
+        self.assertEqual(instances["u0"]["port_map"].items(), [("d", "a"), ("o", "b")])
+        ui = instances["gen.ui"]
+        self.assertEqual((ui["kind"], ui["library"], ui["unit"], ui["architecture"]), 
+            ("entity", "work", "sub", "beh"))
+        self.assertEqual(ui["port_map"].items(), [(0, "q(i-1)"), (1, "q(i)")])
+
+    def testProcesses(self):
+        """ process label, sensitivity list and source lines """
+        self.assertEqual(self.model.get_processes(), [{"label": "gen.proc", 
+            "sensitivity": ["clk", "a"], "lines": (22, 27)}])
+        self.assertEqual(self.model.get_architecture_name(), "rtl")
+
+    def testTruncated(self):
+        """ units cut before their end """
+        for source in ("configuration c of e is for rtl end for;",
+                       "package p is constant c : bit := '0'; end",
+                       "architecture rtl of top is begin end rtl",
+                       "entity top is end"):
+            self.assertRaises(ParseException, vhdl_parser(source).parse)
+
+_project_sources = {
+    "pck_types.vhd": """
+package pck_types is
+    function inv(x : bit) return bit;
+end package pck_types;
+package body pck_types is
+    function inv(x : bit) return bit is
+    begin
+        return not x;
+    end function inv;
+end package body pck_types;
+""",
+    "top.vhd": """
+use work.pck_types.all;
+entity top is
+    port(a : in bit; b : out bit);
+end entity top;
+architecture rtl of top is
+begin
+    u0 : entity work.leaf port map (a => a, b => b);
+end architecture rtl;
+""",
+    "leaf.vhd": """
+use work.pck_types.all;
+entity leaf is
+    port(a : in bit; b : out bit);
+end entity leaf;
+architecture rtl of leaf is
+begin
+    b <= inv(a);
+end architecture rtl;
+""",
+    "other.vhd": """
+entity other is
+end entity other;
+""",
+}
+
+class TestProject(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, content in _project_sources.iteritems():
+            with open(os.path.join(self.tmpdir, name), "w") as f:
+                f.write(content)
+        self.project = vhdl_project(os.path.join(self.tmpdir, "*.vhd"))
+        self.project.parse(processes=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def names(self, paths):
+        return [os.path.basename(p) for p in paths]
+
+    def testIndexes(self):
+        """ entities, architectures and packages by name """
+        self.assertEqual(sorted(self.project.entities), ["leaf", "other", "top"])
+        self.assertEqual(sorted(self.project.architectures), [("leaf", "rtl"), ("top", "rtl")])
+        self.assertEqual(self.names(self.project.packages.values()), ["pck_types.vhd"])
+        self.assertEqual(self.project.get_entity("LEAF").get_entity_name(), "leaf")
+
+    def testCompileOrder(self):
+        """ files after its dependencies, only needed ones for a top """
+        self.assertEqual(self.names(self.project.compile_order()), 
+            ["other.vhd", "pck_types.vhd", "leaf.vhd", "top.vhd"])
+        self.assertEqual(self.names(self.project.compile_order("top")), 
+            ["pck_types.vhd", "leaf.vhd", "top.vhd"])
+
+    def testCycle(self):
+        """ circular dependencies """
+        with open(os.path.join(self.tmpdir, "pck_types.vhd"), "a") as f:
+            f.write("use work.top;\n")
+        project = vhdl_project(os.path.join(self.tmpdir, "*.vhd"))
+        project.parse(processes=1)
+        self.assertRaises(ValueError, project.compile_order)
+
+    def testSplitUnits(self):
+        """ architectures and package bodies in their own files """
+        for name in ("leaf.vhd", "pck_types.vhd"):
+            os.remove(os.path.join(self.tmpdir, name))
+        source = _project_sources["leaf.vhd"]
+        split = source.index("architecture")
+        pck = _project_sources["pck_types.vhd"]
+        body = pck.index("package body")
+        for name, content in (("e_leaf.vhd", source[:split]), ("a_leaf.vhd", source[split:]),
+                              ("pck_types.vhd", pck[:body]), ("pck_body.vhd", pck[body:])):
+            with open(os.path.join(self.tmpdir, name), "w") as f:
+                f.write(content)
+        project = vhdl_project(os.path.join(self.tmpdir, "*.vhd"))
+        project.parse(processes=1)
+        self.assertEqual(self.names(project.compile_order("top")), 
+            ["pck_types.vhd", "e_leaf.vhd", "a_leaf.vhd", "pck_body.vhd", "top.vhd"])
+
+    def testErrors(self):
+        """ parse errors and duplicate units kept as file errors """
+        sources = {"truncated.vhd": "configuration c of leaf is for rtl end for;\n",
+                   "twice.vhd": "entity leaf is\nend entity leaf;\n"}
+        for name, content in sources.iteritems():
+            with open(os.path.join(self.tmpdir, name), "w") as f:
+                f.write(content)
+        project = vhdl_project(os.path.join(self.tmpdir, "*.vhd"))
+        self.assertRaises(ParseException, project.parse, processes=1)
+        project = vhdl_project(os.path.join(self.tmpdir, "*.vhd"))
+        project.parse(processes=1, ignore_errors=True)
+        self.assertEqual(self.names(project.errors), ["truncated.vhd", "twice.vhd"])
+        self.assertTrue("Duplicate entity 'leaf'" in project.errors[os.path.join(self.tmpdir, "twice.vhd")])
+        self.assertEqual(self.names([project.entities["leaf"][0]]), ["leaf.vhd"])
+        os.remove(os.path.join(self.tmpdir, "truncated.vhd"))
+        project = vhdl_project(os.path.join(self.tmpdir, "*.vhd"))
+        self.assertRaises(ValueError, project.parse, processes=1)
+
+class TestCache(TestCase):
+
+    def setUp(self):
+        self.cache = vhdl_cache(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.cache.path)
+
+    def testHit(self):
+        """ second parse of same content loaded from cache """
+        vhdl_parser(_arch_source).parse(self.cache)
+        parser = vhdl_parser(_arch_source)
+        def no_tokenize():
+            raise AssertionError("content parsed again")
+        parser._tokenize = no_tokenize
+        parser.parse(self.cache)
+        self.assertEqual(parser.model.get_entity_name(), "top")
+        self.assertEqual([n for n, s in parser.model.get_signals_iter()], ["a", "b"])
+        self.assertEqual(parser.model.get_processes()[0]["sensitivity"], ["clk", "a"])
+        # same data and container types
+        parsed = vhdl_parser(_arch_source)
+        parsed.parse()
+        self.assertEqual(parser.model.__dict__, parsed.model.__dict__)
+        self.assertEqual(parser.model.get_processes()[0]["lines"], (22, 27))
+        ports = dict(parser.model.get_instances_iter())["gen.ui"]["port_map"]
+        self.assertEqual(ports.items(), [(0, "q(i-1)"), (1, "q(i)")])
+
+    def testDataOnly(self):
+        """ entries are JSON data, pickled entries are not loaded """
+        vhdl_parser(_arch_source).parse(self.cache)
+        name = os.listdir(self.cache.path)[0]
+        path = os.path.join(self.cache.path, name)
+        json.loads(zlib.decompress(open(path, "rb").read()))
+        with open(path, "wb") as f:
+            f.write(zlib.compress(cPickle.dumps(([{}], 0))))
+        self.assertEqual(self.cache.load(_arch_source), None)
+
+    def testStoreErrors(self):
+        """ a parse succeeds when the cache can't be written """
+        path = os.path.join(self.cache.path, "file")
+        open(path, "w").close()
+        parser = vhdl_parser(_arch_source)
+        parser.parse(path)
+        self.assertEqual(parser.model.get_entity_name(), "top")
+
+    def testMiss(self):
+        """ changed content and corrupt entries parsed again """
+        vhdl_parser(_arch_source).parse(self.cache)
+        source = _arch_source.replace("rtl", "beh")
+        self.assertEqual(self.cache.load(source), None)
+        parser = vhdl_parser(source)
+        parser.parse(self.cache)
+        self.assertEqual(parser.model.get_architecture_name(), "beh")
+        for name in os.listdir(self.cache.path):
+            with open(os.path.join(self.cache.path, name), "wb") as f:
+                f.write("garbage")
+        self.assertEqual(self.cache.load(source), None)
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.cache.path), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# vcd_tools: merge, split and extract VCD traces
+#
+# Author:  Oscar Diaz <oscar.dc0@gmail.com>
+# Version: 0.1
+# Date:    18-10-2026
+#
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this package; if not, see
+# <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+import json
+import time
+import heapq
+import fnmatch
+import tempfile
+import shutil
+import multiprocessing
+from collections import OrderedDict
+
+from signal_monitor import signal_monitor, vcd_identifiers
+
+"""
+vcd_tools: merge, split and extract VCD traces (e.g. from signal_monitor)
+
+All operations stream the input files: memory use depends on the number of
+signals, not on trace length. Independent files are processed in parallel
+with multiprocessing.
+
+Usage example:
+
+# merge traces, each one in a scope named after its file
+merge_vcd(["test1.vcd", "test2.vcd"], "all.vcd", processes=4)
+
+# split by time: "trace.0000.vcd", ... and "trace.index.json" (see
+# signal_monitor.vcd_chunks)
+split_vcd_time("trace.vcd", step=100000)
+
+# split by scope: one file for each top level scope
+split_vcd_scopes("trace.vcd", "trace_%s.vcd")
+
+# subset of signals (glob patterns on hierarchical names)
+extract_vcd("trace.vcd", "cpu.vcd", ["*.cpu.*"])
+
+# same operation on many files
+process_files(extract_vcd, [(path, path + ".cpu", ["*.cpu.*"]) for path in paths])
+
+Command line: python vcd_tools.py {merge,split-time,split-scopes,extract} -h
+"""
+
+# timescale units in femtoseconds
+_time_units = {"s": 10**15, "ms": 10**12, "us": 10**9, "ns": 10**6, "ps": 10**3, "fs": 1}
+
+def parse_timescale(timescale):
+    """
+    Returns: timescale (e.g. "10 ns") in femtoseconds
+    """
+    m = re.match(r"^\s*(\d+)\s*([a-z]+)\s*$", timescale)
+    if m is None or m.group(2) not in _time_units:
+        raise ValueError("Invalid timescale '%s'." % timescale)
+    return int(m.group(1)) * _time_units[m.group(2)]
+
+def _format_timescale(fs):
+    for unit in ("s", "ms", "us", "ns", "ps", "fs"):
+        if fs % _time_units[unit] == 0:
+            return "%d%s" % (fs // _time_units[unit], unit)
+
+class vcd_reader(object):
+    """
+    Streaming VCD reader
+
+    Attributes (from header):
+    * date, version, timescale: header sections
+    * scopes: list of (scope path, [(var name, ref, width, var type), ...])
+      in declaration order. A ref can be declared in several scopes
+    * endtime: "$vcdclose" time, after iter_changes() ends (or None)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.date = ""
+        self.version = ""
+        self.timescale = "1ns"
+        self.scopes = []
+        self.endtime = None
+        self._file = open(path)
+        self._tokens = self._iter_tokens()
+        self._read_header()
+
+    def _iter_tokens(self):
+        for line in self._file:
+            for token in line.split():
+                yield token
+
+    def _section(self):
+        # tokens until $end
+        retval = []
+        for token in self._tokens:
+            if token == "$end":
+                break
+            retval.append(token)
+        return retval
+
+    def _read_header(self):
+        path = []
+        scopevars = {}
+        for token in self._tokens:
+            if token == "$scope":
+                path.append(self._section()[-1])
+            elif token == "$upscope":
+                self._section()
+                path.pop()
+            elif token == "$var":
+                decl = self._section()
+                key = tuple(path)
+                if key not in scopevars:
+                    scopevars[key] = []
+                    self.scopes.append((key, scopevars[key]))
+                scopevars[key].append((" ".join(decl[3:]), decl[2], int(decl[1]), decl[0]))
+            elif token == "$timescale":
+                self.timescale = "".join(self._section())
+            elif token == "$date":
+                self.date = " ".join(self._section())
+            elif token == "$version":
+                self.version = " ".join(self._section())
+            elif token == "$enddefinitions":
+                self._section()
+                return
+            elif token.startswith("$"):
+                self._section()
+        raise ValueError("'%s': VCD header without $enddefinitions." % self.path)
+
+    def iter_changes(self):
+        """
+        Iterate over value changes as (time, ref, value). Value is the VCD
+        text before the ref: "1" for scalars, "b101 " for vectors. Initial
+        values ($dumpvars) are changes at their timestamp (0 if none).
+        """
+        curtime = 0
+        tokens = self._tokens
+        for token in tokens:
+            first = token[0]
+            if first == "#":
+                curtime = int(token[1:])
+            elif first in "bBrRsS":
+                yield curtime, next(tokens), token + " "
+            elif first == "$":
+                if token == "$vcdclose":
+                    section = self._section()
+                    if len(section) > 0 and section[0].startswith("#"):
+                        self.endtime = int(section[0][1:])
+                elif token == "$comment":
+                    self._section()
+                # $dumpvars, $end and similar: values follow
+            else:
+                yield curtime, token[1:], first
+        self._file.close()
+
+    def close(self):
+        self._file.close()
+
+class vcd_writer(object):
+    """
+    Streaming VCD writer
+
+    Arguments:
+    * path: output file
+    * scopes: list of (scope path, [(var name, key, width, var type), ...]).
+      Each distinct key gets a VCD identifier code; changes refer to keys
+    * timescale: timescale string
+    """
+    def __init__(self, path, scopes, timescale="1ns", date=None, bufsize=1<<16):
+        self.path = path
+        self.refs = OrderedDict()
+        for scopepath, scopevars in scopes:
+            for varname, key, width, vartype in scopevars:
+                self.refs.setdefault(key)
+        for key, ref in zip(self.refs, vcd_identifiers(len(self.refs))):
+            self.refs[key] = ref
+        vcdgen = signal_monitor()
+        refs = self.refs
+        def var_decl(varname, key):
+            return vcdgen._vcd_section("var", "%s %d %s %s" % (decls[key][1], decls[key][0], refs[key], varname))
+        decls = {}
+        declscopes = []
+        for scopepath, scopevars in scopes:
+            declscopes.append((scopepath, [(varname, key) for varname, key, width, vartype in scopevars]))
+            for varname, key, width, vartype in scopevars:
+                decls[key] = (width, vartype)
+        self.file = open(path, "w", bufsize)
+        self.file.write(vcdgen._vcd_section("date", date or time.asctime(), True, True))
+        self.file.write(vcdgen._vcd_section("version", "NoCmodel 0.1 (TEMP)", True, True))
+        self.file.write(vcdgen._vcd_section("timescale", timescale, True, True))
+        self.file.write("\n")
+        self.file.write(vcdgen._vcd_scope_decls(declscopes, var_decl))
+        self.file.write(vcdgen._vcd_section("enddefinitions", ""))
+        self.curtime = None
+        self.lasttime = None
+
+    def dumpvars(self, curtime, values):
+        """
+        Write a $dumpvars section at curtime. values: key -> value
+        """
+        refs = self.refs
+        self.file.write("#%d\n$dumpvars\n" % curtime)
+        self.file.write("".join("%s%s\n" % (value, refs[key]) for key, value in values.iteritems() if key in refs))
+        self.file.write("$end\n")
+        self.curtime = curtime
+
+    def change(self, curtime, key, value):
+        if curtime != self.curtime:
+            self.file.write("#%d\n" % curtime)
+            self.curtime = curtime
+        self.file.write("%s%s\n" % (value, self.refs[key]))
+
+    def close(self, endtime=None):
+        if endtime is None:
+            endtime = self.curtime
+        if endtime is not None:
+            self.file.write("$vcdclose #%d $end\n" % endtime)
+        self.file.close()
+
+def _match_function(patterns):
+    # hierarchical name filter from glob patterns
+    if patterns is None:
+        return lambda name: True
+    regex = re.compile("|".join("(?:%s)" % fnmatch.translate(p) for p in patterns))
+    return lambda name: regex.match(name) is not None
+
+def extract_vcd(path, output, patterns):
+    """
+    Write a VCD with a subset of signals
+
+    Arguments:
+    * path: input VCD
+    * output: output VCD
+    * patterns: glob patterns on hierarchical names ("scope.sub.var")
+
+    Returns: number of selected variables
+    """
+    match = _match_function(patterns)
+    reader = vcd_reader(path)
+    scopes = []
+    count = 0
+    for scopepath, scopevars in reader.scopes:
+        prefix = "".join(s + "." for s in scopepath)
+        selected = [v for v in scopevars if match(prefix + v[0])]
+        if len(selected) > 0:
+            scopes.append((scopepath, selected))
+            count += len(selected)
+    writer = vcd_writer(output, scopes, reader.timescale, reader.date)
+    refs = writer.refs
+    for curtime, ref, value in reader.iter_changes():
+        if ref in refs:
+            writer.change(curtime, ref, value)
+    writer.close(reader.endtime)
+    return count
+
+def split_vcd_scopes(path, output_format=None, depth=1):
+    """
+    Split a VCD in one file for each scope at depth (1: top level scopes).
+    Variables above depth are not written.
+
+    Arguments:
+    * output_format: output name with "%s" for the scope path (names
+      joined with "."). Default "<root>.%s<ext>"
+
+    Returns: list of output files
+    """
+    if output_format is None:
+        root, ext = os.path.splitext(path)
+        output_format = root + ".%s" + ext
+    reader = vcd_reader(path)
+    groups = OrderedDict()
+    for scopepath, scopevars in reader.scopes:
+        if len(scopepath) >= depth:
+            groups.setdefault(scopepath[:depth], []).append((scopepath, scopevars))
+    writers = []
+    # ref -> writers with that ref
+    by_ref = {}
+    for group, scopes in groups.iteritems():
+        writer = vcd_writer(output_format % ".".join(group), scopes, reader.timescale, reader.date)
+        writers.append(writer)
+        for ref in writer.refs:
+            by_ref.setdefault(ref, []).append(writer)
+    for curtime, ref, value in reader.iter_changes():
+        for writer in by_ref.get(ref, ()):
+            writer.change(curtime, ref, value)
+    for writer in writers:
+        writer.close(reader.endtime)
+    return [writer.path for writer in writers]
+
+def split_vcd_time(path, boundaries=None, step=None, output_format=None):
+    """
+    Split a VCD by time ranges. Each chunk has the full header and a
+    $dumpvars snapshot of all values at its start, and an index file
+    "<root>.index.json" maps time ranges to chunks (see
+    signal_monitor.vcd_chunks)
+
+    Arguments:
+    * boundaries: sorted list of chunk start times (first chunk starts at 0)
+    * step: chunk time span, instead of boundaries
+    * output_format: chunk names with "%d" for the chunk number. Default
+      "<root>.%04d<ext>"
+
+    Returns: list of output files
+    """
+    if (boundaries is None) == (step is None):
+        raise ValueError("Use either boundaries or step.")
+    root, ext = os.path.splitext(path)
+    if output_format is None:
+        output_format = root + ".%04d" + ext
+    reader = vcd_reader(path)
+    # current values, for chunk snapshots
+    values = OrderedDict()
+    for scopepath, scopevars in reader.scopes:
+        for varname, ref, width, vartype in scopevars:
+            values.setdefault(ref, "x" if width == 1 else "bx ")
+    boundaries = list(boundaries) if boundaries is not None else []
+    chunks = []
+    def open_chunk(start):
+        writer = vcd_writer(output_format % len(chunks), reader.scopes, reader.timescale, reader.date)
+        if len(chunks) > 0:
+            writer.dumpvars(start, values)
+        chunks.append([writer.path, start, None])
+        return writer
+    writer = open_chunk(0)
+    nextstart = boundaries.pop(0) if boundaries else step
+    for curtime, ref, value in reader.iter_changes():
+        if nextstart is not None and curtime >= nextstart:
+            # new chunk from the last boundary before curtime, time ranges 
+            # without changes have no chunk
+            if step:
+                start = curtime - curtime % step
+                nextstart = start + step
+            else:
+                start = nextstart
+                while boundaries and boundaries[0] <= curtime:
+                    start = boundaries.pop(0)
+                nextstart = boundaries.pop(0) if boundaries else None
+            writer.close(start)
+            chunks[-1][2] = start
+            writer = open_chunk(start)
+        writer.change(curtime, ref, value)
+        values[ref] = value
+    writer.close(reader.endtime)
+    chunks[-1][2] = reader.endtime if reader.endtime is not None else writer.curtime
+    index = {"version": 1, "chunks": [{"file": os.path.basename(f), "start": start, "end": end}
+                                      for f, start, end in chunks]}
+    with open(root + ".index.json", "w") as indexfile:
+        json.dump(index, indexfile, indent=1)
+    return [f for f, start, end in chunks]
+
+def _merge(inputs, output, prefixes):
+    # merge VCD files. prefixes: scope name for each input, or None
+    readers = [vcd_reader(path) for path in inputs]
+    scales = [parse_timescale(reader.timescale) for reader in readers]
+    outscale = min(scales)
+    factors = []
+    for path, scale in zip(inputs, scales):
+        if scale % outscale != 0:
+            raise ValueError("'%s': timescale not a multiple of %s." % (path, _format_timescale(outscale)))
+        factors.append(scale // outscale)
+    scopes = []
+    declared = set()
+    for index, reader in enumerate(readers):
+        for scopepath, scopevars in reader.scopes:
+            if prefixes is not None:
+                scopepath = (prefixes[index],) + scopepath
+            for varname, ref, width, vartype in scopevars:
+                fullname = scopepath + (varname,)
+                if fullname in declared:
+                    raise ValueError("'%s': variable %s declared in another input." % (inputs[index], ".".join(fullname)))
+                declared.add(fullname)
+            scopes.append((scopepath, [(varname, (index, ref), width, vartype)
+                                      for varname, ref, width, vartype in scopevars]))
+    writer = vcd_writer(output, scopes, _format_timescale(outscale))
+    def changes(index, reader, factor):
+        for curtime, ref, value in reader.iter_changes():
+            yield curtime * factor, index, ref, value
+    streams = [changes(index, reader, factor) for index, (reader, factor) in enumerate(zip(readers, factors))]
+    # changes from different inputs ordered by time, then input order
+    for curtime, index, ref, value in heapq.merge(*streams):
+        writer.change(curtime, (index, ref), value)
+    endtimes = [reader.endtime * factor for reader, factor in zip(readers, factors) if reader.endtime is not None]
+    writer.close(max(endtimes) if endtimes else None)
+    return output
+
+def _scope_names(inputs):
+    # scope name for each input file: file name, made unique
+    names = []
+    for path in inputs:
+        name = re.sub(r"[^\w.]", "_", os.path.splitext(os.path.basename(path))[0])
+        unique = name
+        count = 1
+        while unique in names:
+            unique = "%s_%d" % (name, count)
+            count += 1
+        names.append(unique)
+    return names
+
+def merge_vcd(inputs, output, scopes="file", processes=1, fanin=32):
+    """
+    Merge VCD files in one trace
+
+    Arguments:
+    * inputs: list of VCD files
+    * output: output VCD
+    * scopes: "file" to put each input in a scope named after its file, or
+      "merge" to combine scopes with the same path (variables must not be
+      declared in more than one input)
+    * processes: with more than fanin inputs, groups of fanin files are
+      merged in parallel in temporary files first
+    * fanin: maximum number of files read at once
+
+    Time is written in the finest input timescale.
+    """
+    if scopes not in ("file", "merge"):
+        raise ValueError("Unknown scopes mode '%s'." % scopes)
+    prefixes = _scope_names(inputs) if scopes == "file" else None
+    if len(inputs) <= fanin:
+        return _merge(inputs, output, prefixes)
+    tempdir = tempfile.mkdtemp(prefix="vcd_merge")
+    try:
+        jobs = []
+        for n, start in enumerate(range(0, len(inputs), fanin)):
+            jobs.append((inputs[start:start + fanin], os.path.join(tempdir, "part%d.vcd" % n),
+                         prefixes[start:start + fanin] if prefixes is not None else None))
+        parts = process_files(_merge, jobs, processes)
+        # scopes already prefixed
+        return merge_vcd(parts, output, "merge", processes, fanin)
+    finally:
+        shutil.rmtree(tempdir)
+
+def _call(job):
+    function, args = job
+    return function(*args)
+
+def process_files(function, arglist, processes=None):
+    """
+    Run function(*args) for each args tuple in arglist with a process pool
+    (e.g. extract_vcd on many files).
+
+    Arguments:
+    * function: module level function (must be picklable)
+    * processes: number of processes. None for one for each CPU, 1 to run
+      in this process
+
+    Returns: list of results, in arglist order
+    """
+    jobs = [(function, tuple(args)) for args in arglist]
+    if processes == 1 or len(jobs) <= 1:
+        return [_call(job) for job in jobs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_call, jobs, 1)
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Merge, split and extract VCD traces")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("merge", help="merge VCD files")
+    p.add_argument("output")
+    p.add_argument("inputs", nargs="+")
+    p.add_argument("--scopes", choices=("file", "merge"), default="file")
+    p.add_argument("-j", "--processes", type=int, default=1)
+    p = sub.add_parser("split-time", help="split a VCD by time")
+    p.add_argument("input")
+    p.add_argument("--step", type=int, required=True)
+    p = sub.add_parser("split-scopes", help="split a VCD by scope")
+    p.add_argument("inputs", nargs="+")
+    p.add_argument("--depth", type=int, default=1)
+    p.add_argument("-j", "--processes", type=int, default=None)
+    p = sub.add_parser("extract", help="extract signals (glob patterns) from VCD files")
+    p.add_argument("inputs", nargs="+")
+    p.add_argument("-p", "--pattern", action="append", required=True)
+    p.add_argument("-s", "--suffix", default=".extract", help="output name: <input><suffix>")
+    p.add_argument("-j", "--processes", type=int, default=None)
+    args = parser.parse_args()
+    if args.command == "merge":
+        merge_vcd(args.inputs, args.output, args.scopes, args.processes)
+    elif args.command == "split-time":
+        split_vcd_time(args.input, step=args.step)
+    elif args.command == "split-scopes":
+        process_files(split_vcd_scopes, [(path, None, args.depth) for path in args.inputs], args.processes)
+    else:
+        process_files(extract_vcd, [(path, path + args.suffix, args.pattern) for path in args.inputs], args.processes)
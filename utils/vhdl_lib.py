@@ -6,6 +6,7 @@
 # * Base model for VHDL source files
 # * Parser object
 # * Code generator
+# * Project model: many files, dependencies and compile order
 #
 # Author:  Oscar Diaz <oscar.dc0@gmail.com>
 # Version: 0.1
@@ -31,7 +32,17 @@ import shlex
 import StringIO
 import re
 import os
+import gc
+import glob
+import bisect
+import heapq
+import hashlib
+import tempfile
+import zlib
+import json
+import multiprocessing
 from collections import OrderedDict
+from itertools import chain
 
 _vhdl_validtypes = ["bit", "bit_vector", "boolean", "character", "integer", 
 "natural", "positive", "real", "string", "time", "signed", "unsigned", 
@@ -44,6 +55,25 @@ _vhdl_typesizes = {"bit": 1, "bit_vector": None, "boolean": 1, "character": 8, "
 _vhdl_vector_bases = {"bit_vector": "bit", "std_logic_vector": "std_logic", "signed": "bit", 
 "unsigned": "bit", "string": "character"}
 
+# parser output version, part of vhdl_cache keys. Change it when parsed 
+# models change, to discard old cache entries
+_parser_version = 1
+
+# VHDL lexical elements, in match order (see vhdl_parser._tokenize). Every
+# character except whitespace matches one of them. A "'" after an identifier
+# or ")" is an attribute tick (clk'event, std_logic'('1')), not a character
+# literal. A lone '"' is an unterminated string
+_vhdl_token_re = re.compile(r"""
+    --.*\n?                             # comment, until end of line
+  | [bBoOxX]"[0-9a-zA-Z_]*"             # bit string literal
+  | [^\W\d]\w* | \\[^\\\n]*\\           # basic and extended identifiers
+  | \d[\d_]*(?:\#[\w.]+\#|\.[\d_]+)?(?:[eE][+-]?\d+)?   # abstract literal
+  | "(?:[^"\n]|"")*"                    # string literal
+  | (?<![\w)])'.'                       # character literal
+  | :=|<=|=>|>=|/=|\*\*|<>              # compound delimiters
+  | [^\s\w]                             # delimiters
+""", re.VERBOSE)
+
 class ParseException(Exception):
     def __init__(self, message, token=None):
         super(ParseException, self).__init__(message)
@@ -69,11 +99,11 @@ class str_token(str):
     string object with related line and col numbers
     """
     def __new__(cls, basestr, line=None, col=None, meta=None):
-        return super(str_token, cls).__new__(cls, basestr)
-    def __init__(self, basestr, line=None, col=None, meta=None):
+        self = str.__new__(cls, basestr)
         self._linenum = line
         self._colnum = col
         self._meta = meta
+        return self
     def _getlinecol(self):
         return (self._linenum, self._colnum)
     def _getmeta(self):
@@ -96,8 +126,18 @@ class vhdl_model(object):
         self._ports = OrderedDict()
         self._constants = {}
         self._architecture_name = None
+        self._architecture_entity = None
         self._architecture_body = ""
+        # architecture structure
+        self._signals = OrderedDict()
+        self._instances = OrderedDict()
+        self._processes = []
         self._configuration = None
+        # packages declared in the same file: 
+        # name -> {"declaration": bool, "body": bool}
+        self._packages = OrderedDict()
+        if package_name is not None:
+            self.add_package(package_name)
         
     def add_header(self, header):
         """
@@ -135,11 +175,21 @@ class vhdl_model(object):
         self.add_library("ieee.std_logic_1164.all")
         self.add_library("ieee.numeric_std.all")
     
-    def add_package(self, package):
+    def add_package(self, package, body=False):
         """
-        Packages: Not implemented yet.
+        Package declared in the same file. Only its name is kept, package 
+        declarations are not parsed.
+        
+        Arguments:
+        * package: package name
+        * body: True for a package body
         """
-        raise NotImplementedError("Packages not yet supported.")
+        if package not in self._packages:
+            self._packages[package] = {"declaration": False, "body": False}
+        if body:
+            self._packages[package]["body"] = True
+        else:
+            self._packages[package]["declaration"] = True
         
     def set_entity_name(self, entity_name):
         """
@@ -170,7 +220,11 @@ class vhdl_model(object):
                 # guess type
                 t = self._guess_type(defvalue)
             self._generics[name] = {"typedef": t, "defvalue": defvalue, "desc": description}
-            self._constants[name] = self._const_solve(defvalue)
+            try:
+                self._constants[name] = self._const_solve(defvalue)
+            except (NameError, SyntaxError, TypeError):
+                # VHDL expression (e.g. depends on other generics): keep it
+                self._constants[name] = defvalue
     
     def add_port(self, name, direction, sigtype=None, refvalue=None, description="", **kwargs):
         """
@@ -199,11 +253,50 @@ class vhdl_model(object):
                 t = self._guess_type(refvalue)
             self._ports[name] = {"dir": direction, "typedef": t, "desc": description}
         
-    def set_architecture_name(self, architecture_name):
+    def set_architecture_name(self, architecture_name, entity_name=None):
         self._architecture_name = architecture_name
+        if entity_name is not None:
+            self._architecture_entity = entity_name
     def add_architecture_body(self, body):
         self._architecture_body += body
         
+    def add_signal(self, name, sigtype, defvalue=None, description="", **kwargs):
+        """
+        New/edit architecture signal
+        Each signal is {"typedef", "defvalue", "desc"}. Type is kept as 
+        declared (user defined types are allowed)
+        """
+        self._signals[name] = {"typedef": sigtype, "defvalue": defvalue, "desc": description}
+        
+    def add_instance(self, label, unit, kind="component", library=None, architecture=None, 
+                     generic_map=None, port_map=None):
+        """
+        Component, entity or configuration instantiation in architecture
+        
+        Arguments:
+        * label: instance label. Instances inside blocks and generate 
+          statements are prefixed with its labels ("gen_regs.reg0")
+        * unit: component, entity or configuration name
+        * kind: "component", "entity" or "configuration"
+        * library: library name, if given (entity and configuration)
+        * architecture: architecture name, if given (entity)
+        * generic_map, port_map: OrderedDict formal -> actual. Position 
+          number is used as formal for positional association
+        """
+        if generic_map is None:
+            generic_map = OrderedDict()
+        if port_map is None:
+            port_map = OrderedDict()
+        self._instances[label] = {"unit": unit, "kind": kind, "library": library, 
+            "architecture": architecture, "generic_map": generic_map, "port_map": port_map}
+            
+    def add_process(self, label, sensitivity, lines=None):
+        """
+        Process in architecture: label (None if not labeled), sensitivity 
+        list and (first, last) line numbers in source file
+        """
+        self._processes.append({"label": label, "sensitivity": sensitivity, "lines": lines})
+        
     # ******
     # access to model
     def get_entity_name(self):
@@ -215,6 +308,39 @@ class vhdl_model(object):
     def get_ports_iter(self):
         return self._ports.iteritems()
         
+    def get_architecture_name(self):
+        return self._architecture_name
+        
+    def get_architecture_entity(self):
+        return self._architecture_entity
+        
+    def get_packages_iter(self):
+        return self._packages.iteritems()
+        
+    def get_used_units(self, library="work"):
+        """
+        Names of design units used from a library: use clauses and 
+        instances. Instances without library are included (components and 
+        entities from the working library)
+        """
+        units = OrderedDict()
+        for lib, sublibs in self._library_decl.iteritems():
+            if lib.lower() == library.lower():
+                units.update((x, None) for x in sublibs)
+        for inst in self._instances.itervalues():
+            if inst["library"] is None or inst["library"].lower() == library.lower():
+                units[inst["unit"]] = None
+        return units.keys()
+        
+    def get_signals_iter(self):
+        return self._signals.iteritems()
+        
+    def get_instances_iter(self):
+        return self._instances.iteritems()
+        
+    def get_processes(self):
+        return self._processes
+        
     def get_declared_constants(self):
         return self._constants.iteritems()
         
@@ -249,7 +375,7 @@ class vhdl_model(object):
             retval["left"] = None
             retval["defdir"] = None
             retval["right"] = None
-            retval["bitlen"] = _vhdl_typesizes[retval["base"]]
+            retval["bitlen"] = _vhdl_typesizes.get(retval["base"])
             retval["rawdef"] = retval["base"]
             retval["solveddef"] = retval["base"]
         else:
@@ -277,6 +403,10 @@ class vhdl_model(object):
     def _check_type(self, typestr):
         s = [x.strip() for x in typestr.partition("(")]
         if s[0] not in _vhdl_validtypes:
+            # user defined types (enumerations from packages, etc.) are 
+            # kept by name
+            if s[1] == "" and re.match(r"[a-zA-Z]\w*$", s[0]):
+                return (s[0], )
             raise ValueError("Invalid VHDL type: %s" % typestr)
         if s[1] == "":
             return (s[0], )
@@ -538,6 +668,152 @@ class vhdl_codegen(object):
             retval = ["%s%s" % (pretext, x) for x in it]
             return retval
             
+def read_source(source):
+    """
+    Get VHDL source content
+    
+    Arguments:
+    * source: file path, string content, file object or StringIO object
+    
+    Returns: tuple (filename, StringIO object). filename is None if unknown.
+    
+    Note: paths are opened through open() instead of checking its existence
+    on disk, so files kept in memory by an active open_interceptor object
+    (virtual mode) are also available.
+    """
+    if type(source) == str:
+        if "\n" not in source:
+            try:
+                with open(source) as f:
+                    return source, StringIO.StringIO(f.read())
+            except (IOError, TypeError):
+                pass
+        # assume string content
+        return None, StringIO.StringIO(source)
+    elif type(source) == file:
+        t = source.tell()
+        source.seek(0)
+        content = StringIO.StringIO(source.read())
+        source.seek(t)
+        return source.name, content
+    elif isinstance(source, StringIO.StringIO):
+        return None, source
+    else:
+        raise ValueError("Unable to get any VHDL source with %s" % repr(source))
+
+# cache entries: model data as JSON, containers tagged with their type to
+# keep tuples, OrderedDict order and non string keys
+_cache_types = {"t": tuple, "l": list, "d": dict, "o": OrderedDict}
+
+def _cache_encode(obj):
+    # model data to JSON data. str_token objects as plain strings
+    if isinstance(obj, str):
+        return str(obj)
+    elif obj is None or isinstance(obj, (bool, int, long, float)):
+        return obj
+    elif isinstance(obj, OrderedDict):
+        return ["o", [[_cache_encode(k), _cache_encode(v)] for k, v in obj.iteritems()]]
+    elif isinstance(obj, dict):
+        return ["d", [[_cache_encode(k), _cache_encode(v)] for k, v in obj.iteritems()]]
+    elif isinstance(obj, tuple):
+        return ["t", [_cache_encode(x) for x in obj]]
+    elif isinstance(obj, list):
+        return ["l", [_cache_encode(x) for x in obj]]
+    raise TypeError("Can't store %s in cache." % repr(obj))
+    
+def _cache_decode(data):
+    # JSON data to model data. Raises ValueError on unexpected data
+    if isinstance(data, unicode):
+        return data.encode("latin-1")
+    elif isinstance(data, list):
+        if len(data) != 2 or data[0] not in _cache_types:
+            raise ValueError("Invalid cache data.")
+        kind = _cache_types[data[0]]
+        if kind in (dict, OrderedDict):
+            return kind((_cache_decode(k), _cache_decode(v)) for k, v in data[1])
+        return kind(_cache_decode(x) for x in data[1])
+    elif isinstance(data, dict):
+        raise ValueError("Invalid cache data.")
+    return data
+    
+class vhdl_cache(object):
+    """
+    Persistent cache of parsed models (see vhdl_parser.parse)
+    
+    One file for each source content, named after the SHA1 of parser 
+    version and content. Models are saved as compressed JSON data: loading
+    an entry doesn't run any code, the cache directory can be shared.
+    
+    Arguments:
+    * path: cache directory. Default: VHDL_LIB_CACHE environment variable or
+      ~/.cache/vhdl_lib
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get("VHDL_LIB_CACHE", 
+                os.path.join(os.path.expanduser("~"), ".cache", "vhdl_lib"))
+        self.path = path
+        
+    def _entry_path(self, content):
+        key = hashlib.sha1("%d\n%s" % (_parser_version, content)).hexdigest()
+        return os.path.join(self.path, key + ".jsz")
+        
+    def load(self, content):
+        """
+        Models parsed from content: (list of vhdl_model, current model 
+        index), or None if not in cache
+        """
+        try:
+            with open(self._entry_path(content), "rb") as f:
+                states, current = _cache_decode(json.loads(zlib.decompress(f.read())))
+            models = []
+            for state in states:
+                model = vhdl_model.__new__(vhdl_model)
+                model.__dict__.update(state)
+                models.append(model)
+            if not 0 <= current < len(models):
+                return None
+        except Exception:
+            # missing or unreadable entry
+            return None
+        return models, current
+        
+    def store(self, content, models, current=0):
+        """
+        Save models parsed from content. Entries are written atomically, 
+        several processes can share a cache directory.
+        """
+        states = [model.__dict__ for model in models]
+        data = zlib.compress(json.dumps(_cache_encode((states, current)), encoding="latin-1"))
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # created by another process
+                if not os.path.isdir(self.path):
+                    raise
+        fd, tmppath = tempfile.mkstemp(prefix=".tmp_", dir=self.path)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            if os.name == "nt" and os.path.exists(self._entry_path(content)):
+                # no atomic replace on Windows
+                os.remove(self._entry_path(content))
+            os.rename(tmppath, self._entry_path(content))
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+            
+    def clear(self):
+        """
+        Remove all cache entries
+        """
+        # also entries in pickle format from older versions
+        for pattern in ("*.jsz", "*.pkz"):
+            for path in glob.glob(os.path.join(self.path, pattern)):
+                os.remove(path)
+
 class vhdl_parser(object):
     """
     VHDL parser - code object
@@ -546,38 +822,41 @@ class vhdl_parser(object):
     """
     def __init__(self, initial_content):
         self.model = vhdl_model()
+        # a file with several entities has one model for each one
+        self.models = [self.model]
         self.filename = "Untitled.vhdl"
         
         # use StringIO to save contents
         if initial_content is None:
             self.filecontent = StringIO.StringIO()
-        elif type(initial_content) == str:
-            if os.path.exists(initial_content):
-                self.filename = initial_content
-                with open(initial_content) as f:
-                    self.filecontent = StringIO.StringIO(f.read())
-            else:
-                # assume string content
-                self.filecontent = StringIO.StringIO(initial_content)
-        elif type(initial_content) == file:
-            self.filename = initial_content.name
-            t = initial_content.tell()
-            initial_content.seek(0)
-            self.filecontent = StringIO.StringIO(initial_content.read())
-            initial_content.seek(t)
-        elif isinstance(initial_content, StringIO.StringIO):
-            self.filecontent = initial_content
         else:
-            raise ValueError("Unable to set initial content with %s" % repr(initial_content))
+            filename, self.filecontent = read_source(initial_content)
+            if filename is not None:
+                self.filename = filename
         self.filecontent.seek(0)
         
     # main methods
-    def parse(self):
+    def parse(self, cache=None):
         """
-        Stages:
+        Stages: tokenize, then each section (library and use clauses, 
+        entity, architecture, package, configuration) to model
+        
+        Arguments:
+        * cache: vhdl_cache object or cache directory. Models of an already
+          parsed content are loaded from cache instead of parsed. Errors 
+          writing the cache are ignored
         """
+        if cache is not None:
+            if not isinstance(cache, vhdl_cache):
+                cache = vhdl_cache(cache)
+            content = self.filecontent.getvalue()
+            entry = cache.load(content)
+            if entry is not None:
+                self.models, current = entry
+                self.model = self.models[current]
+                return
         token_list = self._tokenize()
-        it = iter(token_list)
+        self._toks = None
         # Note: use index to walk token list
         idx = 0
         # header section
@@ -588,126 +867,132 @@ class vhdl_parser(object):
                 break
             idx += 1
         # next section
-        while idx < len(token_list):
-            sec = token_list[idx]
-            # ignore comments (NOTE: could be saved if tied to a keyword, TODO)
-            if sec.startswith("--"):
-                idx += 1
-                continue
-            elif sec.lower() in ("library", "use"):
-                # read entire line until ";" token
-                idx_end = self._find_token(token_list, ";", idx)
-                if idx_end is None:
-                    raise ParseException("Statement '%s' without ';'." % sec, sec)
-                self._p_library(token_list[idx:idx_end])
-                idx = idx_end + 1
-            elif sec.lower() == "entity":
-                # read entire entity until nearest end statement
-                idx_end = self._find_token(token_list, "end", idx)
-                if idx_end is None:
-                    raise ParseException("Statement '%s' without 'end'." % sec, sec)
-                # next: either <entity_name> or "sec"
-                idx_end += 1
-                if token_list[idx_end].lower() == "entity":
-                    # next is <section_name>
-                    idx_end += 1
-                if token_list[idx+1] != token_list[idx_end]:
-                    raise ParseException("Ambiguous entity definition: (%s or %s)" % (token_list[idx+1], token_list[idx_end]), sec)
-                # next is ";"
-                idx_end += 1
-                if token_list[idx_end] != ";":
-                    raise ParseException("Expected ';'", token_list[idx_end])
-                # process section
-                self._p_entity(token_list[idx:idx_end])
-                idx = idx_end + 1
-            elif sec.lower() == "architecture":
-                # find correct "end" token: 
-                idx_end = idx
-                while idx_end < len(token_list):
-                    idx_end = self._find_token(token_list, "end", idx_end)
+        try:
+            while idx < len(token_list):
+                sec = token_list[idx]
+                # ignore comments (NOTE: could be saved if tied to a keyword, TODO)
+                if sec.startswith("--"):
+                    idx += 1
+                    continue
+                elif sec.lower() in ("library", "use"):
+                    # read entire line until ";" token
+                    idx_end = self._find_token(token_list, ";", idx)
+                    if idx_end is None:
+                        raise ParseException("Statement '%s' without ';'." % sec, self._token(idx))
+                    self._p_library(token_list[idx:idx_end])
+                    idx = idx_end + 1
+                elif sec.lower() == "entity":
+                    # read entire entity until nearest end statement
+                    idx_end = self._find_token(token_list, "end", idx)
                     if idx_end is None:
-                        raise ParseException("Statement 'architecture %s' without 'end'." % token_list[idx+1], sec)
-                    # next: either <architecture_name> or "architecture"
+                        raise ParseException("Statement '%s' without 'end'." % sec, self._token(idx))
+                    # next: either <entity_name> or "sec"
                     idx_end += 1
-                    if token_list[idx_end].lower() in ("architecture", token_list[idx+1]):
-                        break
-                if token_list[idx_end].lower() == "architecture":
-                    # next is <architecture_name>
+                    if token_list[idx_end].lower() == "entity":
+                        # next is <section_name>
+                        idx_end += 1
+                    if token_list[idx+1] != token_list[idx_end]:
+                        raise ParseException("Ambiguous entity definition: (%s or %s)" % (token_list[idx+1], token_list[idx_end]), self._token(idx))
+                    # next is ";"
                     idx_end += 1
-                # next is ";"
-                idx_end += 1
-                if token_list[idx_end] != ";":
-                    raise ParseException("Expected ';'", token_list[idx_end])
-                # process architecture
-                self._p_architecture(token_list[idx:idx_end])
-                idx = idx_end + 1
-            else:
-                raise ParseException("Unknown section '%s'" % sec, sec)
+                    if token_list[idx_end] != ";":
+                        raise ParseException("Expected ';'", self._token(idx_end))
+                    # process section
+                    if self.model.get_entity_name() is not None:
+                        # next entity in the same file
+                        self.model = vhdl_model()
+                        self.models.append(self.model)
+                    self._p_entity(self._token_range(idx, idx_end))
+                    idx = idx_end + 1
+                elif sec.lower() == "architecture":
+                    idx = self._p_architecture(token_list, idx)
+                elif sec.lower() == "package":
+                    idx = self._p_package(token_list, idx)
+                elif sec.lower() == "configuration":
+                    idx = self._p_configuration(token_list, idx)
+                else:
+                    raise ParseException("Unknown section '%s'" % sec, self._token(idx))
+        except IndexError:
+            # a unit cut before its end
+            raise ParseException("Unexpected end of file in '%s' statement." % sec, self._token(idx))
+        if cache is not None:
+            try:
+                cache.store(content, self.models, self.models.index(self.model))
+            except EnvironmentError:
+                # best effort: unwritable cache directory, full disk
+                pass
         
     def _tokenize(self):
-        token_list = []
-        it = iter(self.filecontent)
-        linenum = 0
-        for line in it:
-            linenum += 1
-            # get rid of tabs and spaces at line beginning
-            ls_line = line.lstrip()
-            # get first line comments
-            if ls_line.startswith("--"):
-                colnum = line.find("--") + 1
-                token_list.append(str_token(ls_line, linenum, colnum))
-            else:
-                # split by lines
-                split_line = re.split(r"(\s|:=|<=|=>|--|\W)", ls_line)
-                # check for comments at the end, take entire comment as a token
-                try:
-                    idx = split_line.index("--")
-                    c = "".join(split_line[idx:])
-                    split_line[idx] = c
-                    del(split_line[idx+1:])
-                except:
-                    pass
-                # add line,col info to all strings
-                for i in range(len(split_line)):
-                    colnum = line.find(split_line[i]) + 1
-                    meta = None
-                    if split_line[i].startswith("--"):
-                        # hack: use "meta" argument to flag comment as "inline"
-                        meta = "inline-comment"
-                    split_line[i] = str_token(split_line[i], linenum, colnum, meta)
-                token_list.extend(split_line)
-        # special case: quotes
-        idx = 0
-        idx_end = 0
-        for quote in ('"', "'"):
-            while True:
-                try:
-                    idx = token_list.index(quote)
-                except:
-                    break
-                try:
-                    idx_end = token_list.index(quote, idx+1) + 1
-                except:
-                    raise ParseException("Found a open <%s>." % quote, token_list[idx])
-                t = "".join(token_list[idx:idx_end])
-                token_list[idx] = t
-                del(token_list[idx+1:idx_end])
-            
-        # clean whitespaces and empty strings
-        for space in ("", " ", "\n"):
-            while True:
-                try:
-                    idx = token_list.index(space)
-                except:
-                    break
-                del(token_list[idx])
+        """
+        Split file content in tokens, with _vhdl_token_re for each line. 
+        Tokens are plain strings: whitespace is dropped, comments keep the 
+        line end. Line and column numbers are only found for the tokens 
+        that need them (see _token_range).
+        """
+        # tokens don't make reference cycles: don't let the cyclic garbage 
+        # collector run for each list of line tokens
+        gcenabled = gc.isenabled()
+        gc.disable()
+        try:
+            # source lines, also for architecture body text
+            self._lines = self.filecontent.getvalue().splitlines(True)
+            self._line_tokens = map(_vhdl_token_re.findall, self._lines)
+        finally:
+            if gcenabled:
+                gc.enable()
+        # index of the first token of each line
+        self._line_starts = starts = []
+        n = 0
+        for tokens in self._line_tokens:
+            starts.append(n)
+            n += len(tokens)
+        self._token_list = token_list = list(chain.from_iterable(self._line_tokens))
+        if '"' in token_list:
+            raise ParseException("Found a open <\">.", self._token(token_list.index('"')))
         return token_list
-                
+        
+    def _token_positions(self, start, end):
+        # (token, line, column) for token_list[start:end]
+        starts = self._line_starts
+        line = bisect.bisect_right(starts, start)
+        i = start
+        while i < end:
+            while line < len(starts) and starts[line] <= i:
+                line += 1
+            text = self._lines[line - 1]
+            tokens = self._line_tokens[line - 1]
+            first = starts[line - 1]
+            col = 0
+            for k, t in enumerate(tokens):
+                col = text.find(t, col)
+                if i <= first + k < end:
+                    yield t, line, col + 1
+                col += len(t)
+            i = first + len(tokens)
+        
+    def _token_range(self, start, end):
+        """
+        str_token objects for token_list[start:end], with line and column 
+        numbers. Comments after other tokens on the same line are flagged 
+        with "inline-comment" meta.
+        """
+        result = []
+        for t, line, col in self._token_positions(start, end):
+            meta = None
+            if t.startswith("--") and self._lines[line - 1][:col - 1].strip() != "":
+                meta = "inline-comment"
+            result.append(str_token(t, line, col, meta))
+        return result
+        
+    def _token(self, i):
+        return self._token_range(i, i + 1)[0]
+        
     def _find_token(self, list, token, start=0, end=-1):
         if end == -1:
             end = len(list)
-        for i in range(start, end):
-            if list[i].lower() == token.lower():
+        token = token.lower()
+        for i in xrange(start, end):
+            if list[i].lower() == token:
                 return i
         return None
             
@@ -814,22 +1099,684 @@ class vhdl_parser(object):
             else:
                 raise ParseException("Unexpected '%s' statement." % sec, sec)
         
-    def _p_architecture(self, line):
-        self.model.set_architecture_name(line[1])
+    def _p_architecture(self, token_list, idx):
+        """
+        architecture <name> of <entity> is <declarations> begin 
+        <concurrent statements> end [architecture] [<name>] ;
         
-        # WARNING: copy entire architecture content without further parsing
-        # TODO: implement architecture parsing (including model)
+        Signal declarations, instantiations and processes go to the model 
+        (also inside blocks and generate statements), other items are 
+        skipped. Returns the index after the closing ';'
+        """
+        start = self._p_unit_tokens(token_list, idx)
+        toks, low = self._toks, self._low
+        sec = self._p_token(start)
+        if len(toks) < start + 5 or low[start+2] != "of" or low[start+4] != "is":
+            raise ParseException("Expected 'architecture <name> of <entity> is'.", sec)
+        self.model = self._architecture_model(toks[start+3])
+        self.model.set_architecture_name(toks[start+1], toks[start+3])
+        try:
+            idx_end = self._p_arch_items(start + 5, "")
+            # end [architecture] [<name>] ;
+            i = idx_end + 1
+            if low[i] == "architecture":
+                i += 1
+            if low[i] == low[start+1]:
+                i += 1
+        except IndexError:
+            raise ParseException("Statement 'architecture %s' without 'end'." % toks[start+1], sec)
+        if toks[i] != ";":
+            raise ParseException("Expected ';'", self._p_token(i))
+        # architecture text for code generation. Don't include 'architecture'
+        # and 'end architecture' lines
+        startline = sec._getlinecol()[0]
+        endline = self._p_line(i - 1)
+        self.model.add_architecture_body("".join(self._lines[startline:endline - 1]))
+        return self._p_pos(i) + 1
         
-        # copy all text lines from line[0] to line[-1]. Don't include 'architecture'
-        # and 'end architecture' statements
-        startline, col = line[0]._getlinecol()
-        endline, col = line[-1]._getlinecol()
-        startline += 1
-        linecount = 0
-        self.filecontent.seek(0)
-        for fl in self.filecontent:
-            linecount += 1
-            if linecount >= endline:
+    def _architecture_model(self, entity_name):
+        # model for an architecture: the one with its entity, the current 
+        # one if it has no architecture yet, or a new one
+        for model in self.models:
+            name = model.get_entity_name()
+            if name is not None and name.lower() == entity_name.lower() and \
+                    model.get_architecture_name() is None:
+                return model
+        if self.model.get_architecture_name() is None:
+            return self.model
+        model = vhdl_model()
+        self.models.append(model)
+        return model
+        
+    def _p_unit_tokens(self, token_list, idx):
+        # design units are parsed from the tokens without comments, built 
+        # once for each parse. Inline comments are kept by line number, for
+        # signal descriptions. Returns the position of token_list[idx]
+        if self._toks is None:
+            # a comment is always the last token of a line
+            self._comments = {}
+            comments = []
+            for line in [k for k, text in enumerate(self._lines) if "--" in text]:
+                tokens = self._line_tokens[line]
+                if tokens[-1].startswith("--"):
+                    comments.append(self._line_starts[line] + len(tokens) - 1)
+                    if len(tokens) > 1:
+                        self._comments[line + 1] = tokens[-1]
+            self._toks = toks = []
+            prev = 0
+            for i in comments:
+                toks.extend(token_list[prev:i])
+                prev = i + 1
+            toks.extend(token_list[prev:])
+            # tokens without comments have no line ends
+            self._low = "\n".join(toks).lower().split("\n")
+            # comment token positions, and positions in self._toks of the 
+            # token after each one
+            self._comment_pos = comments
+            self._comment_next = [i - k for k, i in enumerate(comments)]
+        return idx - bisect.bisect_left(self._comment_pos, idx)
+        
+    def _p_pos(self, i):
+        # position in token_list of self._toks[i]
+        return i + bisect.bisect_right(self._comment_next, i)
+        
+    def _p_token(self, i):
+        # self._toks[i] with line and column numbers, for errors
+        return self._token(self._p_pos(i))
+        
+    def _p_line(self, i):
+        # line number of self._toks[i]
+        return bisect.bisect_right(self._line_starts, self._p_pos(i))
+        
+    def _p_package(self, token_list, idx):
+        """
+        package [body] <name> is <declarations> end [package [body]] [<name>] ;
+        
+        Only the package name goes to the model. Returns the index after the
+        closing ';'
+        """
+        i = self._p_unit_tokens(token_list, idx)
+        toks, low = self._toks, self._low
+        sec = self._p_token(i)
+        body = low[i+1] == "body"
+        if body:
+            i += 1
+        name = toks[i+1]
+        if low[i+2] != "is":
+            raise ParseException("Expected 'is' statement.", self._p_token(i+2))
+        try:
+            if low[i+3] == "new":
+                # VHDL-2008 package instantiation
+                i = self._p_statement_end(i)
+            else:
+                i = self._p_skip_declarations(i + 3, "end")
+                i += 1
+                if low[i] == "package":
+                    i += 1
+                    if low[i] == "body":
+                        i += 1
+                if low[i] == name.lower():
+                    i += 1
+        except IndexError:
+            raise ParseException("Statement 'package %s' without 'end'." % name, sec)
+        if toks[i] != ";":
+            raise ParseException("Expected ';'", self._p_token(i))
+        self.model.add_package(name, body)
+        return self._p_pos(i) + 1
+        
+    def _p_configuration(self, token_list, idx):
+        # configuration <name> of <entity> is <block configuration> 
+        # end [configuration] [<name>] ; Not kept in model. 
+        # Returns the index after the closing ';'
+        i = self._p_unit_tokens(token_list, idx)
+        low = self._low
+        sec = self._p_token(i)
+        try:
+            # block configurations nest with "end for"
+            while not (low[i] == "end" and low[i+1] != "for"):
+                i += 1
+            i = self._p_statement_end(i)
+        except IndexError:
+            raise ParseException("Statement '%s' without 'end'." % sec, sec)
+        return self._p_pos(i) + 1
+        
+    def _p_arch_items(self, i, prefix):
+        # declarations and concurrent statements until 'end'. Returns the 
+        # 'end' index. prefix: block and generate labels for model names
+        toks, low = self._toks, self._low
+        while True:
+            t = low[i]
+            if t == "end":
+                return i
+            elif t == "begin":
+                i += 1
+            elif t == "signal":
+                i = self._p_signal(i, prefix)
+            elif t == "component":
+                i = self._p_skip_until_end(i, "component")
+            elif t in ("function", "procedure", "pure", "impure"):
+                i = self._p_skip_subprogram(i)
+            elif t == "type":
+                i = self._p_skip_type(i)
+            elif t == "process" or (t == "postponed" and low[i+1] == "process"):
+                i = self._p_process(i, None, prefix)
+            elif t in ("elsif", "else"):
+                # VHDL-2008 generate alternatives
+                i = low.index("generate", i) + 1
+            elif t == "when":
+                i = low.index("=>", i) + 1
+            elif toks[i+1] == ":":
+                i = self._p_labeled(i + 2, toks[i], prefix)
+            else:
+                # other declarations, assignments, assertions, procedure calls
+                i = self._p_statement_end(i) + 1
+        
+    def _p_labeled(self, i, label, prefix):
+        # concurrent statement after "<label> :"
+        toks, low = self._toks, self._low
+        t = low[i]
+        if t == "process" or (t == "postponed" and low[i+1] == "process"):
+            return self._p_process(i, label, prefix)
+        elif t == "block":
+            i += 1
+            if toks[i] == "(":
+                # guard expression
+                i = self._p_skip_parens(i)
+            if low[i] == "is":
+                i += 1
+            i = self._p_arch_items(i, prefix + label + ".")
+            return self._p_end(i, "block", label)
+        elif t in ("for", "if", "case"):
+            i = low.index("generate", i) + 1
+            i = self._p_arch_items(i, prefix + label + ".")
+            while low[i+1] != "generate":
+                # VHDL-2008 alternative end: end [<alternative label>] ;
+                i = self._p_arch_items(self._p_statement_end(i) + 1, prefix + label + ".")
+            return self._p_end(i, "generate", label)
+        elif t in ("entity", "configuration", "component") or low[i+1] in ("generic", "port", ";"):
+            return self._p_instance(i, label, prefix)
+        # labeled assignment, assertion or procedure call
+        return self._p_statement_end(i) + 1
+        
+    def _p_end(self, i, keyword, label):
+        # end <keyword> [<label>] ; Returns the index after ';'
+        toks, low = self._toks, self._low
+        if low[i+1] != keyword:
+            raise ParseException("Expected 'end %s'" % keyword, self._p_token(i))
+        i += 2
+        if low[i] == label.lower():
+            i += 1
+        if toks[i] != ";":
+            raise ParseException("Expected ';'", self._p_token(i))
+        return i + 1
+        
+    def _p_signal(self, i, prefix):
+        # signal <name> {, <name>} : <type> [register | bus] [:= <value>] ;
+        toks = self._toks
+        names = [toks[i+1]]
+        i += 2
+        while toks[i] == ",":
+            names.append(toks[i+1])
+            i += 2
+        if toks[i] != ":":
+            raise ParseException("Expected ':' token.", self._p_token(i))
+        idx_end = self._p_statement_end(i)
+        decl_end = idx_end
+        defval = None
+        for k in xrange(i + 1, idx_end):
+            if toks[k] == ":=":
+                defval = self._p_text(k + 1, idx_end)
+                decl_end = k
                 break
-            if linecount >= startline:
-                self.model.add_architecture_body(fl)
+        if toks[decl_end-1].lower() in ("register", "bus"):
+            decl_end -= 1
+        sigtype = self._p_text(i + 1, decl_end)
+        comment = self._comments.get(self._p_line(idx_end), "")
+        for name in names:
+            self.model.add_signal(prefix + name, sigtype, defval, comment)
+        return idx_end + 1
+        
+    def _p_instance(self, i, label, prefix):
+        # [component | entity | configuration] [<library> .] <unit> [( <architecture> )]
+        # [generic map ( <associations> )] [port map ( <associations> )] ;
+        toks, low = self._toks, self._low
+        kind = "component"
+        if low[i] in ("entity", "configuration", "component"):
+            kind = low[i]
+            i += 1
+        names = [toks[i]]
+        i += 1
+        while toks[i] == ".":
+            names.append(toks[i+1])
+            i += 2
+        library = None
+        if len(names) > 1:
+            library = names[-2]
+        architecture = None
+        if kind == "entity" and toks[i] == "(":
+            architecture = toks[i+1]
+            i += 3
+        maps = {"generic": None, "port": None}
+        while low[i] in maps:
+            sec = low[i]
+            if low[i+1] != "map":
+                raise ParseException("Expected '%s map'" % sec, self._p_token(i+1))
+            maps[sec], i = self._p_associations(i + 2)
+        if toks[i] != ";":
+            raise ParseException("Expected ';'", self._p_token(i))
+        self.model.add_instance(prefix + label, names[-1], kind, library, architecture, 
+            maps["generic"], maps["port"])
+        return i + 1
+        
+    def _p_associations(self, i):
+        # ( [<formal> =>] <actual> {, [<formal> =>] <actual>} )
+        # Returns (OrderedDict formal -> actual, index after ')')
+        toks = self._toks
+        if toks[i] != "(":
+            raise ParseException("Expected '(' token.", self._p_token(i))
+        idx_end = self._p_skip_parens(i) - 1
+        assoc = OrderedDict()
+        for start, end in self._p_split(i + 1, idx_end):
+            formal = len(assoc)
+            for k in xrange(start, end):
+                if toks[k] == "=>":
+                    formal = self._p_text(start, k)
+                    start = k + 1
+                    break
+            assoc[formal] = self._p_text(start, end)
+        return assoc, idx_end + 1
+        
+    def _p_process(self, i, label, prefix):
+        # [postponed] process [( <sensitivity list> )] [is] ... end [postponed] process [<label>] ;
+        toks, low = self._toks, self._low
+        startline = self._p_line(i)
+        if low[i] == "postponed":
+            i += 1
+        i += 1
+        sensitivity = []
+        if toks[i] == "(":
+            idx_end = self._p_skip_parens(i) - 1
+            sensitivity = [self._p_text(start, end) for start, end in self._p_split(i + 1, idx_end)]
+            i = idx_end + 1
+        # processes don't nest
+        while not (low[i] == "end" and low[i+1] in ("process", "postponed")):
+            i += 1
+        endline = self._p_line(i)
+        if low[i+1] == "postponed":
+            i += 1
+        i = self._p_end(i, "process", label or "")
+        if label is not None:
+            label = prefix + label
+        self.model.add_process(label, sensitivity, (startline, endline))
+        return i
+        
+    def _p_skip_subprogram(self, i):
+        # [pure | impure] function | procedure <name> [( <parameters> )] 
+        # [return <type>] ( ; | is <declarations> begin <statements> end ... ; )
+        toks, low = self._toks, self._low
+        while toks[i] != ";" and low[i] != "is":
+            if toks[i] == "(":
+                i = self._p_skip_parens(i)
+            else:
+                i += 1
+        if toks[i] == ";" or low[i+1] == "new":
+            # declaration or VHDL-2008 instantiation
+            return self._p_statement_end(i) + 1
+        i = self._p_skip_declarations(i + 1, "begin")
+        # sequential statements: first 'end' that doesn't close if/loop/case
+        while not (low[i] == "end" and low[i+1] not in ("if", "loop", "case")):
+            i += 1
+        return self._p_statement_end(i) + 1
+        
+    def _p_skip_declarations(self, i, stop):
+        # declarations of a subprogram or package until the stop keyword. 
+        # Returns its index
+        low = self._low
+        while low[i] != stop:
+            if low[i] in ("function", "procedure", "pure", "impure"):
+                i = self._p_skip_subprogram(i)
+            elif low[i] == "type":
+                i = self._p_skip_type(i)
+            elif low[i] == "component":
+                i = self._p_skip_until_end(i, "component")
+            else:
+                i = self._p_statement_end(i) + 1
+        return i
+        
+    def _p_skip_type(self, i):
+        # type declaration, including record, physical and protected types
+        toks, low = self._toks, self._low
+        while toks[i] != ";":
+            if low[i] in ("record", "units", "protected"):
+                i = self._p_skip_until_end(i, low[i]) - 1
+            elif toks[i] == "(":
+                i = self._p_skip_parens(i)
+            else:
+                i += 1
+        return i + 1
+        
+    def _p_skip_until_end(self, i, keyword):
+        # skip until "end <keyword> ... ;". Returns the index after ';'
+        low = self._low
+        while not (low[i] == "end" and low[i+1] == keyword):
+            i += 1
+        return self._p_statement_end(i) + 1
+        
+    def _p_statement_end(self, i):
+        # index of the next ';' outside parenthesis
+        toks = self._toks
+        depth = 0
+        while True:
+            t = toks[i]
+            if t == ";" and depth == 0:
+                return i
+            elif t == "(":
+                depth += 1
+            elif t == ")":
+                depth -= 1
+            i += 1
+            
+    def _p_skip_parens(self, i):
+        # index after the ')' matching '(' at i
+        toks = self._toks
+        depth = 0
+        while True:
+            t = toks[i]
+            if t == "(":
+                depth += 1
+            elif t == ")":
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            i += 1
+            
+    def _p_split(self, start, end):
+        # split tokens start to end by ',' outside parenthesis. Returns a 
+        # list of (start, end) ranges
+        toks = self._toks
+        items = []
+        depth = 0
+        for i in xrange(start, end):
+            t = toks[i]
+            if t == "," and depth == 0:
+                items.append((start, i))
+                start = i + 1
+            elif t == "(":
+                depth += 1
+            elif t == ")":
+                depth -= 1
+        items.append((start, end))
+        return items
+            
+    def _p_text(self, start, end):
+        # tokens start to end back to text, with a space where the source 
+        # has whitespace
+        if end - start <= 1:
+            return "".join(self._toks[start:end])
+        first = self._p_pos(start)
+        last = self._p_pos(end - 1)
+        starts = self._line_starts
+        line = bisect.bisect_right(starts, first)
+        parts = []
+        if line == bisect.bisect_right(starts, last):
+            # all in one line, without comments
+            text = self._lines[line - 1]
+            tokens = self._line_tokens[line - 1]
+            col = 0
+            for t in tokens[:first - starts[line - 1]]:
+                col = text.find(t, col) + len(t)
+            for t in tokens[first - starts[line - 1]:last - starts[line - 1] + 1]:
+                pos = text.find(t, col)
+                if parts and pos != col:
+                    parts.append(" ")
+                parts.append(t)
+                col = pos + len(t)
+            return "".join(parts)
+        prevline = prevend = None
+        for t, line, col in self._token_positions(first, last + 1):
+            if t.startswith("--"):
+                continue
+            if prevline is not None and (line != prevline or col != prevend):
+                parts.append(" ")
+            parts.append(t)
+            prevline, prevend = line, col + len(t)
+        return "".join(parts)
+        
+def _parse_file(args):
+    # vhdl_project worker: (list of vhdl_model, error message)
+    path, cache = args
+    try:
+        parser = vhdl_parser(path)
+        parser.parse(cache)
+    except (ParseException, ValueError) as e:
+        return None, str(e)
+    return parser.models, None
+    
+class vhdl_project(object):
+    """
+    VHDL project: design units from several source files
+    
+    Files are parsed (in worker processes) to index entities, architectures 
+    and packages by name. Use clauses and instances give the dependencies 
+    between files, and compile_order() sorts the files so each one is 
+    analyzed after the ones it depends on.
+    """
+    def __init__(self, files=None, library="work"):
+        self.library = library
+        # path -> list of vhdl_model (None until parsed)
+        self.files = OrderedDict()
+        # parse errors: path -> message
+        self.errors = OrderedDict()
+        # indexes, with lower case names
+        # entities: name -> (path, model)
+        # architectures: (entity name, architecture name) -> (path, model)
+        # packages, package_bodies: name -> path
+        self.entities = OrderedDict()
+        self.architectures = OrderedDict()
+        self.packages = OrderedDict()
+        self.package_bodies = OrderedDict()
+        if files is not None:
+            self.add_files(files)
+            
+    def add_files(self, files):
+        """
+        Add source files
+        
+        Arguments:
+        * files: path, glob pattern or a list of them. Files matched by a 
+          pattern are added in name order
+        """
+        if isinstance(files, str):
+            files = [files]
+        for f in files:
+            if glob.has_magic(f):
+                paths = sorted(glob.glob(f))
+            else:
+                paths = [f]
+            for path in paths:
+                if path not in self.files:
+                    self.files[path] = None
+                    
+    def parse(self, processes=None, ignore_errors=False, cache=None):
+        """
+        Parse the files added since last call and update indexes
+        
+        Arguments:
+        * processes: number of worker processes. None for one for each CPU,
+          1 to parse in this process (required for files kept in memory by 
+          an open_interceptor object)
+        * ignore_errors: keep parse errors in self.errors instead of raising
+          ParseException. Those files have no design units
+        * cache: vhdl_cache object or cache directory, see vhdl_parser.parse
+        
+        A design unit already defined (in another file or twice in the same 
+        file) raises ValueError, or is an error of the file with 
+        ignore_errors: the first definition is kept.
+        """
+        paths = [path for path, models in self.files.iteritems() if models is None]
+        jobs = [(path, cache) for path in paths]
+        if processes == 1 or len(paths) <= 1:
+            results = map(_parse_file, jobs)
+        else:
+            if processes is None:
+                processes = multiprocessing.cpu_count()
+            pool = multiprocessing.Pool(processes)
+            try:
+                # a few chunks for each process: files are usually small
+                chunksize = max(1, len(paths) // (4 * processes))
+                results = pool.map(_parse_file, jobs, chunksize)
+            finally:
+                pool.close()
+                pool.join()
+        if not ignore_errors:
+            for path, (models, error) in zip(paths, results):
+                if error is not None:
+                    raise ParseException("%s: %s" % (path, error))
+        for path, (models, error) in zip(paths, results):
+            if error is None:
+                error = self._duplicate(path, models)
+                if error is not None and not ignore_errors:
+                    raise ValueError("%s: %s" % (path, error))
+            if error is not None:
+                self.errors[path] = error
+                models = []
+            self.files[path] = models
+            self._index(path, models)
+            
+    def _units(self, path, models):
+        # (kind, index, key, value) for each design unit of models
+        for model in models:
+            name = model.get_entity_name()
+            if name is not None:
+                yield "entity", self.entities, name.lower(), (path, model)
+            name = model.get_architecture_name()
+            if name is not None:
+                key = (model.get_architecture_entity().lower(), name.lower())
+                yield "architecture", self.architectures, key, (path, model)
+            for name, data in model.get_packages_iter():
+                if data["declaration"]:
+                    yield "package", self.packages, name.lower(), path
+                if data["body"]:
+                    yield "package body", self.package_bodies, name.lower(), path
+                    
+    def _duplicate(self, path, models):
+        # error message for the first unit of models already indexed or 
+        # defined twice in models, None if all are new
+        seen = set()
+        for kind, index, key, value in self._units(path, models):
+            if key in index or (kind, key) in seen:
+                other = index.get(key, path)
+                if isinstance(other, tuple):
+                    other = other[0]
+                if kind == "architecture":
+                    key = "%s of %s" % (key[1], key[0])
+                return "Duplicate %s '%s', also defined in %s." % (kind, key, other)
+            seen.add((kind, key))
+        return None
+        
+    def _index(self, path, models):
+        for kind, index, key, value in self._units(path, models):
+            index[key] = value
+                    
+    def get_entity(self, name):
+        """
+        Model of an entity, None if not found
+        """
+        return self.entities.get(name.lower(), (None, None))[1]
+        
+    def dependencies(self, path):
+        """
+        Files that must be analyzed before a file (direct dependencies): 
+        packages and entities it uses, entity of its architectures, package
+        declaration of its package bodies. Units not found in the project 
+        (e.g. ieee library) are ignored.
+        """
+        libraries = ["work"]
+        if self.library.lower() != "work":
+            libraries.append(self.library)
+        deps = OrderedDict()
+        for model in self.files[path] or []:
+            units = []
+            for lib in libraries:
+                units.extend(model.get_used_units(lib))
+            if model.get_architecture_entity() is not None:
+                units.append(model.get_architecture_entity())
+            for name, data in model.get_packages_iter():
+                if data["body"] and not data["declaration"]:
+                    units.append(name)
+            for name in units:
+                name = name.lower()
+                if name in self.packages:
+                    deps[self.packages[name]] = None
+                if name in self.entities:
+                    deps[self.entities[name][0]] = None
+        deps.pop(path, None)
+        return deps.keys()
+        
+    def _implementations(self, path):
+        # files with architectures of the entities declared in path, and 
+        # bodies of its packages
+        impl = []
+        for model in self.files[path] or []:
+            name = model.get_entity_name()
+            if name is not None:
+                impl.extend(p for (entity, arch), (p, m) in self.architectures.iteritems() 
+                    if entity == name.lower())
+            for name, data in model.get_packages_iter():
+                if data["declaration"] and name.lower() in self.package_bodies:
+                    impl.append(self.package_bodies[name.lower()])
+        return impl
+        
+    def compile_order(self, top=None):
+        """
+        Files in analysis order: each file after the files it depends on. 
+        Independent files keep the order they were added. Files not parsed
+        yet are parsed first.
+        
+        Arguments:
+        * top: entity name or file path. Only return the files needed to 
+          analyze and elaborate it: its dependencies, and the architectures
+          and package bodies of the entities and packages they declare
+        
+        Raises ValueError on circular dependencies.
+        """
+        if None in self.files.itervalues():
+            self.parse()
+        deps = dict((path, self.dependencies(path)) for path in self.files)
+        if top is None:
+            paths = self.files.keys()
+        else:
+            if top.lower() in self.entities:
+                top = self.entities[top.lower()][0]
+            elif top not in self.files:
+                raise ValueError("Unknown top entity or file '%s'." % top)
+            needed = set()
+            stack = [top]
+            while len(stack) > 0:
+                path = stack.pop()
+                if path not in needed:
+                    needed.add(path)
+                    stack.extend(deps[path])
+                    stack.extend(self._implementations(path))
+            paths = [path for path in self.files if path in needed]
+        # topological sort, ready files in insertion order
+        position = dict((path, i) for i, path in enumerate(paths))
+        pending = dict((path, len(deps[path])) for path in paths)
+        users = dict((path, []) for path in paths)
+        for path in paths:
+            for d in deps[path]:
+                users[d].append(path)
+        ready = [(position[path], path) for path in paths if pending[path] == 0]
+        heapq.heapify(ready)
+        order = []
+        while len(ready) > 0:
+            i, path = heapq.heappop(ready)
+            order.append(path)
+            for user in users[path]:
+                pending[user] -= 1
+                if pending[user] == 0:
+                    heapq.heappush(ready, (position[user], user))
+        if len(order) < len(paths):
+            cycle = [path for path in paths if pending[path] > 0]
+            raise ValueError("Circular dependency between files: %s" % ", ".join(cycle))
+        return order